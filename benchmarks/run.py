@@ -0,0 +1,275 @@
+"""
+Benchmarks of the saving modes with stand-in servers running in this process. Works offline.
+
+Run from the root of the repository:
+    python -m benchmarks.run
+    python -m benchmarks.run --modes LOCAL SFTP --trees tiny --scale 0.5 --repeat 3
+    python -m benchmarks.run --compare <old commit> <new commit>
+
+Like the application, the benchmarks need paramiko. FTP and FTPS also need pyftpdlib (and pyOpenSSL for FTPS),
+they are skipped if it is not installed. Results are written in benchmarks/results/<commit>.json to compare the
+runs across commits.
+"""
+import argparse
+import configparser
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.servers import PASSWORD, USERNAME, FtpServer, SftpServer, SmtpSink
+from benchmarks.trees import TREES, make_tree
+from main import app
+from main.saving_modes.dedup_saving import DedupSave
+from main.saving_modes.ftp_ftps_saving import FtpFtpsSave
+from main.saving_modes.local_saving import LocalSave
+from main.saving_modes.sftp_saving import SftpSave
+from main.utils.infos import REPORT_NAME, Infos
+from main.utils.settings import Settings
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIRECTORY = os.path.join(REPOSITORY, "benchmarks", "results")
+
+# APP runs the whole application (settings, scan, LOCAL save and mail) like the command line does.
+# SFTP_DELTA saves the tree over SFTP a second time, with delta transfers on several channels: the large files are
+# compared with their version in the first backup.
+MODES = ['LOCAL', 'DEDUP', 'FTP', 'FTPS', 'SFTP', 'SFTP_DELTA', 'APP']
+
+# Save mode written in settings.ini for the modes that are not save modes.
+SAVE_MODES = {'APP': 'LOCAL', 'SFTP_DELTA': 'SFTP'}
+
+# Files of at least this size are sent with delta transfers in SFTP_DELTA.
+DELTA_THRESHOLD = 1024 * 1024
+
+
+def write_settings(path, mode, tree_path, destination, port, smtp_port, options):
+    """
+    Write a settings.ini for one benchmark.
+    :param path: Path of the settings file.
+    :param mode: One of MODES.
+    :param tree_path: Directory to save.
+    :param destination: Directory to save in.
+    :param port: Port of the stand-in server, None for local modes.
+    :param smtp_port: Port of the SMTP sink.
+    :param options: Dict of other [main] options, e.g. nb_threads.
+    """
+    config = configparser.ConfigParser()
+    # Backups named by version, the two runs of SFTP_DELTA can start in the same second
+    config['main'] = {'save_mode': SAVE_MODES.get(mode, mode), 'paths_to_save': tree_path,
+                      'archiving_mode': 'version' if mode == 'SFTP_DELTA' else 'date', 'archiving_max': '100',
+                      'directory_to_save_in': destination}
+    config['main'].update(options)
+    config['remote'] = {'username': USERNAME, 'password': PASSWORD, 'port': str(port), 'server_ip_address': '127.0.0.1',
+                        'nb_connections': options.get('nb_connections', '4'), 'server_side_delete': 'NO'}
+    if mode == 'SFTP_DELTA':
+        config['remote']['delta_threshold'] = str(DELTA_THRESHOLD)
+    config['email'] = {'email_recipients': 'benchmark@localhost', 'title': 'Benchmark', 'smtp_server': '127.0.0.1',
+                       'email_port': str(smtp_port), 'use_tls': 'NO', 'sender_email': 'benchmark@localhost',
+                       'sender_login': USERNAME, 'sender_password': PASSWORD}
+    with open(path, 'w') as settings_file:
+        config.write(settings_file)
+
+
+def run_mode(mode, settings_path):
+    """
+    Save the tree once with a saving mode.
+    :param mode: One of MODES.
+    :param settings_path: Path of the settings file.
+    :return: Report of the run, see Infos.get_report().
+    """
+    if mode == 'APP':
+        # The application reads its settings and writes its logs relative to the working directory
+        report_path = os.path.abspath(REPORT_NAME)
+        app.run()
+        logging.getLogger().handlers.clear()
+        with open(report_path) as report_file:
+            return json.load(report_file)
+
+    infos = Infos()
+    infos.start_time = datetime.datetime.now()
+    settings = Settings(settings_path)
+    settings.read_parameters()
+    with infos.measure_phase("scan"):
+        scan_index = app.get_files_to_save(settings.paths_to_save, settings.exclusions)
+    settings.paths_to_save = scan_index.roots
+
+    with infos.measure_phase("save"):
+        if mode == 'LOCAL':
+            LocalSave(settings, infos, scan_index).save()
+        elif mode == 'DEDUP':
+            DedupSave(settings, infos, scan_index).save()
+        elif mode in ('FTP', 'FTPS'):
+            FtpFtpsSave(settings, infos, scan_index).connect_ftp()
+        else:
+            SftpSave(settings, infos, scan_index).connect_sftp()
+    infos.result = True
+    infos.end_time = datetime.datetime.now()
+    return infos.get_report()
+
+
+def start_server(mode, root):
+    """
+    :param mode: One of MODES.
+    :param root: Directory where the server stores files.
+    :return: Started server or None for local modes.
+    """
+    if mode in ('FTP', 'FTPS'):
+        server = FtpServer(root, tls=mode == 'FTPS')
+    elif mode in ('SFTP', 'SFTP_DELTA'):
+        server = SftpServer(root)
+    else:
+        return None
+    server.start()
+    return server
+
+
+def is_mode_available(mode):
+    if mode in ('FTP', 'FTPS'):
+        return FtpServer.is_available(tls=mode == 'FTPS')
+    if mode in ('SFTP', 'SFTP_DELTA'):
+        return SftpServer.is_available()
+    return True
+
+
+def run_benchmarks(modes, trees, scale, repeat, options):
+    """
+    :return: List of the results, one dict per mode and tree.
+    """
+    results = []
+    work_directory = tempfile.mkdtemp(prefix="backup_benchmark_")
+    current_directory = os.getcwd()
+    smtp_sink = SmtpSink()
+    smtp_sink.start()
+    try:
+        # Logs, journals and reports of the application are written in the working directory
+        os.chdir(work_directory)
+        os.makedirs(os.path.join("main", "settings"))
+        shutil.copy(os.path.join(REPOSITORY, "main", "settings", "logging.ini"), os.path.join("main", "settings"))
+
+        for tree in trees:
+            tree_path = os.path.join(work_directory, "trees", tree)
+            nb_files, nb_bytes = make_tree(tree, tree_path, scale)
+            print("Tree {}: {} files, {} bytes".format(tree, nb_files, nb_bytes))
+
+            for mode in modes:
+                if not is_mode_available(mode):
+                    print("  {}: skipped, its server library is not installed".format(mode))
+                    continue
+
+                root = os.path.join(work_directory, "server")
+                os.makedirs(root)
+                server = start_server(mode, root)
+                try:
+                    best = None
+                    for i in range(repeat):
+                        destination = "/run_" + str(i)
+                        if server is None:
+                            destination = root + destination
+                            os.makedirs(destination)
+                        else:
+                            os.makedirs(root + destination)
+                        write_settings(os.path.join("main", "settings", "settings.ini"), mode, tree_path,
+                                       destination, server.port if server else None, smtp_sink.port, options)
+                        if mode == 'SFTP_DELTA':
+                            # First backup, the measured one sends only the blocks that differ from it
+                            run_mode(mode, os.path.join("main", "settings", "settings.ini"))
+
+                        start = time.monotonic()
+                        report = run_mode(mode, os.path.join("main", "settings", "settings.ini"))
+                        seconds = time.monotonic() - start
+                        if not report['result']:
+                            raise RuntimeError(mode + " failed: " + str(report['fail_reason']))
+                        if best is None or seconds < best['seconds']:
+                            best = {'mode': mode, 'tree': tree, 'seconds': seconds, 'nb_files': nb_files,
+                                    'nb_bytes': nb_bytes, 'files_per_second': nb_files / seconds,
+                                    'mb_per_second': nb_bytes / 1000000 / seconds, 'phases': report['phases']}
+                finally:
+                    if server is not None:
+                        server.stop()
+                    shutil.rmtree(root)
+
+                print("  {}: {:.2f}s, {:.1f} files/s, {:.2f} MB/s".format(mode, best['seconds'],
+                                                                         best['files_per_second'],
+                                                                         best['mb_per_second']))
+                results.append(best)
+            shutil.rmtree(tree_path)
+    finally:
+        os.chdir(current_directory)
+        smtp_sink.stop()
+        shutil.rmtree(work_directory, ignore_errors=True)
+    print("Mails received by the SMTP sink: {} ({} bytes)".format(smtp_sink.nb_messages, smtp_sink.nb_bytes))
+    return results
+
+
+def get_commit():
+    """
+    :return: Short hash of the current commit, with -dirty if there are uncommitted changes.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPOSITORY, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPOSITORY,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + "-dirty" if status else commit
+
+
+def save_results(results, scale, repeat):
+    """
+    :return: Path of the results file.
+    """
+    os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+    commit = get_commit()
+    path = os.path.join(RESULTS_DIRECTORY, commit + ".json")
+    with open(path, 'w') as results_file:
+        json.dump({'commit': commit, 'date': datetime.datetime.now().isoformat(), 'python': sys.version.split()[0],
+                   'machine': platform.platform(), 'scale': scale, 'repeat': repeat, 'results': results},
+                  results_file, indent=2)
+    return path
+
+
+def compare(old_commit, new_commit):
+    """
+    Print the speed of each benchmark in two results files.
+    """
+    runs = []
+    for commit in (old_commit, new_commit):
+        with open(os.path.join(RESULTS_DIRECTORY, commit + ".json")) as results_file:
+            runs.append({(result['mode'], result['tree']): result for result in json.load(results_file)['results']})
+
+    print("{:<6} {:<5} {:>10} {:>10} {:>8}".format("mode", "tree", old_commit[:10], new_commit[:10], "change"))
+    for key in sorted(runs[0].keys() & runs[1].keys()):
+        old_seconds = runs[0][key]['seconds']
+        new_seconds = runs[1][key]['seconds']
+        print("{:<6} {:<5} {:>9.2f}s {:>9.2f}s {:>+7.1f}%".format(key[0], key[1], old_seconds, new_seconds,
+                                                                (new_seconds - old_seconds) / old_seconds * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the saving modes.")
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--trees', nargs='+', choices=TREES, default=TREES)
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplier of the number and size of the files")
+    parser.add_argument('--repeat', type=int, default=1, help="runs of each benchmark, the fastest is kept")
+    parser.add_argument('--option', nargs=2, action='append', default=[], metavar=('NAME', 'VALUE'),
+                        help="settings.ini option, e.g. --option nb_connections 8")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two results files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = run_benchmarks(args.modes, args.trees, args.scale, args.repeat, dict(args.option))
+    print("Results written in " + save_results(results, args.scale, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
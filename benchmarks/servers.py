@@ -0,0 +1,316 @@
+import logging
+import os
+import socket
+import socketserver
+import subprocess
+import threading
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    FTPHandler = None
+
+try:
+    from pyftpdlib.handlers import TLS_FTPHandler
+except ImportError:
+    TLS_FTPHandler = None
+
+# Credentials accepted by all the stand-in servers.
+USERNAME = "benchmark"
+PASSWORD = "benchmark"
+
+
+class FtpServer:
+    """
+    FTP or FTPS server running in a thread of this process, files are stored in a local directory.
+    Needs pyftpdlib, and pyOpenSSL and the openssl command for FTPS.
+    """
+
+    def __init__(self, root, tls=False):
+        """
+        Constructor.
+        :param root: Local directory served as /.
+        :param tls: True for FTPS.
+        """
+        self.root = root
+        self.tls = tls
+        self.server = None
+        self.thread = None
+        self.port = None
+
+    @staticmethod
+    def is_available(tls=False):
+        if tls:
+            return TLS_FTPHandler is not None and subprocess.run(['which', 'openssl'],
+                                                                 capture_output=True).returncode == 0
+        return FTPHandler is not None
+
+    def start(self):
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(USERNAME, PASSWORD, self.root, perm='elradfmwMT')
+
+        if self.tls:
+            certificate = os.path.join(os.path.dirname(self.root), "ftps_certificate.pem")
+            subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                            '-subj', '/CN=localhost', '-keyout', certificate, '-out', certificate],
+                           check=True, capture_output=True)
+            handler = type('BenchmarkTlsHandler', (TLS_FTPHandler,), {'certfile': certificate})
+        else:
+            handler = type('BenchmarkHandler', (FTPHandler,), {})
+        handler.authorizer = authorizer
+
+        # pyftpdlib logs each command
+        logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        self.port = self.server.address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.close_all()
+        self.thread.join()
+
+
+class SftpServer:
+    """
+    SFTP server running in threads of this process, files are stored in a local directory.
+    Only the SFTP subsystem is accepted, so "rm -rf" commands are refused. Needs paramiko.
+    """
+
+    def __init__(self, root):
+        """
+        Constructor.
+        :param root: Local directory served as /.
+        """
+        self.root = root
+        self.socket = None
+        self.thread = None
+        self.transports = []
+        self.port = None
+        self.host_key = None
+
+    @staticmethod
+    def is_available():
+        return paramiko is not None
+
+    def start(self):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(16)
+        self.port = self.socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.accept_connections, daemon=True)
+        self.thread.start()
+
+    def accept_connections(self):
+        while True:
+            try:
+                client, address = self.socket.accept()
+            except OSError:
+                # Socket closed by stop()
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, StubSftpServer, self.root)
+            transport.start_server(server=StubServer())
+            self.transports.append(transport)
+
+    def stop(self):
+        # close() alone does not wake up the thread blocked in accept()
+        self.socket.shutdown(socket.SHUT_RDWR)
+        self.socket.close()
+        self.thread.join()
+        for transport in self.transports:
+            transport.close()
+
+
+if paramiko is not None:
+    class StubServer(paramiko.ServerInterface):
+        """
+        Accepts the benchmark user and session channels.
+        """
+
+        def check_auth_password(self, username, password):
+            if username == USERNAME and password == PASSWORD:
+                return paramiko.AUTH_SUCCESSFUL
+            return paramiko.AUTH_FAILED
+
+        def get_allowed_auths(self, username):
+            return 'password'
+
+        def check_channel_request(self, kind, chanid):
+            if kind == 'session':
+                return paramiko.OPEN_SUCCEEDED
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    class StubSftpHandle(paramiko.SFTPHandle):
+        def stat(self):
+            try:
+                return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        def chattr(self, attr):
+            try:
+                paramiko.SFTPServer.set_file_attr(self.filename, attr)
+                return paramiko.SFTP_OK
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+    class StubSftpServer(paramiko.SFTPServerInterface):
+        """
+        SFTP operations done on a local directory.
+        """
+
+        def __init__(self, server, root, *args, **kwargs):
+            super().__init__(server, *args, **kwargs)
+            self.root = root
+
+        def get_real_path(self, path):
+            return self.root + self.canonicalize(path)
+
+        def list_folder(self, path):
+            path = self.get_real_path(path)
+            try:
+                entries = []
+                for name in os.listdir(path):
+                    attributes = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                    attributes.filename = name
+                    entries.append(attributes)
+                return entries
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        def stat(self, path):
+            try:
+                return paramiko.SFTPAttributes.from_stat(os.stat(self.get_real_path(path)))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        def lstat(self, path):
+            try:
+                return paramiko.SFTPAttributes.from_stat(os.lstat(self.get_real_path(path)))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        def open(self, path, flags, attr):
+            path = self.get_real_path(path)
+            try:
+                mode = getattr(attr, 'st_mode', None)
+                fd = os.open(path, flags, mode if mode is not None else 0o666)
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+            if flags & os.O_WRONLY:
+                file_mode = 'ab' if flags & os.O_APPEND else 'wb'
+            elif flags & os.O_RDWR:
+                file_mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+            else:
+                file_mode = 'rb'
+            handle = StubSftpHandle(flags)
+            handle.filename = path
+            handle.readfile = handle.writefile = os.fdopen(fd, file_mode)
+            return handle
+
+        def remove(self, path):
+            try:
+                os.remove(self.get_real_path(path))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+        def rename(self, oldpath, newpath):
+            try:
+                os.rename(self.get_real_path(oldpath), self.get_real_path(newpath))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+        def mkdir(self, path, attr):
+            try:
+                os.mkdir(self.get_real_path(path))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+        def rmdir(self, path):
+            try:
+                os.rmdir(self.get_real_path(path))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+        def chattr(self, path, attr):
+            try:
+                paramiko.SFTPServer.set_file_attr(self.get_real_path(path), attr)
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+
+class SmtpSink:
+    """
+    SMTP server that accepts any authentication and any message, and only counts them.
+    STARTTLS is not supported, MailSender must be used with use_tls = NO.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.thread = None
+        self.port = None
+        self.nb_messages = 0
+        self.nb_bytes = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.wfile.write(b"220 benchmark ESMTP\r\n")
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line[:4].upper()
+                    if command == b"EHLO":
+                        self.wfile.write(b"250-benchmark\r\n250-8BITMIME\r\n250 AUTH PLAIN LOGIN\r\n")
+                    elif command == b"AUTH":
+                        self.wfile.write(b"235 Authentication successful\r\n")
+                    elif command == b"DATA":
+                        self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                        nb_bytes = 0
+                        for data_line in self.rfile:
+                            if data_line == b".\r\n":
+                                break
+                            nb_bytes += len(data_line)
+                        with sink.lock:
+                            sink.nb_messages += 1
+                            sink.nb_bytes += nb_bytes
+                        self.wfile.write(b"250 OK\r\n")
+                    elif command == b"QUIT":
+                        self.wfile.write(b"221 Bye\r\n")
+                        return
+                    elif command in (b"HELO", b"MAIL", b"RCPT", b"RSET", b"NOOP"):
+                        self.wfile.write(b"250 OK\r\n")
+                    else:
+                        self.wfile.write(b"502 Command not implemented\r\n")
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
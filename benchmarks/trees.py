@@ -0,0 +1,74 @@
+import os
+
+# Synthetic trees, the sizes are multiplied by the scale given on the command line.
+# tiny: many small files in a few directories.
+# huge: a few big files.
+# deep: a long chain of directories with some files at each level.
+TREES = ['tiny', 'huge', 'deep']
+
+
+def make_tree(name, path, scale=1.0):
+    """
+    Create a synthetic tree to save.
+    :param name: Kind of tree, one of TREES.
+    :param path: Directory created with the tree in it.
+    :param scale: Multiplier of the number and size of the files.
+    :return: Tuple (number of files, number of bytes).
+    """
+    os.makedirs(path)
+    if name == 'tiny':
+        return make_tiny_tree(path, scale)
+    if name == 'huge':
+        return make_huge_tree(path, scale)
+    if name == 'deep':
+        return make_deep_tree(path, scale)
+    raise ValueError("Unknown tree: " + name)
+
+
+def write_file(path, size):
+    """
+    Write a file of random bytes, so compression does not make transfers look faster than they are.
+    :param path: Path of the new file.
+    :param size: Number of bytes.
+    """
+    with open(path, 'wb') as file:
+        while size > 0:
+            block = os.urandom(min(size, 1024 * 1024))
+            file.write(block)
+            size -= len(block)
+
+
+def make_tiny_tree(path, scale):
+    nb_files = max(1, int(2000 * scale))
+    nb_bytes = 0
+    for i in range(nb_files):
+        directory = os.path.join(path, "directory_" + str(i % 20))
+        os.makedirs(directory, exist_ok=True)
+        size = 512 + (i * 37) % 4096
+        write_file(os.path.join(directory, "file_" + str(i)), size)
+        nb_bytes += size
+    return nb_files, nb_bytes
+
+
+def make_huge_tree(path, scale):
+    nb_files = 4
+    size = max(1024 * 1024, int(64 * 1024 * 1024 * scale))
+    for i in range(nb_files):
+        write_file(os.path.join(path, "huge_" + str(i)), size)
+    return nb_files, nb_files * size
+
+
+def make_deep_tree(path, scale):
+    depth = max(1, int(40 * scale))
+    nb_files = 0
+    nb_bytes = 0
+    directory = path
+    for level in range(depth):
+        directory = os.path.join(directory, "level_" + str(level))
+        os.makedirs(directory)
+        for i in range(5):
+            size = 16 * 1024 * (i + 1)
+            write_file(os.path.join(directory, "file_" + str(i)), size)
+            nb_files += 1
+            nb_bytes += size
+    return nb_files, nb_bytes
@@ -1,8 +1,24 @@
-from main import app
+import argparse
+
+from main import app, daemon
 
 
 def main():
-    app.run()
+    parser = argparse.ArgumentParser(description="Backup the files listed in main/settings/settings.ini.")
+    parser.add_argument('--profile', action='store_true',
+                        help="profile each phase with cProfile and tracemalloc, results are written next to the logs")
+    parser.add_argument('--daemon', nargs='?', const='main/settings/daemon.ini', metavar='SETTINGS',
+                        help="run the backups of the profiles listed in the daemon settings file at their interval, "
+                             "until interrupted (default: %(const)s)")
+    parser.add_argument('--restore', nargs=2, metavar=('INDEX', 'DIRECTORY'),
+                        help="restore the DEDUP backup of the index file INDEX in DIRECTORY")
+    args = parser.parse_args()
+    if args.daemon:
+        daemon.run_daemon(args.daemon)
+    elif args.restore:
+        app.run_restore(*args.restore)
+    else:
+        app.run(profile=args.profile)
 
 
 if __name__ == '__main__':
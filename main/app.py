@@ -1,9 +1,8 @@
 #!/usr/bin/env python
 import logging.config
-import os
 from datetime import datetime
-from os import path
 
+from main.saving_modes.dedup_saving import DedupSave, restore_backup
 from main.saving_modes.ftp_ftps_saving import FtpFtpsSave
 from main.saving_modes.local_saving import LocalSave
 from main.saving_modes.rsync_saving import RSyncSave
@@ -11,33 +10,83 @@ from main.saving_modes.sftp_saving import SftpSave
 from main.utils.MailSender import MailSender
 from main.utils.custom_exceptions import ApplicationError
 from main.utils.infos import Infos
+from main.utils.profiler import Profiler
+from main.utils.queue_logging import QueueLogging, set_file_events_verbosity
+from main.utils.scan_index import ScanIndex
 from main.utils.settings import Settings
 
+# Configuration files read by run.
+LOGGING_PATH = 'main/settings/logging.ini'
+SETTINGS_PATH = 'main/settings/settings.ini'
 
-def run():
+
+def run(profile=False):
     """
     Main function of the app.
     First reads the settings, then get all the files to save and finally save them with the chosen method in settings.
+    :param profile: True to profile each phase, profiles are written next to the log files.
     """
+    # Initialize logging, the loggers created at import (file_events) stay enabled
+    logging.config.fileConfig(LOGGING_PATH, disable_existing_loggers=False)
+    logging.info("Application started")
 
     # Create object containing infos during save
     infos = Infos()
-    settings = None
+    if profile:
+        infos.profiler = Profiler()
+    run_backup(SETTINGS_PATH, infos)
+
+    logging.info("Application terminated")
+
+
+def run_restore(index_path, target_directory):
+    """
+    Restore a DEDUP backup, its files are stored as chunks that only this application can put back together.
+    :param index_path: Path of the index of the backup in the directory to save in.
+    :param target_directory: Directory where the files are restored.
+    """
+    logging.config.fileConfig(LOGGING_PATH, disable_existing_loggers=False)
     try:
-        # Initialize logging
-        logging.config.fileConfig('main/settings/logging.ini')
-        logging.info("Application started")
+        restore_backup(index_path, target_directory)
+    except ApplicationError as e:
+        logging.critical("Restore failed: " + e.message)
+
 
+def run_backup(settings_path, infos, connection_pool=None, log_filter=None):
+    """
+    Run one backup: read the settings, scan, save, send the mail and write the report.
+    Used once by run, or for each scheduled backup of a profile by the daemon.
+    :param settings_path: Path of the settings file.
+    :param infos: New Infos of this backup, its script_path is the directory of the log files.
+    :param connection_pool: ConnectionPool of the daemon, connections are closed at the end if None.
+    :param log_filter: ProfileFilter of the log files of the profile in the daemon, None to configure the logging of
+    the whole application.
+    """
+    infos.start_time = datetime.now()
+    settings = None
+    queue_logging = None
+    try:
         # Read settings file
-        settings = Settings("main/settings/settings.ini")
-        settings.read_parameters()
+        with infos.measure_phase("settings"):
+            settings = Settings(settings_path)
+            settings.read_parameters()
+        if log_filter is not None:
+            # Several profiles log at the same time in the daemon, the handlers are shared
+            log_filter.file_events = settings.file_events
+        else:
+            set_file_events_verbosity(settings.file_events)
+            if settings.log_queue == "YES":
+                queue_logging = QueueLogging()
+                queue_logging.start()
 
         # Verify files to save
-        settings.paths_to_save = get_files_to_save(settings.paths_to_save)
+        with infos.measure_phase("scan"):
+            scan_index = get_files_to_save(settings.paths_to_save, settings.exclusions)
+        settings.paths_to_save = scan_index.roots
 
         # Save
-        infos.start_time = datetime.now()
-        switch_mode(settings, infos)
+        with infos.measure_phase("save"):
+            switch_mode(settings, infos, scan_index, connection_pool)
         logging.info("save successfully terminated")
         infos.result = True
 
@@ -48,106 +97,118 @@ def run():
     except Exception as e:
         infos.result = False
         logging.exception("UNSUCCESSFULLY terminated because: ")
+    infos.end_time = datetime.now()
 
-    mail_sender = MailSender(settings, infos)
-    mail_sender.send_mail()
+    # Log files must be complete before they are attached to the mail
+    if queue_logging:
+        queue_logging.stop()
 
-    logging.info("Application terminated")
+    with infos.measure_phase("mail"):
+        mail_sender = MailSender(settings, infos)
+        mail_sender.send_mail()
 
+    # Metrics of the run, to compare the runs with each other
+    try:
+        infos.write_report()
+        if infos.profiler:
+            infos.profiler.write(infos.script_path)
+    except OSError as e:
+        logging.warning("Report can't be written: " + str(e))
 
-def switch_mode(settings, infos):
+
+def switch_mode(settings, infos, scan_index, connection_pool=None):
     """
     Choose the saving mode
     :param infos:
     :param settings:
+    :param scan_index: Files and directories to save.
+    :param connection_pool: ConnectionPool of the daemon or None.
     :return:
     """
     if settings.save_mode == 'FTP' or settings.save_mode == 'FTPS':
-        save_with_ftp(settings, infos)
+        save_with_ftp(settings, infos, scan_index, connection_pool)
     elif settings.save_mode == 'SFTP':
-        save_with_sftp(settings, infos)
+        save_with_sftp(settings, infos, scan_index, connection_pool)
     elif settings.save_mode == 'RSYNC':
-        save_with_rsync(settings, infos)
+        save_with_rsync(settings, infos, scan_index)
     elif settings.save_mode == 'LOCAL':
-        save_local(settings, infos)
+        save_local(settings, infos, scan_index)
+    elif settings.save_mode == 'DEDUP':
+        save_dedup(settings, infos, scan_index)
     else:
         logging.critical("Save method is not valid, please verify your settings.ini")
         raise ApplicationError
 
 
-def get_files_to_save(paths_to_save):
+def get_files_to_save(paths_to_save, exclusions=()):
     """
-    For each file or path to save, verify their existence.
+    For each file or path to save, verify their existence and scan them once.
     :param paths_to_save: List of strings that contains paths or files.
-    :return: List of string that contains all the paths of files.
+    :param exclusions: Patterns of the files and directories not to save.
+    :return: ScanIndex that contains the verified paths and all the files and directories in them.
     """
     logging.info("Scanning files...")
 
-    # Will contain verified paths/files
-    paths_to_save_ok = []
-
-    # All the files with their path e.g. : /etc/test.txt or test.txt
-    list_files_to_save = list()
-
-    # Verify if files or paths exist
-    for path_or_file in paths_to_save:
-        if path.exists(path_or_file):
-            if path.isfile(path_or_file):
-                logging.info("File: " + path_or_file + " exists")
-                paths_to_save_ok.append(path_or_file)
-            else:
-                logging.info("Directory: " + path_or_file + " exists")
-                paths_to_save_ok.append(path_or_file)
-        else:
-            logging.error("File or directory NOT FOUND: " + path_or_file)
-
-    # Get all the path of files recursively in paths to save
-    for path_to_save in paths_to_save_ok:
-        logging.info("Analysing: " + path_to_save)
-        # Get the list of all files in directory tree at given path
-        for (dirpath, dirnames, filenames) in os.walk(path_to_save):
-            complete_path = [os.path.join(dirpath, file) for file in filenames]
-            list_files_to_save += complete_path
+    scan_index = ScanIndex(exclusions)
+    scan_index.scan(paths_to_save)
 
-    logging.info("Analyse terminated " + str(len(list_files_to_save)) + " files analysed")
-    return paths_to_save_ok
+    logging.info("Analyse terminated " + str(scan_index.nb_files) + " files analysed (" +
+                 str(scan_index.total_size) + " bytes)")
+    return scan_index
 
 
-def save_with_ftp(settings, infos):
+def save_with_ftp(settings, infos, scan_index, connection_pool=None):
     """
     Calls the FTP or FTPS saving mode.
     :param infos:
     :param settings: Settings object.
+    :param scan_index: Files and directories to save.
+    :param connection_pool: ConnectionPool of the daemon or None.
     """
-    ftp_connection = FtpFtpsSave(settings, infos)
+    ftp_connection = FtpFtpsSave(settings, infos, scan_index, connection_pool)
     ftp_connection.connect_ftp()
 
 
-def save_with_sftp(settings, infos):
+def save_with_sftp(settings, infos, scan_index, connection_pool=None):
     """
     Calls the SFTP saving mode.
     :param infos:
     :param settings: Settings object.
+    :param scan_index: Files and directories to save.
+    :param connection_pool: ConnectionPool of the daemon or None.
     """
-    sftp_connection = SftpSave(settings, infos)
+    sftp_connection = SftpSave(settings, infos, scan_index, connection_pool)
     sftp_connection.connect_sftp()
 
 
-def save_with_rsync(settings, infos):
+def save_with_rsync(settings, infos, scan_index):
     """
     Calls the rsync saving mode.
     :param infos:
     :param settings: Settings object.
+    :param scan_index: Files and directories to save.
     """
-    rsync_connection = RSyncSave(settings, infos)
+    rsync_connection = RSyncSave(settings, infos, scan_index)
     rsync_connection.connect_rsync()
 
 
-def save_local(settings, infos):
+def save_local(settings, infos, scan_index):
     """
     Calls the local saving mode.
     :param infos:
     :param settings: Settings object.
+    :param scan_index: Files and directories to save.
     """
-    local = LocalSave(settings, infos)
+    local = LocalSave(settings, infos, scan_index)
     local.save()
+
+
+def save_dedup(settings, infos, scan_index):
+    """
+    Calls the deduplicated local saving mode.
+    :param infos:
+    :param settings: Settings object.
+    :param scan_index: Files and directories to save.
+    """
+    dedup = DedupSave(settings, infos, scan_index)
+    dedup.save()
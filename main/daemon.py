@@ -0,0 +1,172 @@
+import configparser
+import logging
+import logging.config
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from main import app
+from main.utils.connection_pool import ConnectionPool
+from main.utils.custom_exceptions import ApplicationError
+from main.utils.infos import Infos
+from main.utils.profile_logging import ProfileFilter, current_profile, get_file_handlers
+from main.utils.queue_logging import file_events
+
+# Seconds between two checks of the schedule.
+SCHEDULER_PERIOD = 1
+
+
+class Profile:
+    """
+    One backup scheduled by the daemon: a settings file and the time between two backups.
+    """
+
+    def __init__(self, name, settings_path, interval):
+        """
+        Constructor.
+        :param name: Name of the profile, also the name of the directory of its log files.
+        :param settings_path: Path of its settings file, same format as settings.ini.
+        :param interval: Seconds between the start of two backups.
+        """
+        self.name = name
+        self.settings_path = settings_path
+        self.interval = interval
+        self.next_run = time.monotonic()  # The first backup starts when the daemon starts
+        self.running = False
+
+
+class Daemon:
+    """
+    Run the backups of several profiles in one long-running process. The settings of each backup are read again when
+    it starts, so they can be changed without restarting the daemon. Connections to the servers are kept open between
+    the backups, each profile has its own log files, report and mail.
+    """
+
+    def __init__(self, path_to_daemon_settings):
+        self.file_name = path_to_daemon_settings
+        self.max_jobs = 1
+        self.log_directory = "logs"
+        self.profiles = []
+        self.connection_pool = None
+        self.stopping = threading.Event()
+
+    def read_parameters(self):
+        """
+        Parse the daemon settings file: the [daemon] section and one [profile <name>] section for each profile.
+        """
+        config = configparser.ConfigParser()
+        if not os.path.exists(self.file_name):
+            raise ApplicationError("Daemon setting file not found")
+        config.read(self.file_name)
+
+        try:
+            self.max_jobs = int(config.get('daemon', 'max_jobs', fallback='1'))
+            self.log_directory = config.get('daemon', 'log_directory', fallback='logs')
+            max_idle_time = int(config.get('daemon', 'max_idle_time', fallback='300'))
+            if self.max_jobs < 1:
+                raise ApplicationError("Number of jobs must be at least 1, please verify your daemon settings")
+
+            for section in config.sections():
+                if not section.startswith('profile '):
+                    continue
+                name = section[len('profile '):].strip()
+                interval = int(config.get(section, 'interval'))
+                if not name or os.sep in name or interval < 1:
+                    raise ApplicationError("Profile [" + section + "] is not valid, please verify your daemon settings")
+                self.profiles.append(Profile(name, config.get(section, 'settings'), interval))
+        except (configparser.Error, ValueError) as e:
+            raise ApplicationError("Daemon settings are not valid: " + str(e))
+
+        if not self.profiles:
+            raise ApplicationError("No profile in " + self.file_name)
+        self.connection_pool = ConnectionPool(max_idle_time)
+
+    def run(self):
+        """
+        Start the backups when they are due, at most max_jobs at the same time, until stop is called or the process
+        is interrupted. A profile is never run twice at the same time: if a backup lasts longer than the interval, the
+        next one starts when it is done.
+        """
+        logging.info("Daemon started with " + str(len(self.profiles)) + " profile(s), " + str(self.max_jobs) +
+                     " backup(s) at the same time")
+        executor = ThreadPoolExecutor(max_workers=self.max_jobs, thread_name_prefix="profile")
+        futures = []  # Backups submitted and not finished
+        try:
+            while not self.stopping.wait(SCHEDULER_PERIOD):
+                now = time.monotonic()
+                for profile in self.profiles:
+                    if not profile.running and now >= profile.next_run:
+                        profile.running = True
+                        profile.next_run = now + profile.interval
+                        futures.append(executor.submit(self.run_profile, profile))
+                futures = [future for future in futures if not future.done()]
+                self.connection_pool.close_expired()
+        except KeyboardInterrupt:
+            pass
+        logging.info("Daemon stopping, waiting for the running backups")
+        # Backups waiting for a free job are not started (shutdown has no cancel_futures before python 3.9)
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        self.connection_pool.close_expired(0)
+        logging.info("Daemon terminated")
+
+    def stop(self):
+        """
+        Stop scheduling backups, the running ones are finished. Can be called from another thread.
+        """
+        self.stopping.set()
+
+    def run_profile(self, profile):
+        """
+        Run one backup of a profile, with its own log files and Infos in <log_directory>/<profile name>.
+        :param profile: Profile to run.
+        """
+        directory = os.path.abspath(os.path.join(self.log_directory, profile.name))
+        log_filter = ProfileFilter(profile.name)
+        handlers = []
+        token = current_profile.set(profile.name)
+        root = logging.getLogger()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            handlers = get_file_handlers(app.LOGGING_PATH, directory)
+            for handler in handlers:
+                handler.addFilter(log_filter)
+                root.addHandler(handler)
+
+            logging.info("Backup of profile " + profile.name + " started")
+            infos = Infos()
+            infos.script_path = directory
+            app.run_backup(profile.settings_path, infos, self.connection_pool, log_filter)
+            logging.info("Backup of profile " + profile.name + " terminated")
+        except Exception:
+            logging.exception("Backup of profile " + profile.name + " failed: ")
+        finally:
+            for handler in handlers:
+                root.removeHandler(handler)
+                handler.close()
+            current_profile.reset(token)
+            profile.running = False
+
+
+def run_daemon(path_to_daemon_settings):
+    """
+    Entry point of the daemon mode, runs until it is interrupted.
+    :param path_to_daemon_settings: Path of the daemon settings file, e.g. main/settings/daemon.ini.
+    """
+    logging.config.fileConfig(app.LOGGING_PATH, disable_existing_loggers=False)
+    # The log files of the daemon only contain the scheduling, the backups log in the files of their profile
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.FileHandler):
+            handler.addFilter(ProfileFilter(None))
+    # The verbosity of the events of each file is set by the log filter of each profile
+    file_events.setLevel(logging.INFO)
+
+    daemon = Daemon(path_to_daemon_settings)
+    try:
+        daemon.read_parameters()
+    except ApplicationError as e:
+        logging.critical("Daemon cannot start: " + e.message)
+        return
+    daemon.run()
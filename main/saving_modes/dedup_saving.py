@@ -0,0 +1,301 @@
+import hashlib
+import json
+import logging
+import os
+import stat
+import time
+
+from main.saving_modes.local_saving import LocalSave
+from main.utils.custom_exceptions import ApplicationError
+from main.utils.pipeline import run_pipeline
+
+try:
+    from fastcdc import fastcdc
+except ImportError:
+    fastcdc = None
+
+# Directory of the chunk store, in the directory to save in.
+CHUNKS_DIRECTORY = ".chunks"
+
+# File that contains the number of backups that use each chunk.
+REFERENCES_FILE = "references.json"
+
+# Sizes of chunks, a chunk ends when the rolling hash matches the mask (about every CHUNK_AVERAGE_SIZE bytes).
+# The mask uses the high bits of the hash, they depend on the last 64 bytes read.
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_AVERAGE_SIZE = 1024 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_MASK = (CHUNK_AVERAGE_SIZE - 1) << (64 - CHUNK_AVERAGE_SIZE.bit_length() + 1)
+
+# Without the fastcdc module, larger files are split in chunks of fixed size: the rolling hash in python reads about
+# 5 MB/s. Blocks changed in place (database files, disk images) are still deduplicated, inserted bytes are not.
+CHUNK_FIXED_THRESHOLD = 16 * 1024 * 1024
+
+# Random value for each byte, used by the rolling hash. Derived from sha256 so it never changes between runs.
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+
+
+class DedupSave(LocalSave):
+    """
+    Class for DEDUP saving.
+    Files are split in chunks with content defined boundaries, each different chunk is stored once in the chunk store.
+    A backup is a small index file that lists the chunks of each file.
+    """
+
+    def __init__(self, settings, infos, scan_index):
+        """
+        Constructor.
+        :param settings: Object that contains the information about server, path to save, usernames...
+        :param infos: Object that contains the information about what happens.
+        :param scan_index: Files and directories to save.
+        """
+        super().__init__(settings, infos, scan_index)
+        self.chunks_directory = None  # Absolute path of the chunk store
+        self.references = {}  # hash of chunk -> number of backups that use it
+        self.index = None
+        self.nb_chunks_written = 0
+        self.nb_bytes_written = 0
+
+    def save_files(self):
+        """
+        Store all files in the chunk store and write the index of the new backup.
+        """
+        self.chunks_directory = os.path.join(self.destination, CHUNKS_DIRECTORY)
+        os.makedirs(self.chunks_directory, exist_ok=True)
+        self.references = self.read_references()
+
+        # Clean the directory first.
+        with self.infos.measure_phase("cleaning"):
+            indexes_in_path = self.cleaning()
+
+        # Get the index name
+        new_index_name = self.get_new_directory_name(indexes_in_path)
+        self.infos.new_directory_name = new_index_name
+        self.index = {'files': {}, 'directories': []}
+
+        # Store files and directories. Files are read in advance while the previous ones are split and stored, by a
+        # single thread so the index and the chunk store do not need locks.
+        files = []
+        for entry in self.scan_index.entries:
+            if entry.type == 'dir':
+                self.index['directories'].append(entry.relative_path)
+            else:
+                files.append(entry)
+        run_pipeline([None], files, lambda _, entry, local_file: self.store_file(entry, local_file),
+                     lambda entry: entry.path, self.settings.read_ahead)
+
+        # Count the references of its chunks, then publish the index. If the backup stops in between, chunks are
+        # counted once too many and are never deleted, but a chunk used by an index is never deleted.
+        for chunk_hash in self.get_chunks(self.index):
+            self.references[chunk_hash] = self.references.get(chunk_hash, 0) + 1
+        self.write_references()
+
+        temporary_name = os.path.join(self.chunks_directory, new_index_name + ".tmp")
+        with open(temporary_name, 'w') as index_file:
+            json.dump(self.index, index_file)
+        os.replace(temporary_name, os.path.join(self.destination, new_index_name))
+        logging.info("New backup index created: " + new_index_name)
+
+        logging.info("Deduplication terminated: " + str(self.infos.nb_bytes_copied) + " bytes saved, " +
+                     str(self.nb_bytes_written) + " bytes written in " + str(self.nb_chunks_written) + " new chunks")
+
+    def store_file(self, entry, local_file=None):
+        """
+        Split one file in chunks, store the new chunks and add the file in the index.
+        :param entry: Scan index entry of the file.
+        :param local_file: ReadAheadFile of the file read by the pipeline, the file is opened here if None.
+        """
+        try:
+            start = time.monotonic()
+            chunks = []
+            with local_file if local_file is not None else open(entry.path, 'rb') as file:
+                for data in split_chunks(file, entry.size):
+                    chunks.append(self.store_chunk(data))
+
+            self.index['files'][entry.relative_path] = {'size': entry.size, 'mtime': entry.mtime,
+                                                        'mode': entry.mode, 'chunks': chunks}
+            self.infos.add_file_copied(entry.size, entry.path, time.monotonic() - start)
+        except OSError:
+            logging.warning("Cannot copy: " + entry.path + " PERMISSION DENIED")
+
+    def store_chunk(self, data):
+        """
+        Write a chunk in the store if it is not already in it.
+        :param data: bytes of the chunk.
+        :return: hash of the chunk.
+        """
+        chunk_hash = hashlib.sha256(data).hexdigest()
+        chunk_path = get_chunk_path(self.chunks_directory, chunk_hash)
+        if not os.path.exists(chunk_path):
+            os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+            with open(chunk_path + ".tmp", 'wb') as chunk_file:
+                chunk_file.write(data)
+            os.replace(chunk_path + ".tmp", chunk_path)
+            self.nb_chunks_written += 1
+            self.nb_bytes_written += len(data)
+        return chunk_hash
+
+    def remove_directories(self, path):
+        """
+        Delete a backup index and the chunks that are not used by another backup anymore.
+        The index is deleted first and the references are written before the chunks are deleted: if the cleaning
+        stops in between, some chunks are kept for nothing, but no other backup loses a chunk.
+        :param path: The path of the index to delete.
+        """
+        with open(path) as index_file:
+            index = json.load(index_file)
+        os.remove(path)
+
+        unused_chunks = []
+        for chunk_hash in self.get_chunks(index):
+            self.references[chunk_hash] = self.references.get(chunk_hash, 1) - 1
+            if self.references[chunk_hash] <= 0:
+                del self.references[chunk_hash]
+                unused_chunks.append(chunk_hash)
+        self.write_references()
+
+        nb_chunks_deleted = 0
+        for chunk_hash in unused_chunks:
+            try:
+                os.remove(get_chunk_path(self.chunks_directory, chunk_hash))
+                nb_chunks_deleted += 1
+            except FileNotFoundError:
+                pass
+        logging.info(str(nb_chunks_deleted) + " chunks not used anymore deleted")
+
+    def get_directories_in_path(self, path):
+        """
+        :param path: String current path
+        :return: List of string that contains the backup indexes in path.
+        """
+        return [entry for entry in os.listdir(path=path) if entry != CHUNKS_DIRECTORY]
+
+    def get_chunks(self, index):
+        """
+        :param index: index of a backup.
+        :return: Set of the hashes of the chunks used by the backup.
+        """
+        return {chunk_hash for properties in index['files'].values() for chunk_hash in properties['chunks']}
+
+    def read_references(self):
+        """
+        :return: Dict hash of chunk -> number of backups that use it.
+        """
+        try:
+            with open(os.path.join(self.chunks_directory, REFERENCES_FILE)) as references_file:
+                return json.load(references_file)
+        except FileNotFoundError:
+            return {}
+
+    def write_references(self):
+        temporary_name = os.path.join(self.chunks_directory, REFERENCES_FILE + ".tmp")
+        with open(temporary_name, 'w') as references_file:
+            json.dump(self.references, references_file)
+        os.replace(temporary_name, os.path.join(self.chunks_directory, REFERENCES_FILE))
+
+
+def get_chunk_path(chunks_directory, chunk_hash):
+    """
+    :param chunks_directory: path of the chunk store.
+    :param chunk_hash: hash of the chunk.
+    :return: path of the chunk in the store, e.g. .chunks/ab/abcdef...
+    """
+    return os.path.join(chunks_directory, chunk_hash[:2], chunk_hash)
+
+
+def restore_backup(index_path, target_directory):
+    """
+    Rebuild the files of a DEDUP backup from its index and the chunk store next to it. The content of each chunk is
+    verified with its hash. Files with a missing or damaged chunk are not restored, they are logged in error.log.
+    :param index_path: Path of the index of the backup, e.g. directory_to_save_in/2020-05-01_12-00-00.
+    :param target_directory: Directory where the files are restored, created if needed.
+    :return: Tuple (number of files restored, number of files not restored).
+    """
+    try:
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError) as e:
+        raise ApplicationError("Cannot read the backup index " + index_path + ": " + str(e))
+    chunks_directory = os.path.join(os.path.dirname(os.path.abspath(index_path)), CHUNKS_DIRECTORY)
+
+    for relative_path in index['directories']:
+        os.makedirs(os.path.join(target_directory, relative_path), exist_ok=True)
+
+    nb_restored = 0
+    nb_failed = 0
+    for relative_path, properties in index['files'].items():
+        path = os.path.join(target_directory, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with open(path + ".tmp", 'wb') as file:
+                for chunk_hash in properties['chunks']:
+                    with open(get_chunk_path(chunks_directory, chunk_hash), 'rb') as chunk_file:
+                        data = chunk_file.read()
+                    if hashlib.sha256(data).hexdigest() != chunk_hash:
+                        raise OSError("chunk " + chunk_hash + " is damaged")
+                    file.write(data)
+            os.replace(path + ".tmp", path)
+            os.chmod(path, stat.S_IMODE(properties['mode']))
+            os.utime(path, (properties['mtime'], properties['mtime']))
+            nb_restored += 1
+        except OSError as e:
+            logging.error("Cannot restore: " + relative_path + " " + str(e))
+            nb_failed += 1
+            try:
+                os.remove(path + ".tmp")
+            except FileNotFoundError:
+                pass
+
+    logging.info("Backup " + index_path + " restored in " + target_directory + ": " + str(nb_restored) +
+                 " files restored, " + str(nb_failed) + " files not restored")
+    return nb_restored, nb_failed
+
+
+def split_chunks(file, size):
+    """
+    Split a file in chunks. Boundaries are found by the fastcdc module (written in C) if it is installed, else by
+    get_chunk_end for files up to CHUNK_FIXED_THRESHOLD and at fixed sizes for larger files.
+    :param file: Local file opened in binary mode, or ReadAheadFile.
+    :param size: Size of the file.
+    :return: Generator of the chunks as bytes.
+    """
+    if fastcdc is not None:
+        for chunk in fastcdc(file, CHUNK_MIN_SIZE, CHUNK_AVERAGE_SIZE, CHUNK_MAX_SIZE, fat=True):
+            yield chunk.data
+        return
+
+    if size > CHUNK_FIXED_THRESHOLD:
+        yield from iter(lambda: file.read(CHUNK_AVERAGE_SIZE), b'')
+        return
+
+    buffer = b''
+    while True:
+        data = file.read(CHUNK_MAX_SIZE)
+        buffer += data
+        # Keep at least one full chunk in the buffer unless the end of the file is reached
+        while len(buffer) >= CHUNK_MAX_SIZE or (not data and buffer):
+            end = get_chunk_end(buffer)
+            yield buffer[:end]
+            buffer = buffer[end:]
+        if not data:
+            return
+
+
+def get_chunk_end(data):
+    """
+    Find the end of the first chunk with a gear rolling hash, so boundaries move with the content.
+    Inserting bytes in a file only changes the chunks around the insertion.
+    :param data: bytes at the beginning of the chunk.
+    :return: Size of the first chunk.
+    """
+    if len(data) <= CHUNK_MIN_SIZE:
+        return len(data)
+
+    rolling_hash = 0
+    gear = GEAR
+    end = min(len(data), CHUNK_MAX_SIZE)
+    for position in range(CHUNK_MIN_SIZE, end):
+        rolling_hash = ((rolling_hash << 1) + gear[data[position]]) & 0xFFFFFFFFFFFFFFFF
+        if not rolling_hash & CHUNK_MASK:
+            return position + 1
+    return end
@@ -1,11 +1,22 @@
 import ftplib
+import hashlib
+import io
 import logging
-import os
+import posixpath
 import ssl
-from pathlib import Path
+import threading
+import time
 
+from main.utils.archive_stream import ARCHIVE_EXTENSIONS, ArchiveStream
+from main.utils.bundles import BUNDLE_INDEX_NAME, Bundle, get_bundle_index, make_bundles
+from main.utils.checkpoint import Checkpoint
+from main.utils.checksums import CHECKSUMS_NAME, HashingFile, find_checksum, get_checksums_content, is_sampled
 from main.utils.custom_exceptions import ApplicationError
-from main.utils.historisation import get_new_names_by_version, get_new_name_by_date
+from main.utils.historisation import get_new_name_by_version, get_new_name_by_date
+from main.utils.manifest import MANIFEST_NAME, Manifest, filter_unchanged_files, get_directories_to_keep
+from main.utils.pipeline import run_pipeline
+from main.utils.queue_logging import file_events
+from main.utils.workers import run_in_workers
 
 
 class FtpFtpsSave:
@@ -13,14 +24,29 @@ class FtpFtpsSave:
     Class for FTP or FTPS saving.
     """
 
-    def __init__(self, settings, infos):
+    def __init__(self, settings, infos, scan_index, connection_pool=None):
         """
         Constructor.
         :param settings: Object that contains the information about server, path to save, usernames...
         :param infos: Object that contains the information about what happens.
+        :param scan_index: Files and directories to save.
+        :param connection_pool: ConnectionPool of the daemon, connections are closed at the end if None.
         """
+        self.scan_index = scan_index
+        self.connection_pool = connection_pool
         self.ftp_connection = None
+        self.connections = []  # Main connection and other sessions opened to work concurrently
+        self.base_directory = None  # Absolute path of the directory to save in
+        self.listings = {}  # absolute path -> MLSD entries, each directory is listed once per run
+        self.files_to_send = []  # List of tuples (scan index entry, absolute path on server)
+        self.checkpoint = None  # Journal of the sent files
+        self.unreadable_paths = set()  # Local paths of the files that could not be read
+        self.verification = None  # Command used to verify the files: HASH, XSHA256, XCRC or RETR of a sample
+        self.hash_connections = set()  # Connections on which SHA-256 was chosen for the HASH command
+        self.verification_lock = threading.Lock()
         self.settings = settings
+        # Files sent by the kernel are not read by python, so they have no checksum to verify
+        self.zero_copy = settings.zero_copy == "YES" and settings.save_mode == "FTP" and settings.verify != "YES"
         self.server_ip_address = self.settings.server_ip_address
         self.infos = infos
 
@@ -28,168 +54,593 @@ class FtpFtpsSave:
         """
         Connect to the server with the right method.
         """
+        succeeded = False
         try:
-            if self.settings.save_mode == "FTPS":
-                logging.info("Connection to FTPS server at " + self.server_ip_address)
-                self.ftp_connection = CustomFtpTLS()
-                self.ftp_connection.connect(self.server_ip_address, int(self.settings.port), timeout=5)
-                self.ftp_connection.auth()
-                self.ftp_connection.login(user=self.settings.username, passwd=self.settings.password)
-                self.ftp_connection.prot_p()
-
-            else:
-                logging.info("Connection to FTP server at " + self.server_ip_address)
-                self.ftp_connection = ftplib.FTP()
-                self.ftp_connection.connect(self.server_ip_address, int(self.settings.port), timeout=5)
-                self.ftp_connection.login(user=self.settings.username, passwd=self.settings.password)
-
-            # This line avoids error when path names contain space or accent.
-            self.ftp_connection.encoding = 'utf-8'
+            self.ftp_connection = self.open_connection()
+            self.connections = [self.ftp_connection]
 
             logging.info(self.ftp_connection.getwelcome())
 
             # Go to the directory where files were be saved
             self.ftp_connection.cwd(self.settings.directory_to_save_in)
-            logging.info("Positioned in: " + self.ftp_connection.pwd())
+            self.base_directory = self.ftp_connection.pwd()
+            logging.info("Positioned in: " + self.base_directory)
 
             self.save_files()
-
-            self.ftp_connection.quit()
-            logging.info("Quiting from FTP server at " + self.server_ip_address)
+            succeeded = True
 
         except ftplib.all_errors as e:
             raise ApplicationError(str(e))
+        finally:
+            self.release_connections(succeeded)
+
+    def open_connection(self):
+        """
+        Open a new session logged in on the server.
+        :return: FTP or FTPS connection.
+        """
+        if self.connection_pool is not None:
+            ftp_connection = self.connection_pool.take(self.get_pool_key(), is_alive)
+            if ftp_connection is not None:
+                logging.info("Reusing connection to " + self.server_ip_address)
+                return ftp_connection
+
+        if self.settings.save_mode == "FTPS":
+            logging.info("Connection to FTPS server at " + self.server_ip_address)
+            ftp_connection = CustomFtpTLS()
+        else:
+            logging.info("Connection to FTP server at " + self.server_ip_address)
+            ftp_connection = ftplib.FTP()
+        try:
+            ftp_connection.connect(self.server_ip_address, int(self.settings.port), timeout=5)
+            if self.settings.save_mode == "FTPS":
+                ftp_connection.auth()
+            ftp_connection.login(user=self.settings.username, passwd=self.settings.password)
+            if self.settings.save_mode == "FTPS":
+                ftp_connection.prot_p()
+        except ftplib.all_errors:
+            # Not in the list of connections yet, so not closed at the end of the backup
+            ftp_connection.close()
+            raise
+
+        # This line avoids error when path names contain space or accent.
+        ftp_connection.encoding = 'utf-8'
+        if self.connection_pool is not None:
+            # Given back to the pool in this directory
+            ftp_connection.home_directory = ftp_connection.pwd()
+        return ftp_connection
+
+    def get_pool_key(self):
+        """
+        :return: Key of the connections to the same server with the same user in the pool.
+        """
+        return self.settings.save_mode, self.server_ip_address, int(self.settings.port), self.settings.username
+
+    def get_connections(self, nb_jobs):
+        """
+        Get the connections to use to do jobs concurrently. New sessions are opened if necessary.
+        :param nb_jobs: Number of jobs to do, no more connections than jobs are opened.
+        :return: List of connections, the first one is the main connection.
+        """
+        nb_connections = max(1, min(self.settings.nb_connections, nb_jobs))
+        while len(self.connections) < nb_connections:
+            self.connections.append(self.open_connection())
+        return self.connections[:nb_connections]
+
+    def release_connections(self, reusable):
+        """
+        Close all the connections at the end of the backup, or give them back to the pool of the daemon. After an
+        error the connections are closed: they can be in the middle of a transfer.
+        :param reusable: False if the backup failed.
+        """
+        if self.connection_pool is None or not reusable:
+            for connection in self.connections:
+                quit_connection(connection)
+            if self.connections:
+                logging.info("Quiting from FTP server at " + self.server_ip_address)
+            self.connections = []
+            return
+
+        for connection in self.connections:
+            try:
+                connection.cwd(connection.home_directory)
+            except ftplib.all_errors:
+                quit_connection(connection)
+                continue
+            self.connection_pool.give_back(self.get_pool_key(), connection, quit_connection)
+        self.connections = []
+        logging.info("Connections to " + self.server_ip_address + " kept open for the next backup")
 
     def save_files(self):
         """
         Copy all files on server.
+        If the previous backup was interrupted, it is resumed: files already sent are not sent again.
         """
 
-        # Clean the directory first.
-        self.cleaning()
+        # Journal of the sent files, an unfinished backup is resumed instead of starting a new one.
+        self.checkpoint = Checkpoint(self.settings)
+        resumed_directory = self.checkpoint.load() if self.settings.archive == "NO" else None
+
+        # Clean the directory first, remaining backups are sorted from oldest to newest.
+        with self.infos.measure_phase("cleaning"):
+            directories_in_path = self.cleaning(resumed_directory)
 
-        # Get the directory name
-        if self.settings.archiving_mode == "date":
-            new_directory_name = get_new_name_by_date()
+        # Read the manifest of the latest backup to send only new or changed files.
+        previous_manifest = None
+        if self.settings.incremental == "YES" and directories_in_path:
+            previous_manifest = self.read_manifest(directories_in_path[-1][0])
+
+        if resumed_directory is not None and self.is_directory(self.base_directory, resumed_directory):
+            logging.info("Resuming backup directory: " + resumed_directory)
+            new_directory_name = resumed_directory
+            self.checkpoint.resume()
         else:
-            # Change the names of older backups by doing a shift of index. (1->2, 2->3...)
-            directories_in_path = self.get_directories_in_path(self.ftp_connection.pwd())
-            directories_in_path.sort(key=lambda entry: entry[1]['modify'], reverse=False)
-            old_names = [entry[0] for entry in directories_in_path]
-            new_names = get_new_names_by_version(old_names)
-            new_directory_name = new_names[len(new_names) - 1]
-            for directory_index in range(0, len(new_names) - 1):
-                logging.info(
-                    "Renaming directory: " + old_names[directory_index] + " to: " + new_names[directory_index])
-                self.ftp_connection.rename(old_names[directory_index], new_names[directory_index])
-
-        # Create new directory to store files and go in.
+            # Get the directory name, older backups keep their name.
+            if self.settings.archiving_mode == "date":
+                new_directory_name = get_new_name_by_date()
+            else:
+                new_directory_name = get_new_name_by_version([entry[0] for entry in directories_in_path])
+
+            # In archive mode, the backup is one compressed file instead of a directory.
+            if self.settings.archive != "NO":
+                self.send_archive(new_directory_name + ARCHIVE_EXTENSIONS[self.settings.archive])
+                return
+
+            # Create new directory to store files, paths in it are absolute so the working directory never changes.
+            self.ftp_connection.mkd(posixpath.join(self.base_directory, new_directory_name))
+            logging.info("New backup directory created: " + new_directory_name)
+            self.checkpoint.start(new_directory_name)
         self.infos.new_directory_name = new_directory_name
-        self.ftp_connection.mkd(new_directory_name)
-        logging.info("New backup directory created: " + new_directory_name)
-        self.ftp_connection.cwd(new_directory_name)
-        logging.info("Positioned in: " + self.ftp_connection.pwd())
+        backup_path = posixpath.join(self.base_directory, new_directory_name)
 
-        # Save files recursively with the same structure and hierarchy.
-        for path in self.settings.paths_to_save:
+        try:
+            # Create the directories with the same structure and hierarchy, files are sent after.
+            self.files_to_send = []
+            directories = []
+            for entry in self.scan_index.entries:
+                if entry.type == 'dir':
+                    if entry.relative_path not in self.checkpoint.created_directories:
+                        directories.append(entry.relative_path)
+                else:
+                    self.files_to_send.append((entry, posixpath.join(backup_path, entry.relative_path)))
+            self.make_directories(backup_path, directories, resumed_directory == new_directory_name)
+            self.checkpoint.directories_created(directories)
+
+            manifest = None
+            if self.settings.incremental == "YES":
+                manifest = Manifest(new_directory_name)
+                directories_to_keep = get_directories_to_keep([entry[0] for entry in directories_in_path],
+                                                              self.settings.archiving_max)
+                self.files_to_send = filter_unchanged_files(self.files_to_send, backup_path, manifest,
+                                                            previous_manifest, directories_to_keep)
+
+            self.files_to_send, bundles, bundles_to_delete = self.checkpoint.filter_sent_files(self.files_to_send,
+                                                                                               backup_path)
+            for bundle_path in bundles_to_delete:
+                self.remove_file(bundle_path)
+
+            # Small files are sent in bundles to avoid the cost of one transfer per file.
+            new_bundles = []
+            if self.settings.bundle_threshold > 0:
+                self.files_to_send, new_bundles = make_bundles(self.files_to_send, backup_path,
+                                                               self.settings.bundle_threshold,
+                                                               self.checkpoint.get_next_bundle_number())
+
+            self.send_files_with_connections(new_bundles)
+
+            bundles += new_bundles
+            if bundles:
+                self.write_file(posixpath.join(backup_path, BUNDLE_INDEX_NAME), get_bundle_index(bundles))
+            if self.checkpoint.checksums:
+                self.write_file(posixpath.join(backup_path, CHECKSUMS_NAME),
+                                get_checksums_content(self.checkpoint.checksums))
+            if manifest is not None:
+                manifest.add_bundles(bundles)
+                manifest.add_checksums(self.checkpoint.checksums,
+                                       {entry.relative_path for entry in self.scan_index.entries
+                                        if entry.path in self.unreadable_paths})
+                self.write_manifest(manifest, backup_path)
+        finally:
+            self.checkpoint.close()
+
+        self.checkpoint.finish()
+
+    def send_archive(self, archive_name):
+        """
+        Send all the files in one compressed tar archive, produced while it is sent.
+        :param archive_name: Name of the archive on server.
+        """
+        self.infos.new_directory_name = archive_name
+        logging.info("Sending archive: " + archive_name)
 
-            if os.path.isfile(path):
-                file_name = Path(path).name
-                self.send_file(path, file_name)
+        start = time.monotonic()
+        with self.infos.measure_phase("transfer"), \
+                ArchiveStream(self.scan_index.entries, self.infos, self.settings.archive,
+                              self.settings.compression_level) as archive:
+            self.ftp_connection.storbinary('STOR ' + archive_name, archive, self.settings.buffer_size)
+        self.infos.transfer_time += time.monotonic() - start
 
-            elif os.path.isdir(path):
-                path_name = Path(path).name
-                try:
-                    self.ftp_connection.mkd(path_name)
-                    logging.info("New directory created: " + path_name)
+        logging.info("Archive sent: " + str(archive.nb_bytes_read) + " bytes for " + str(self.infos.nb_file_copied) +
+                     " files (" + str(self.infos.nb_bytes_copied) + " bytes)")
 
-                # ignore "directory already exists"
-                except ftplib.error_perm as e:
-                    raise ApplicationError(e.__traceback__)
+    def read_manifest(self, directory_name):
+        """
+        :param directory_name: Name of a backup directory.
+        :return: The manifest of the backup or None if it has no manifest.
+        """
+        buffer = io.BytesIO()
+        try:
+            self.ftp_connection.retrbinary('RETR ' + posixpath.join(directory_name, MANIFEST_NAME), buffer.write)
+        except ftplib.error_perm:
+            logging.info("No manifest in " + directory_name + ", all files will be sent")
+            return None
+        logging.info("Manifest of " + directory_name + " read")
+        return Manifest.from_bytes(buffer.getvalue())
+
+    def write_manifest(self, manifest, backup_path):
+        """
+        :param manifest: Manifest of the new backup.
+        :param backup_path: Absolute path of the new backup directory.
+        """
+        self.write_file(posixpath.join(backup_path, MANIFEST_NAME), manifest.to_bytes())
+        logging.info("Manifest written in " + backup_path)
 
-                self.ftp_connection.cwd(path_name)
-                self.send_files(path)
-                self.ftp_connection.cwd('..')
+    def write_file(self, path, data):
+        """
+        Write a small file on server.
+        :param path: Absolute path of the file.
+        :param data: Content as bytes.
+        """
+        self.ftp_connection.storbinary('STOR ' + path, io.BytesIO(data))
 
-    def cleaning(self):
+    def cleaning(self, in_progress_directory=None):
         """
         Save Rotation.
         Counts the number of backups in directory. If it is greater than limit, it delete old versions.
+        :param in_progress_directory: Name of an unfinished backup that will be resumed, it is not counted.
+        :return: List of the remaining backups, sorted from oldest to newest.
         """
-        entries = self.get_directories_in_path(self.ftp_connection.pwd())
+        current_directory = self.base_directory
+        entries = [entry for entry in self.get_directories_in_path(current_directory)
+                   if entry[0] != in_progress_directory]
+        # sort files by date from oldest to newest
+        entries.sort(key=lambda entry: entry[1]['modify'], reverse=False)
+
         if len(entries) >= int(self.settings.archiving_max):
             logging.info("Maximum backup (" + str(self.settings.archiving_max) + ") is reached: " + str(len(entries)))
 
-            while len(entries) >= int(self.settings.archiving_max):
-                # sort files by date from oldest to newest
-                entries.sort(key=lambda entry: entry[1]['modify'], reverse=False)
-                oldest_name = entries[0][0]
+            nb_expired = len(entries) - int(self.settings.archiving_max) + 1
+            for (oldest_name, properties) in entries[:nb_expired]:
                 logging.info("Deleting directory: " + oldest_name)
-                self.remove_directories(oldest_name)
+                if properties['type'] == 'file':
+                    # Backup saved as an archive
+                    self.ftp_connection.delete(posixpath.join(current_directory, oldest_name))
+                else:
+                    self.remove_directories(posixpath.join(current_directory, oldest_name))
                 self.infos.deleted_directories.append(oldest_name)
-                entries = self.get_directories_in_path(self.ftp_connection.pwd())
+            entries = entries[nb_expired:]
+            self.listings[current_directory] = [entry for entry in self.listings[current_directory]
+                                                if entry[0] not in self.infos.deleted_directories]
+
+        return entries
 
     def remove_directories(self, path):
         """
         Delete a directory recursively.
-        :param path: The path of directory to delete.
+        The tree is listed first, then files are deleted concurrently over several connections.
+        :param path: The absolute path of directory to delete.
+        """
+        files = []
+        directories = []
+        self.list_tree(path, files, directories)
+
+        connections = self.get_connections(len(files))
+        logging.info("Deleting " + str(len(files)) + " files with " + str(len(connections)) + " connection(s)")
+        run_in_workers(connections, files, lambda connection, file: connection.delete(file))
+
+        # Subdirectories are listed before their parent, so they are empty when deleted.
+        for directory in directories:
+            self.ftp_connection.rmd(directory)
+            self.listings.pop(directory, None)
+
+    def list_tree(self, path, files, directories):
+        """
+        List a directory recursively.
+        :param path: The absolute path of directory to list.
+        :param files: List filled with the paths of the files.
+        :param directories: List filled with the paths of the directories, subdirectories first.
         """
         for (name, properties) in self.get_directories_in_path(path=path):
             if properties['type'] == 'file':
-                self.ftp_connection.delete(f"{path}/{name}")
+                files.append(f"{path}/{name}")
             elif properties['type'] == 'dir':
-                self.remove_directories(f"{path}/{name}")
-        self.ftp_connection.rmd(path)
+                self.list_tree(f"{path}/{name}", files, directories)
+        directories.append(path)
 
     def get_directories_in_path(self, path):
         """
         Server MUST support mlsd commands !
-        :param path: String current path
+        The listing is kept for the run, the directory is not listed again.
+        :param path: String absolute path
         :return: List of string that contains directories in path.
         """
-        entries = list(self.ftp_connection.mlsd(path=path))
-        entries = list(filter(lambda entry: entry[0] not in ['.', '..'], entries))
-        return entries
+        if path not in self.listings:
+            entries = list(self.ftp_connection.mlsd(path=path))
+            self.listings[path] = list(filter(lambda entry: entry[0] not in ['.', '..'], entries))
+        return self.listings[path]
 
-    def send_files(self, path):
+    def is_directory(self, path, name):
         """
-        Copy files recursively. Creates the subdirectories if necessary.
-        :param path: path to save.
+        :param path: Absolute path of a directory.
+        :param name: Name of an entry in this directory.
+        :return: True if the entry exists and is a directory.
+        """
+        return any(entry_name == name and properties['type'] == 'dir'
+                   for entry_name, properties in self.get_directories_in_path(path))
+
+    def remove_file(self, path):
+        """
+        Delete a file if it exists.
+        :param path: Absolute path of the file.
         """
         try:
-            for name in os.listdir(path):
-                local_path = os.path.join(path, name)
-                if os.path.isfile(local_path):
-                    self.send_file(local_path, name)
-                elif os.path.isdir(local_path):
-                    try:
-                        self.ftp_connection.mkd(name)
-                        logging.info("New directory created" + local_path + name)
-
-                    # Ignore "directory already exists"
-                    except ftplib.error_perm as e:
-                        if not e.args[0].startswith('550'):
-                            raise
-
-                    self.ftp_connection.cwd(name)
-                    self.send_files(local_path)
-                    self.ftp_connection.cwd("..")
+            self.ftp_connection.delete(path)
+        except ftplib.error_perm:
+            pass
 
-        except PermissionError:
-            logging.warning("Cannot copy: " + path + " PERMISSION DENIED")
+    def make_directories(self, backup_path, relative_paths, may_exist):
+        """
+        Create the directories of the backup from the list built with the scan, one level of the tree at a time.
+        The directories of a level are created concurrently over the connections, their parents are created by the
+        previous level.
+        :param backup_path: Absolute path of the backup directory.
+        :param relative_paths: Paths of the directories in the backup.
+        :param may_exist: True if the backup is resumed, directories that already exist are ignored.
+        """
+        levels = {}
+        # Two paths to save can have the same name, their directories are created once
+        for relative_path in dict.fromkeys(relative_paths):
+            levels.setdefault(relative_path.count('/'), []).append(posixpath.join(backup_path, relative_path))
+        if not levels:
+            return
+
+        connections = self.get_connections(max(len(paths) for paths in levels.values()))
+        logging.info("Creating " + str(len(relative_paths)) + " directories in " + str(len(levels)) + " levels with " +
+                     str(len(connections)) + " connection(s)")
+        for depth in sorted(levels):
+            run_in_workers(connections, levels[depth],
+                           lambda connection, path: self.make_directory(path, connection, may_exist))
+
+    def make_directory(self, path, ftp_connection=None, may_exist=False):
+        """
+        Create a directory.
+        :param path: Absolute path of the directory, its parent must exist.
+        :param ftp_connection: connection to use, the main connection by default.
+        :param may_exist: True to ignore "directory already exists".
+        """
+        if ftp_connection is None:
+            ftp_connection = self.ftp_connection
+        try:
+            ftp_connection.mkd(path)
+            file_events.info("New directory created: " + path)
+
+        # Ignore "directory already exists"
+        except ftplib.error_perm as e:
+            if not (may_exist and e.args[0].startswith('550')):
+                raise
 
-    def send_file(self, path, file_name):
+    def send_files_with_connections(self, bundles):
+        """
+        Send the listed files and the bundles by spreading them across the connections.
+        :param bundles: List of Bundle to send.
+        """
+        jobs = bundles + self.files_to_send
+        connections = self.get_connections(len(jobs))
+        logging.info("Sending " + str(len(self.files_to_send)) + " files and " + str(len(bundles)) + " bundles with " +
+                     str(len(connections)) + " connection(s)")
+
+        start = time.monotonic()
+        with self.infos.measure_phase("transfer"):
+            run_pipeline(connections, jobs, self.send_job, self.get_job_path, self.settings.read_ahead)
+        self.infos.transfer_time += time.monotonic() - start
+
+        files_per_second, mb_per_second = self.infos.get_throughput()
+        logging.info("Transfer terminated: {:.1f} files/s, {:.2f} MB/s".format(files_per_second, mb_per_second))
+
+    def get_job_path(self, job):
+        """
+        :param job: Bundle or tuple (scan index entry, absolute path on server).
+        :return: Path of the local file read in advance by the pipeline, None for a bundle or a file sent with sendfile.
+        """
+        return None if isinstance(job, Bundle) or self.zero_copy else job[0].path
+
+    def send_job(self, ftp_connection, job, local_file=None):
+        """
+        :param ftp_connection: connection to use.
+        :param job: Bundle or tuple (scan index entry, absolute path on server).
+        :param local_file: ReadAheadFile of the file given by the pipeline, or None.
+        """
+        if isinstance(job, Bundle):
+            self.checkpoint.bundle_started(job)
+            checksum = self.send_bundle(job, ftp_connection)
+            self.checkpoint.bundle_done(job, checksum)
+        else:
+            entry, remote_path = job
+            offset = 0
+            if self.checkpoint.is_partially_sent(entry):
+                offset = self.get_remote_size(remote_path, ftp_connection)
+                if offset > entry.size:
+                    offset = 0
+            self.checkpoint.file_started(entry)
+            checksum = self.send_file(entry.path, remote_path, ftp_connection, offset, local_file)
+            # A file that cannot be read is tried again if the backup is resumed
+            if entry.path not in self.unreadable_paths:
+                self.checkpoint.file_done(entry, checksum)
+
+    def send_bundle(self, bundle, ftp_connection):
+        """
+        Send a bundle, the tar file is produced while it is sent.
+        :param bundle: Bundle to send.
+        :param ftp_connection: connection to use.
+        :return: SHA-256 of the bundle.
+        """
+        file_events.info("Sending " + bundle.name + " (" + str(len(bundle.entries)) + " files)")
+        with ArchiveStream(bundle.entries, self.infos, None, 0) as archive:
+            hashing_file = HashingFile(archive)
+            ftp_connection.storbinary('STOR ' + bundle.remote_path, hashing_file, self.settings.buffer_size)
+        self.unreadable_paths.update(archive.unreadable_paths)
+        self.verify_file(ftp_connection, bundle.remote_path, bundle.name, hashing_file)
+        return hashing_file.get_checksum()
+
+    def get_remote_size(self, path, ftp_connection):
+        """
+        :param path: Absolute path of a file on server.
+        :param ftp_connection: connection to use.
+        :return: Size of the file on server, 0 if it does not exist.
+        """
+        try:
+            # SIZE gives the number of bytes only in binary mode
+            ftp_connection.voidcmd('TYPE I')
+            return ftp_connection.size(path) or 0
+        except ftplib.error_perm:
+            return 0
+
+    def send_file(self, path, file_name, ftp_connection=None, offset=0, local_file=None):
         """
         Copy one file to server.
         :param path: String path of the local file.
-        :param file_name: name of the file.
+        :param file_name: name of the file, or its absolute path on server.
+        :param ftp_connection: connection to use, the main connection by default.
+        :param offset: Number of bytes already on server, the transfer restarts from there (REST command).
+        :param local_file: ReadAheadFile of the file read by the pipeline, the file is opened here if None.
+        :return: SHA-256 of the file, None if it cannot be read or if it is sent with sendfile.
         """
+        if ftp_connection is None:
+            ftp_connection = self.ftp_connection
         try:
-            logging.info("Sending " + path)
-            self.ftp_connection.storbinary('STOR ' + file_name, open(path, 'rb'))
-            self.infos.nb_file_copied += 1
+            start = time.monotonic()
+            with local_file if local_file is not None else open(path, 'rb') as file:
+                if offset:
+                    file_events.info("Resuming " + path + " at byte " + str(offset))
+                else:
+                    file_events.info("Sending " + path)
+                if self.zero_copy:
+                    hashing_file = None
+                    store_with_sendfile(ftp_connection, 'STOR ' + file_name, file, offset)
+                else:
+                    # The checksum is computed while the file is read for the upload
+                    hashing_file = HashingFile(file)
+                    hashing_file.seek(offset)
+                    ftp_connection.storbinary('STOR ' + file_name, hashing_file, self.settings.buffer_size,
+                                              rest=offset or None)
+                self.infos.add_file_copied(file.tell() - offset, path, time.monotonic() - start)
         except PermissionError:
             logging.warning("Cannot copy: " + path + " PERMISSION DENIED")
+            self.unreadable_paths.add(path)
+            return None
+        if hashing_file is None:
+            return None
+        self.verify_file(ftp_connection, file_name, path, hashing_file)
+        return hashing_file.get_checksum()
+
+    def get_verification(self, ftp_connection):
+        """
+        Choose the command used to verify the files, from the features of the server. Done once per run.
+        :param ftp_connection: connection to use.
+        :return: HASH, XSHA256, XCRC or RETR.
+        """
+        with self.verification_lock:
+            if self.verification is None:
+                try:
+                    features = [line.strip().upper() for line in ftp_connection.sendcmd('FEAT').splitlines()[1:-1]]
+                except ftplib.error_perm:
+                    features = []
+                if any(feature.startswith('HASH') and 'SHA-256' in feature for feature in features):
+                    self.verification = 'HASH'
+                elif 'XSHA256' in features:
+                    self.verification = 'XSHA256'
+                elif 'XCRC' in features:
+                    self.verification = 'XCRC'
+                else:
+                    self.verification = 'RETR'
+                logging.info("Files verified with the " + self.verification + " command")
+            return self.verification
+
+    def verify_file(self, ftp_connection, remote_path, path, hashing_file):
+        """
+        Compare the checksum of a file on server with the one computed while it was sent, if verify is YES.
+        Without a hash command on the server, only a sample of the files is read back.
+        :param ftp_connection: connection to use.
+        :param remote_path: Path of the file on server.
+        :param path: Path of the local file, or name of the bundle, for the logs.
+        :param hashing_file: HashingFile that read the file.
+        """
+        if self.settings.verify != "YES":
+            return
+        verification = self.get_verification(ftp_connection)
+        expected = hashing_file.get_checksum()
+        try:
+            if verification == 'HASH':
+                if ftp_connection not in self.hash_connections:
+                    ftp_connection.sendcmd('OPTS HASH SHA-256')
+                    self.hash_connections.add(ftp_connection)
+                checksum = find_checksum(ftp_connection.sendcmd('HASH ' + remote_path), 64)
+            elif verification == 'XSHA256':
+                checksum = find_checksum(ftp_connection.sendcmd('XSHA256 ' + remote_path), 64)
+            elif verification == 'XCRC':
+                expected = hashing_file.get_crc()
+                checksum = find_checksum(ftp_connection.sendcmd('XCRC ' + remote_path), 8)
+            else:
+                if not is_sampled(self.settings.verify_sample):
+                    return
+                sha256 = hashlib.sha256()
+                ftp_connection.retrbinary('RETR ' + remote_path, sha256.update)
+                checksum = sha256.hexdigest()
+        except ftplib.error_perm as e:
+            logging.warning("Cannot verify: " + path + " " + str(e))
+            return
+
+        self.infos.add_file_verified(path, checksum == expected)
+        if checksum != expected:
+            logging.warning("Checksum mismatch: " + path + " is different on server (" + str(checksum) +
+                            " instead of " + expected + ")")
+
+
+def is_alive(ftp_connection):
+    """
+    :param ftp_connection: Connection kept open in the pool.
+    :return: True if the server did not close the connection.
+    """
+    try:
+        ftp_connection.voidcmd('NOOP')
+        return True
+    except ftplib.all_errors:
+        return False
+
+
+def quit_connection(ftp_connection):
+    """
+    Close a connection, politely if the server still answers.
+    """
+    try:
+        ftp_connection.quit()
+    except ftplib.all_errors:
+        ftp_connection.close()
+
+
+def store_with_sendfile(ftp_connection, command, file, offset):
+    """
+    Same as storbinary, but the file is sent by the kernel (sendfile) from the page cache to the data connection.
+    :param ftp_connection: Plain FTP connection, the data of FTPS must be encrypted by python.
+    :param command: STOR command.
+    :param file: Local file opened in binary mode, its position is at the end of the file after.
+    :param offset: Number of bytes already on server, the transfer restarts from there (REST command).
+    :return: Response of the server.
+    """
+    ftp_connection.voidcmd('TYPE I')
+    with ftp_connection.transfercmd(command, offset or None) as data_connection:
+        data_connection.sendfile(file, offset)
+    return ftp_connection.voidresp()
 
 
 class CustomFtpTLS(ftplib.FTP_TLS):
@@ -1,10 +1,13 @@
 import logging
 import os
 import shutil
-from pathlib import Path
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from main.utils.custom_exceptions import ApplicationError
-from main.utils.historisation import get_new_names_by_version, get_new_name_by_date
+from main.utils.fast_copy import copy_file_data
+from main.utils.historisation import get_new_name_by_version, get_new_name_by_date
+from main.utils.profile_logging import in_current_context
 
 
 class LocalSave:
@@ -12,20 +15,30 @@ class LocalSave:
     Class for LOCAL saving.
     """
 
-    def __init__(self, settings, infos):
+    def __init__(self, settings, infos, scan_index):
         """
         Constructor.
         :param settings: Object that contains the information about server, path to save, usernames...
+        :param infos: Object that contains the information about what happens.
+        :param scan_index: Files and directories to save.
         """
+        self.scan_index = scan_index
         self.settings = settings
         self.infos = infos
+        self.destination = None  # Absolute path of the directory to save in
+        self.previous_path_name = None  # Absolute path of the latest backup in snapshot mode
+        self.files_to_copy = []  # List of tuples (scan index entry, path in backup, path in previous backup or None)
+        self.directories_copied = []  # List of tuples (local path, path in backup)
 
     def save(self):
         """Entry point of class.
         """
         try:
-            os.chdir(self.settings.directory_to_save_in)
-            logging.info("Positioned in: " + os.getcwd())
+            # Absolute paths instead of changing the working directory, other backups can run in the same process
+            self.destination = os.path.abspath(self.settings.directory_to_save_in)
+            if not os.path.isdir(self.destination):
+                raise ApplicationError("Directory to save in not found: " + self.destination)
+            logging.info("Positioned in: " + self.destination)
 
             self.save_files()
 
@@ -37,57 +50,70 @@ class LocalSave:
         Copy all files on locally.
         """
 
-        # Clean the directory first.
-        self.cleaning()
+        # Clean the directory first, remaining backups are sorted from oldest to newest.
+        with self.infos.measure_phase("cleaning"):
+            directories_in_path = self.cleaning()
 
         # Get the directory name
-        if self.settings.archiving_mode == "date":
-            new_directory_name = get_new_name_by_date()
-        else:
-            # Change the names of older backups by doing a shift of index. (1->2, 2->3...)
-            directories_in_path = self.get_directories_in_path(os.getcwd())
-            directories_in_path.sort(key=os.path.getmtime)
-            old_names = [entry for entry in directories_in_path]
-            new_names = get_new_names_by_version(old_names)
-            new_directory_name = new_names[len(new_names) - 1]
-            for directory_index in range(0, len(new_names) - 1):
-                logging.info(
-                    "Renaming directory: " + old_names[directory_index] + " to: " + new_names[directory_index])
-                os.rename(old_names[directory_index], new_names[directory_index])
+        new_directory_name = self.get_new_directory_name(directories_in_path)
+
+        # In snapshot mode, unchanged files are hard links to the files of the latest backup.
+        if self.settings.snapshot == "YES" and directories_in_path:
+            self.previous_path_name = os.path.join(self.destination, directories_in_path[-1])
+            logging.info("Snapshot based on: " + self.previous_path_name)
 
         # Create new directory to store files
         self.infos.new_directory_name = new_directory_name
-        os.mkdir(new_directory_name)
+        new_path_name = os.path.join(self.destination, new_directory_name)
+        os.mkdir(new_path_name)
         logging.info("New backup directory created: " + new_directory_name)
-        os.chdir(new_directory_name)
-        logging.info("Positioned in: " + os.getcwd())
-        new_path_name = os.getcwd()
 
-        # Copy files and directory recursively.
-        for path in self.settings.paths_to_save:
-            if os.path.isfile(path):
-                self.copy_file(path, new_path_name)
+        # Create directories first, then copy files.
+        self.files_to_copy = []
+        for entry in self.scan_index.entries:
+            if entry.type == 'dir':
+                self.make_directory(entry, new_path_name)
+            else:
+                self.files_to_copy.append((entry, os.path.join(new_path_name, entry.relative_path),
+                                           self.get_previous_path(entry.relative_path)))
+
+        self.copy_files_with_threads()
+
+        if self.infos.nb_file_linked > 0:
+            logging.info("Snapshot terminated: " + str(self.infos.nb_file_copied) + " files copied, " +
+                         str(self.infos.nb_file_linked) + " unchanged files linked")
 
-            elif os.path.isdir(path):
-                self.copy_files(path, new_path_name)
+    def get_new_directory_name(self, directories_in_path):
+        """
+        Get the name of the new backup, older backups keep their name.
+        :param directories_in_path: List of the names of the other backups.
+        :return: name of the new backup.
+        """
+        if self.settings.archiving_mode == "date":
+            return get_new_name_by_date()
+        return get_new_name_by_version(directories_in_path)
 
     def cleaning(self):
         """
         Save Rotation.
         Counts the number of backups in directory. If it is greater than limit, it delete old versions.
+        :return: List of the remaining backups, sorted from oldest to newest.
         """
-        entries = self.get_directories_in_path(os.getcwd())
+        entries = self.get_directories_in_path(self.destination)
+        # sort files by date from oldest to newest
+        entries.sort(key=lambda name: os.path.getmtime(os.path.join(self.destination, name)))
+
         if len(entries) >= int(self.settings.archiving_max):
             logging.info("Maximum backup (" + str(self.settings.archiving_max) + ") is reached: " + str(len(entries)))
 
-            while len(entries) >= int(self.settings.archiving_max):
-                # sort files by date from oldest to newest
-                entries.sort(key=os.path.getmtime)
-                oldest_name = entries[0]
+            nb_expired = len(entries) - int(self.settings.archiving_max) + 1
+            for oldest_name in entries[:nb_expired]:
                 logging.info("Deleting directory: " + oldest_name)
-                self.remove_directories(oldest_name)
+                self.remove_directories(os.path.join(self.destination, oldest_name))
                 self.infos.deleted_directories.append(oldest_name)
-                entries = self.get_directories_in_path(os.getcwd())
+            entries = entries[nb_expired:]
+
+        return entries
 
     def remove_directories(self, path):
         """
@@ -104,34 +130,79 @@ class LocalSave:
         entries = list(os.listdir(path=path))
         return entries
 
-    def copy_files(self, path, new_path):
+    def make_directory(self, entry, new_path):
         """
-        Copy files recursively. Creates the subdirectories if necessary.
-        :param new_path: Name of the new path
-        :param path: path to save.
+        Create a directory of the scan index in the backup.
+        :param entry: Scan index entry of the directory.
+        :param new_path: Path of the backup.
         """
+        destination_directory = os.path.join(new_path, entry.relative_path)
         try:
-            directory_name = '/' + Path(path).name
-            logging.info("Copying " + path + " to " + new_path + directory_name)
-            shutil.copytree(path, new_path + directory_name)
+            os.makedirs(destination_directory, exist_ok=True)
+            self.directories_copied.append((entry.path, destination_directory))
+        except OSError:
+            logging.warning("Cannot copy: " + entry.path + " PERMISSION DENIED")
 
-        except shutil.Error as e:
-            logging.warning("Cannot copy: " + path + " PERMISSION DENIED")
-            errors = e.args[0]
-            for error in errors:
-                src, dst, msg = error
-                logging.warning("Cannot copy: " + src + " PERMISSION DENIED")
+    def get_previous_path(self, relative_path):
+        """
+        :param relative_path: path of a file in the backup.
+        :return: path of the file in the previous backup in snapshot mode, None otherwise.
+        """
+        if self.previous_path_name is None:
+            return None
+        return os.path.join(self.previous_path_name, relative_path)
 
-    def copy_file(self, path, new_path):
+    def copy_files_with_threads(self):
+        """
+        Copy the listed files with several threads, then copy the metadata of the directories.
+        Directories are done last because copying files in them changes their modification time.
+        """
+        logging.info("Copying " + str(len(self.files_to_copy)) + " files with " + str(self.settings.nb_threads) +
+                     " thread(s)")
+        start = time.monotonic()
+        with self.infos.measure_phase("transfer"), \
+                ThreadPoolExecutor(max_workers=self.settings.nb_threads, thread_name_prefix="copy") as executor:
+            # list() to raise the exceptions of the threads
+            list(executor.map(in_current_context(lambda job: self.copy_one_file(*job)), self.files_to_copy))
+        self.infos.transfer_time += time.monotonic() - start
+
+        for source_directory, destination_directory in reversed(self.directories_copied):
+            try:
+                shutil.copystat(source_directory, destination_directory)
+            except OSError:
+                pass
+
+        files_per_second, mb_per_second = self.infos.get_throughput()
+        logging.info("Copy terminated: {:.1f} files/s, {:.2f} MB/s".format(files_per_second, mb_per_second))
+
+    def copy_one_file(self, entry, new_file, previous_file):
         """
-        Copy one file.
-        :param path: String path of the local file.
-        :param new_path: path of the new file.
+        Copy one file with its metadata.
+        In snapshot mode, the previous version of the file is hard linked if it has the same size and modification
+        time.
+        :param entry: Scan index entry of the local file, its size and modification time are compared without a stat.
+        :param new_file: path of the new file.
+        :param previous_file: path of the file in the previous backup or None.
         """
+        path = entry.path
         try:
-            file_name = '/' + Path(path).name
-            logging.info("Copying " + path + " to " + new_path + file_name)
-            shutil.copy(path, new_path + file_name)
-            self.infos.nb_file_copied += 1
+            start = time.monotonic()
+            if previous_file is not None:
+                try:
+                    previous_stat = os.lstat(previous_file)
+                    if previous_stat.st_size == entry.size and previous_stat.st_mtime == entry.mtime:
+                        os.link(previous_file, new_file)
+                        self.infos.add_file_linked()
+                        return
+                except OSError:
+                    # No previous version or the file system does not support hard links: copy it
+                    pass
+
+            nb_bytes = copy_file_data(path, new_file)
+            shutil.copystat(path, new_file)
+            self.infos.add_file_copied(nb_bytes, path, time.monotonic() - start)
         except PermissionError:
             logging.warning("Cannot copy: " + path + " PERMISSION DENIED")
+        except OSError as e:
+            # The destination is full or broken (ENOSPC, EIO...), the backup fails
+            raise ApplicationError("Cannot copy " + path + ": " + str(e))
@@ -1,10 +1,25 @@
 import logging
-import shlex
+import os
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from main.utils import logging_subprocess
 from main.utils.custom_exceptions import ApplicationError
+from main.utils.profile_logging import in_current_context
+
+# Seconds to wait for the SSH master connection.
+MASTER_TIMEOUT = 30
+
+# Exit codes of rsync when some files could not be transferred, the others are saved.
+PARTIAL_TRANSFER_CODES = {23, 24}
+
+# Labels of the --stats lines counted in Infos. Older versions of rsync use the second one for the files.
+STATS_FILES_LABELS = ("Number of regular files transferred:", "Number of files transferred:")
+STATS_BYTES_LABEL = "Total transferred file size:"
 
 
 class RSyncSave:
@@ -14,12 +29,14 @@ class RSyncSave:
     Necessity of rsync and sshpass installed.
     """
 
-    def __init__(self, settings, infos):
+    def __init__(self, settings, infos, scan_index):
         """
         Constructor.
         :param settings: Object that contains the information about server, path to save, usernames...
         :param infos: Object that contains the information about what happens.
+        :param scan_index: Files and directories to save.
         """
+        self.scan_index = scan_index
         self.rsync_connection = None
         self.settings = settings
         self.server_ip_address = self.settings.server_ip_address
@@ -37,37 +54,153 @@ class RSyncSave:
                                    "environment.\nIt should be run under a Unix-like"
                                    "environment such as Linux or Cygwin.\n.")
 
+        logging.info("Synchronizing " + str(self.scan_index.nb_files) + " files (" +
+                     str(self.scan_index.total_size) + " bytes) with rsync")
+
+        # All the rsync commands use the same SSH connection, authentication is done once.
+        control_directory = tempfile.mkdtemp(prefix="backup_ssh_")
+        control_path = os.path.join(control_directory, "master")
+        master = None
         try:
-            for path in self.settings.paths_to_save:
-                args = '-avzrh' + ' -d' + ' --update --stats -e'
-                """
-                    -a : archive mode which makes it retain file attributes such as permissions and ownership.
-                    -v : verbose mode, this will make rsync output status of the copy.
-                    -z : compress files during the copy, this will save time for slow network connections.
-                    -r : recursively copy files and directories.
-                    -h : outputs in a human readable format. 
-                    -e : specify the type of protocol to be used
-                    --update :  If we want to copy files over the remote-host that have been updated more recently on 
-                        the local filesystem. Files that do not exist on the remote-host are copied.
-                    Files that exist on both local and remote but have a newer timestamp on the local-host are copied 
-                        to remote-host. 
-                """
-
-                command = 'rsync --rsync-path="/usr/bin/sudo /usr/bin/rsync" {0} ' \
-                          '"sshpass -p "{1}" ' \
-                          'ssh -p {2} -o StrictHostKeyChecking=no" ' \
-                          '{3} {4}@{5}:/{6}'.format(args,
-                                                    self.settings.password,
-                                                    self.settings.port,
-                                                    path,
-                                                    self.settings.username,
-                                                    self.settings.server_ip_address,
-                                                    self.settings.directory_to_save_in)
-
-                logging_subprocess.call(shlex.split(command), self.infos)
+            master = self.start_master(control_path)
+
+            start = time.monotonic()
+            with self.infos.measure_phase("transfer"):
+                if self.settings.rsync_files_from == "YES":
+                    files_from = os.path.join(control_directory, "files_from")
+                    self.write_files_from(files_from)
+                    logging.info("Synchronizing " + str(len(self.scan_index.roots)) + " paths in one rsync session")
+                    self.synchronize(['--from0', '--files-from=' + files_from, '/'], "files-from", control_path)
+                else:
+                    nb_jobs = max(1, min(self.settings.nb_connections, len(self.scan_index.roots)))
+                    logging.info("Synchronizing " + str(len(self.scan_index.roots)) + " paths with " + str(nb_jobs) +
+                                 " rsync job(s)")
+                    exclusions = ['--exclude=' + pattern for pattern in self.scan_index.exclusions]
+                    with ThreadPoolExecutor(max_workers=nb_jobs, thread_name_prefix="rsync") as executor:
+                        # list() to raise the exceptions of the threads
+                        list(executor.map(in_current_context(
+                            lambda path: self.synchronize(['-r'] + exclusions + [path],
+                                                          os.path.basename(path.rstrip('/')), control_path)),
+                            self.scan_index.roots))
+            self.infos.transfer_time += time.monotonic() - start
 
         except (OSError, subprocess.CalledProcessError) as exception:
             logging.info('Subprocess failed')
             raise ApplicationError(str(exception))
+        finally:
+            if master is not None:
+                master.terminate()
+                master.wait()
+            shutil.rmtree(control_directory, ignore_errors=True)
         # no exception was raised
         logging.info('Subprocess finished')
+
+    def get_ssh_command(self, control_path):
+        """
+        :param control_path: Path of the socket of the SSH master connection.
+        :return: List of the arguments of the ssh command.
+        """
+        return ['ssh', '-p', str(self.settings.port), '-o', 'StrictHostKeyChecking=no',
+                '-o', 'ControlPath=' + control_path]
+
+    def start_master(self, control_path):
+        """
+        Open the SSH master connection, other ssh commands with the same control path use it without authentication.
+        :param control_path: Path of the socket of the master connection.
+        :return: Popen of the master connection.
+        """
+        logging.info("Opening SSH connection to " + self.server_ip_address)
+        # The password is given in the environment so it does not appear in the list of processes
+        command = ['sshpass', '-e'] + self.get_ssh_command(control_path) + \
+                  ['-o', 'ControlMaster=yes', '-N', self.settings.username + '@' + self.server_ip_address]
+        master = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.PIPE, env=dict(os.environ, SSHPASS=self.settings.password))
+
+        # The socket is created when the authentication is done
+        deadline = time.monotonic() + MASTER_TIMEOUT
+        while not os.path.exists(control_path):
+            if master.poll() is not None:
+                raise ApplicationError("SSH connection failed: " +
+                                       master.stderr.read().decode('utf-8', errors='replace').strip())
+            if time.monotonic() > deadline:
+                master.terminate()
+                master.wait()
+                raise ApplicationError("SSH connection to " + self.server_ip_address + " timed out")
+            time.sleep(0.1)
+        return master
+
+    def write_files_from(self, path):
+        """
+        Write the list of the scanned files and directories for the --files-from option, separated by null characters.
+        Paths are relative to "/" and contain "/./", so they are saved with the same path as the other modes, e.g.
+        /etc/X11/xorg.conf is listed as etc/./X11/xorg.conf and saved in directory_to_save_in/X11/xorg.conf.
+        :param path: Path of the list.
+        """
+        parents = {root: os.path.dirname(os.path.abspath(root)).strip('/') for root in self.scan_index.roots}
+        with open(path, 'wb') as files_from:
+            root = None
+            for entry in self.scan_index.entries:
+                # Entries of a root come after the root itself
+                if entry.path in parents:
+                    root = entry.path
+                files_from.write(os.path.join(parents[root], '.', entry.relative_path).encode('utf-8') + b'\0')
+
+    def synchronize(self, sources, name, control_path):
+        """
+        Run one rsync command and count the transferred files in Infos.
+        :param sources: rsync arguments that give the files to send.
+        :param name: Written before each line of output of this command.
+        :param control_path: Path of the socket of the SSH master connection.
+        """
+        args = ['-avz', '-d', '--update', '--stats']
+        """
+            -a : archive mode which makes it retain file attributes such as permissions and ownership.
+            -v : verbose mode, this will make rsync output status of the copy.
+            -z : compress files during the copy, this will save time for slow network connections.
+            -r : recursively copy files and directories, given with the paths. With --files-from, the list already
+                contains all the files and directories, without the excluded ones.
+            -e : specify the type of protocol to be used
+            --update :  If we want to copy files over the remote-host that have been updated more recently on 
+                the local filesystem. Files that do not exist on the remote-host are copied.
+            Files that exist on both local and remote but have a newer timestamp on the local-host are copied 
+                to remote-host. 
+            --stats : statistics at the end, numbers are not human readable (no -h) to be parsed.
+        """
+
+        command = ['rsync', '--rsync-path=/usr/bin/sudo /usr/bin/rsync'] + args + \
+                  ['-e', ' '.join(self.get_ssh_command(control_path))] + sources + \
+                  ['{0}@{1}:/{2}'.format(self.settings.username, self.settings.server_ip_address,
+                                         self.settings.directory_to_save_in)]
+
+        stats = {'files': 0, 'bytes': 0}
+        code = logging_subprocess.call(command, lambda line: parse_stats_line(line, stats), prefix="[" + name + "] ")
+        self.infos.add_files_copied(stats['files'], stats['bytes'])
+        logging.info("Synchronized " + name + ": " + str(stats['files']) + " files (" + str(stats['bytes']) +
+                     " bytes) transferred")
+
+        if code in PARTIAL_TRANSFER_CODES:
+            logging.warning("Cannot copy some files of " + name + ", rsync exit code " + str(code))
+        elif code != 0:
+            raise ApplicationError("rsync failed for " + name + " with exit code " + str(code))
+
+
+def parse_stats_line(line, stats):
+    """
+    Read the number of transferred files and bytes in a line of rsync --stats output.
+    :param line: Line of output.
+    :param stats: Dict {'files', 'bytes'} updated if the line contains one of them.
+    """
+    for label in STATS_FILES_LABELS:
+        if line.startswith(label):
+            stats['files'] = get_stats_number(line[len(label):])
+            return
+    if line.startswith(STATS_BYTES_LABEL):
+        stats['bytes'] = get_stats_number(line[len(STATS_BYTES_LABEL):])
+
+
+def get_stats_number(text):
+    """
+    :param text: End of a --stats line, e.g. " 1,234 bytes" or " 12 (reg: 10, dir: 2)".
+    :return: The first number of the text.
+    """
+    return int(text.split()[0].replace(',', ''))
@@ -1,11 +1,30 @@
+import hashlib
 import logging
-import os
-from pathlib import Path
+import posixpath
+import secrets
+import shlex
+import socket
+import stat
+import threading
+import time
 
 import paramiko
 
+from main.utils.archive_stream import ARCHIVE_EXTENSIONS, ArchiveStream
+from main.utils.bundles import BUNDLE_INDEX_NAME, Bundle, get_bundle_index, make_bundles
+from main.utils.checkpoint import Checkpoint
+from main.utils.checksums import CHECKSUMS_NAME, HashingFile, find_checksum, get_checksums_content, is_sampled
 from main.utils.custom_exceptions import ApplicationError
-from main.utils.historisation import get_new_name_by_date, get_new_names_by_version
+from main.utils.delta import DELTA_BLOCK_SIZE, SIGNATURES_DIRECTORY, Signature, get_previous_location, \
+    get_signature_path
+from main.utils.historisation import get_new_name_by_date, get_new_name_by_version
+from main.utils.manifest import MANIFEST_NAME, Manifest, filter_unchanged_files, get_directories_to_keep
+from main.utils.pipeline import run_pipeline
+from main.utils.queue_logging import file_events
+from main.utils.workers import run_in_workers
+
+# Seconds to wait for the commands that only verify what the shell of the server sees.
+SHELL_CHECK_TIMEOUT = 30
 
 
 class SftpSave:
@@ -13,129 +32,430 @@ class SftpSave:
     Class for SFTP saving. Uses paramiko library.
     """
 
-    def __init__(self, settings, infos):
+    def __init__(self, settings, infos, scan_index, connection_pool=None):
         """
         Constructor.
         :param settings: Object that contains the information about server, path to save, usernames...
         :param infos: Object that contains the information about what happens.
+        :param scan_index: Files and directories to save.
+        :param connection_pool: ConnectionPool of the daemon, the transport is closed at the end if None.
         """
+        self.scan_index = scan_index
+        self.connection_pool = connection_pool
         self.sftp_connection = None
         self.transport = None
+        self.channels = []  # Main channel and other channels opened on the transport to work concurrently
+        self.files_to_send = []  # List of tuples (scan index entry, absolute path on server)
+        self.checkpoint = None  # Journal of the sent files
+        self.unreadable_paths = set()  # Local paths of the files that could not be read
+        self.verification = None  # Method used to verify the files: check-file, sha256sum or read back of a sample
+        self.verification_lock = threading.Lock()
+        self.backup_path = None  # Absolute path of the new backup directory
+        self.previous_directories = []  # Names of the previous backups, from oldest to newest
+        self.previous_manifest = None
         self.settings = settings
         self.server_ip_address = self.settings.server_ip_address
+        self.server_side_delete = self.settings.server_side_delete == "YES"
+        self.remote_copy = True  # False once the server refused a cp command
+        self.shell_sees_files = None  # True if commands executed on the server see the files of SFTP (no chroot)
+        self.shell_lock = threading.Lock()
         self.infos = infos
 
     def connect_sftp(self):
         """
         Connect to the server with paramiko.
         """
+        succeeded = False
         try:
-            # Open a transport
-            self.transport = paramiko.Transport(self.settings.server_ip_address, self.settings.port)
-            logging.info("Creating transport " + self.server_ip_address + " on port " + str(self.settings.port))
+            # The daemon keeps the transports to the servers used recently, a new channel is opened on them
+            if self.connection_pool is not None:
+                self.transport = self.connection_pool.take(self.get_pool_key(), lambda transport: transport.is_active())
+            if self.transport is not None:
+                logging.info("Reusing transport to " + self.server_ip_address)
+            else:
+                # Open a transport
+                self.transport = paramiko.Transport((self.settings.server_ip_address, int(self.settings.port)),
+                                                    default_window_size=self.settings.window_size)
+                logging.info("Creating transport " + self.server_ip_address + " on port " + str(self.settings.port))
 
-            # Auth
-            self.transport.connect(None, self.settings.username, self.settings.password)
-            logging.info("Connecting to " + self.server_ip_address)
+                # Auth
+                self.transport.connect(None, self.settings.username, self.settings.password)
+                logging.info("Connecting to " + self.server_ip_address)
 
             # Go!
             self.sftp_connection = paramiko.SFTPClient.from_transport(self.transport)
+            self.channels = [self.sftp_connection]
 
             self.sftp_connection.chdir(self.settings.directory_to_save_in)
             logging.info("Positioned in: " + self.sftp_connection.getcwd())
 
             self.save_files()
-
-            # Close
-            if self.sftp_connection:
-                self.sftp_connection.close()
-            if self.transport:
-                logging.info("Quiting from SFTP server at " + self.server_ip_address)
-            self.transport.close()
+            succeeded = True
 
         except paramiko.SSHException as e:
             raise ApplicationError(str(e) + str(e.args) + str(e.with_traceback(e.__traceback__)))
+        finally:
+            self.release_transport(succeeded)
+
+    def release_transport(self, reusable):
+        """
+        Close the channels at the end of the backup. The transport is given back to the pool of the daemon, or closed
+        if the backup failed: it can be in the middle of a transfer.
+        :param reusable: False if the backup failed.
+        """
+        for channel in self.channels:
+            try:
+                channel.close()
+            except (paramiko.SSHException, OSError, EOFError):
+                pass
+        self.channels = []
+        self.sftp_connection = None
+        if self.transport is None:
+            return
+
+        if reusable and self.connection_pool is not None:
+            self.connection_pool.give_back(self.get_pool_key(), self.transport, lambda transport: transport.close())
+            logging.info("Transport to " + self.server_ip_address + " kept open for the next backup")
+        else:
+            logging.info("Quiting from SFTP server at " + self.server_ip_address)
+            self.transport.close()
+        self.transport = None
+
+    def get_pool_key(self):
+        """
+        :return: Key of the transports to the same server with the same user in the pool.
+        """
+        return self.settings.save_mode, self.server_ip_address, int(self.settings.port), self.settings.username
+
+    def get_channels(self, nb_jobs):
+        """
+        Get the channels to use to do jobs concurrently. New channels are opened on the transport if necessary.
+        :param nb_jobs: Number of jobs to do, no more channels than jobs are opened.
+        :return: List of channels, the first one is the main channel.
+        """
+        nb_channels = max(1, min(self.settings.nb_connections, nb_jobs))
+        while len(self.channels) < nb_channels:
+            self.channels.append(paramiko.SFTPClient.from_transport(self.transport))
+        return self.channels[:nb_channels]
 
     def save_files(self):
         """
         Copy all files on server.
+        If the previous backup was interrupted, it is resumed: files already sent are not sent again.
         """
 
-        # Clean the directory first.
-        self.cleaning()
+        # Journal of the sent files, an unfinished backup is resumed instead of starting a new one.
+        self.checkpoint = Checkpoint(self.settings)
+        resumed_directory = self.checkpoint.load() if self.settings.archive == "NO" else None
+
+        # Clean the directory first, remaining backups are sorted from oldest to newest.
+        with self.infos.measure_phase("cleaning"):
+            directories_in_path = self.cleaning(resumed_directory)
+
+        # Read the manifest of the latest backup to send only new or changed files.
+        previous_manifest = None
+        if self.settings.incremental == "YES" and directories_in_path:
+            previous_manifest = self.read_manifest(directories_in_path[-1].filename)
 
-        # Get the directory name
-        if self.settings.archiving_mode == "date":
-            new_directory_name = get_new_name_by_date()
+        if resumed_directory is not None and self.enter_directory(resumed_directory):
+            logging.info("Resuming backup directory: " + resumed_directory)
+            new_directory_name = resumed_directory
+            self.checkpoint.resume()
         else:
-            # Change the names of older backups by doing a shift of index. (1->2, 2->3...)
-            directories_in_path = self.get_directories_in_path(self.sftp_connection.getcwd())
-            directories_in_path.sort(key=lambda f: f.st_mtime)
-            old_names = [entry.filename for entry in directories_in_path]
-            new_names = get_new_names_by_version(old_names)
-            new_directory_name = new_names[len(new_names) - 1]
-            for directory_index in range(0, len(new_names) - 1):
-                logging.info(
-                    "Renaming directory: " + old_names[directory_index] + " to: " + new_names[directory_index])
-                self.sftp_connection.posix_rename(old_names[directory_index], new_names[directory_index])
-
-        # Create new directory to store files
+            # Get the directory name, older backups keep their name.
+            if self.settings.archiving_mode == "date":
+                new_directory_name = get_new_name_by_date()
+            else:
+                new_directory_name = get_new_name_by_version([entry.filename for entry in directories_in_path])
+
+            # In archive mode, the backup is one compressed file instead of a directory.
+            if self.settings.archive != "NO":
+                self.send_archive(new_directory_name + ARCHIVE_EXTENSIONS[self.settings.archive])
+                return
+
+            # Create new directory to store files and go in.
+            self.sftp_connection.mkdir(new_directory_name)
+            logging.info("New backup directory created: " + new_directory_name)
+            self.enter_directory(new_directory_name)
+            self.checkpoint.start(new_directory_name)
         self.infos.new_directory_name = new_directory_name
-        self.sftp_connection.mkdir(new_directory_name)
-        logging.info("New backup directory created: " + new_directory_name)
-        self.sftp_connection.chdir(new_directory_name)
-        logging.info("Positioned in: " + self.sftp_connection.getcwd())
 
-        # Save files recursively with the same structure and hierarchy.
-        for path in self.settings.paths_to_save:
+        try:
+            # Create the directories with the same structure and hierarchy, files are sent after.
+            current_directory = self.sftp_connection.getcwd()
+            self.backup_path = current_directory
+            self.previous_directories = [entry.filename for entry in directories_in_path]
+            self.previous_manifest = previous_manifest
+            self.files_to_send = []
+            for entry in self.scan_index.entries:
+                if entry.type == 'dir':
+                    self.make_directory(entry.relative_path)
+                else:
+                    self.files_to_send.append((entry, posixpath.join(current_directory, entry.relative_path)))
+
+            manifest = None
+            if self.settings.incremental == "YES":
+                manifest = Manifest(new_directory_name)
+                directories_to_keep = get_directories_to_keep([entry.filename for entry in directories_in_path],
+                                                              self.settings.archiving_max)
+                self.files_to_send = filter_unchanged_files(self.files_to_send, current_directory, manifest,
+                                                            previous_manifest, directories_to_keep)
+
+            self.files_to_send, bundles, bundles_to_delete = self.checkpoint.filter_sent_files(self.files_to_send,
+                                                                                               current_directory)
+            for bundle_path in bundles_to_delete:
+                self.remove_file(bundle_path)
 
-            if os.path.isfile(path):
-                file_name = Path(path).name
-                self.send_file(path, file_name)
+            # Small files are sent in bundles to avoid the cost of one transfer per file.
+            new_bundles = []
+            if self.settings.bundle_threshold > 0:
+                self.files_to_send, new_bundles = make_bundles(self.files_to_send, current_directory,
+                                                               self.settings.bundle_threshold,
+                                                               self.checkpoint.get_next_bundle_number())
 
-            elif os.path.isdir(path):
-                path_name = Path(path).name
-                try:
-                    self.sftp_connection.mkdir(path_name)
-                    logging.info("New directory created: " + path_name)
-                except Exception as e:
-                    raise ApplicationError(e)
+            # Large files are sent with delta, their signatures are kept for the next backup
+            if any(0 < self.settings.delta_threshold <= entry.size for entry, _ in self.files_to_send):
+                self.make_directory(SIGNATURES_DIRECTORY)
 
-                self.sftp_connection.chdir(path_name)
-                self.send_files(path)
-                self.sftp_connection.chdir('..')
+            self.send_files_with_channels(new_bundles)
 
-    def cleaning(self):
+            bundles += new_bundles
+            if bundles:
+                self.write_file(posixpath.join(current_directory, BUNDLE_INDEX_NAME), get_bundle_index(bundles))
+            if self.checkpoint.checksums:
+                self.write_file(posixpath.join(current_directory, CHECKSUMS_NAME),
+                                get_checksums_content(self.checkpoint.checksums))
+            if manifest is not None:
+                manifest.add_bundles(bundles)
+                manifest.add_checksums(self.checkpoint.checksums,
+                                       {entry.relative_path for entry in self.scan_index.entries
+                                        if entry.path in self.unreadable_paths})
+                self.write_manifest(manifest, current_directory)
+        finally:
+            self.checkpoint.close()
+
+        self.checkpoint.finish()
+
+    def send_archive(self, archive_name):
+        """
+        Send all the files in one compressed tar archive, produced while it is sent.
+        :param archive_name: Name of the archive on server.
+        """
+        self.infos.new_directory_name = archive_name
+        logging.info("Sending archive: " + archive_name)
+
+        start = time.monotonic()
+        with self.infos.measure_phase("transfer"), \
+                ArchiveStream(self.scan_index.entries, self.infos, self.settings.archive,
+                              self.settings.compression_level) as archive, \
+                self.sftp_connection.open(archive_name, 'wb') as remote_file:
+            remote_file.set_pipelined(True)
+            while True:
+                data = archive.read(self.settings.buffer_size)
+                if not data:
+                    break
+                remote_file.write(data)
+        self.infos.transfer_time += time.monotonic() - start
+
+        logging.info("Archive sent: " + str(archive.nb_bytes_read) + " bytes for " + str(self.infos.nb_file_copied) +
+                     " files (" + str(self.infos.nb_bytes_copied) + " bytes)")
+
+    def read_manifest(self, directory_name):
+        """
+        :param directory_name: Name of a backup directory.
+        :return: The manifest of the backup or None if it has no manifest.
+        """
+        try:
+            with self.sftp_connection.open(posixpath.join(directory_name, MANIFEST_NAME), 'rb') as remote_file:
+                remote_file.prefetch()
+                data = remote_file.read()
+        except IOError:
+            logging.info("No manifest in " + directory_name + ", all files will be sent")
+            return None
+        logging.info("Manifest of " + directory_name + " read")
+        return Manifest.from_bytes(data)
+
+    def write_manifest(self, manifest, backup_path):
+        """
+        :param manifest: Manifest of the new backup.
+        :param backup_path: Absolute path of the new backup directory.
+        """
+        self.write_file(posixpath.join(backup_path, MANIFEST_NAME), manifest.to_bytes())
+        logging.info("Manifest written in " + backup_path)
+
+    def write_file(self, path, data, sftp_connection=None):
+        """
+        Write a small file on server.
+        :param path: Absolute path of the file.
+        :param data: Content as bytes.
+        :param sftp_connection: channel to use, the main channel by default.
+        """
+        if sftp_connection is None:
+            sftp_connection = self.sftp_connection
+        with sftp_connection.open(path, 'wb') as remote_file:
+            remote_file.write(data)
+
+    def cleaning(self, in_progress_directory=None):
         """
         Save Rotation.
         Counts the number of backups in directory. If it is greater than limit, it delete old versions.
+        :param in_progress_directory: Name of an unfinished backup that will be resumed, it is not counted.
+        :return: List of the remaining backups, sorted from oldest to newest.
         """
-        entries = self.get_directories_in_path(self.sftp_connection.getcwd())
+        current_directory = self.sftp_connection.getcwd()
+        entries = [entry for entry in self.get_directories_in_path(current_directory)
+                   if entry.filename != in_progress_directory]
+        # sort files by date from oldest to newest
+        entries.sort(key=lambda f: f.st_mtime)
+
         if len(entries) >= int(self.settings.archiving_max):
             logging.info("Maximum backup (" + str(self.settings.archiving_max) + ") is reached: " + str(len(entries)))
 
-            while len(entries) >= int(self.settings.archiving_max):
-                # sort files by date from oldest to newest
-                entries.sort(key=lambda f: f.st_mtime)
-                oldest_name = entries[0].filename
+            nb_expired = len(entries) - int(self.settings.archiving_max) + 1
+            for entry in entries[:nb_expired]:
+                oldest_name = entry.filename
                 logging.info("Deleting directory: " + oldest_name)
-                self.remove_directories(oldest_name)
+                if stat.S_ISDIR(entry.st_mode):
+                    self.remove_directories(posixpath.join(current_directory, oldest_name))
+                else:
+                    # Backup saved as an archive
+                    self.sftp_connection.remove(posixpath.join(current_directory, oldest_name))
                 self.infos.deleted_directories.append(oldest_name)
-                entries = self.get_directories_in_path(self.sftp_connection.getcwd())
+            entries = entries[nb_expired:]
+
+        return entries
 
     def remove_directories(self, path):
         """
         Delete a directory recursively.
-        :param path: The path of directory to delete.
+        A "rm -rf" command is executed on the server if it is allowed. Else the tree is listed first, then files are
+        deleted concurrently over several channels.
+        :param path: The absolute path of directory to delete.
+        """
+        if self.server_side_delete and self.remove_with_command(path):
+            return
+
+        files = []
+        directories = []
+        self.list_tree(path, files, directories)
+
+        channels = self.get_channels(len(files))
+        logging.info("Deleting " + str(len(files)) + " files with " + str(len(channels)) + " channel(s)")
+        run_in_workers(channels, files, lambda channel, file: channel.remove(file))
+
+        # Subdirectories are listed before their parent, so they are empty when deleted.
+        for directory in directories:
+            self.sftp_connection.rmdir(directory)
+
+    def remove_with_command(self, path):
+        """
+        Delete a directory with a "rm -rf" executed on the server through the transport. The command is only executed
+        if the shell sees the directory at the same path as SFTP, a path of SFTP can be another directory for the
+        shell (chroot).
+        :param path: The absolute path of directory to delete.
+        :return: True if the directory does not exist anymore.
         """
-        files = self.sftp_connection.listdir(path)
-        for f in files:
-            filepath = os.path.join(path, f)
+        if self.is_seen_by_shell(path):
+            exit_status, _ = self.run_command("rm -rf -- " + shlex.quote(path), self.settings.command_timeout)
+            if exit_status is None:
+                raise ApplicationError("Server did not delete " + path + " in " + str(self.settings.command_timeout) +
+                                       " seconds")
             try:
-                self.sftp_connection.remove(filepath)
+                self.sftp_connection.stat(path)
             except IOError:
-                self.remove_directories(filepath)
-        self.sftp_connection.rmdir(path)
+                logging.info("Directory deleted by the server: " + path)
+                return True
+
+        logging.info("Server cannot delete directories with rm, files will be deleted one by one")
+        self.server_side_delete = False
+        return False
+
+    def run_command(self, command, timeout):
+        """
+        Execute a command on the server through the transport. Its standard input is closed: on accounts restricted
+        to SFTP (ForceCommand internal-sftp) the command is an SFTP server that would wait for requests forever.
+        :param command: Command for the shell of the server.
+        :param timeout: Seconds after which the command is abandoned.
+        :return: Tuple (exit status, standard output as bytes). Exit status is -1 if the command cannot be executed
+        and None if it did not end in time.
+        """
+        deadline = time.monotonic() + timeout
+        try:
+            channel = self.transport.open_session(timeout=timeout)
+        except paramiko.SSHException:
+            return -1, b''
+        try:
+            channel.settimeout(timeout)
+            channel.exec_command(command)
+            channel.shutdown_write()
+            output = b''
+            while True:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                output += data
+                if time.monotonic() > deadline:
+                    return None, output
+            while not channel.exit_status_ready():
+                if time.monotonic() > deadline:
+                    return None, output
+                time.sleep(0.05)
+            return channel.recv_exit_status(), output
+        except socket.timeout:
+            return None, b''
+        except paramiko.SSHException:
+            return -1, b''
+        finally:
+            channel.close()
+
+    def is_seen_by_shell(self, directory, sftp_connection=None):
+        """
+        Verify that the commands executed on the server see a directory of SFTP at the same path: a marker file is
+        created with SFTP and looked for by the shell.
+        :param directory: Absolute path of a directory on server, writable.
+        :param sftp_connection: channel to use, the main channel by default.
+        :return: True if the shell sees the marker file.
+        """
+        marker_name = ".marker_" + secrets.token_hex(8)
+        marker_path = posixpath.join(directory, marker_name)
+        try:
+            self.write_file(marker_path, b'', sftp_connection)
+        except IOError:
+            return False
+        try:
+            # The name is echoed: a forced command (ForceCommand internal-sftp) also ends with the exit status 0
+            exit_status, output = self.run_command("test -e " + shlex.quote(marker_path) + " && echo " + marker_name,
+                                                   SHELL_CHECK_TIMEOUT)
+        finally:
+            self.remove_file(marker_path, sftp_connection)
+        return exit_status == 0 and marker_name.encode() in output
+
+    def shell_sees_backup(self, sftp_connection):
+        """
+        :param sftp_connection: channel of the calling thread, a channel cannot be used by two threads at once.
+        :return: True if the commands executed on the server see the files of the new backup. Verified once per run.
+        """
+        with self.shell_lock:
+            if self.shell_sees_files is None:
+                self.shell_sees_files = self.is_seen_by_shell(self.backup_path, sftp_connection)
+                if not self.shell_sees_files:
+                    logging.info("Commands executed on the server do not see the files of SFTP, they are not used")
+            return self.shell_sees_files
+
+    def list_tree(self, path, files, directories):
+        """
+        List a directory recursively.
+        :param path: The absolute path of directory to list.
+        :param files: List filled with the paths of the files.
+        :param directories: List filled with the paths of the directories, subdirectories first.
+        """
+        for entry in self.get_directories_in_path(path):
+            entry_path = posixpath.join(path, entry.filename)
+            if stat.S_ISDIR(entry.st_mode):
+                self.list_tree(entry_path, files, directories)
+            else:
+                files.append(entry_path)
+        directories.append(path)
 
     def get_directories_in_path(self, path):
         """
@@ -145,41 +465,375 @@ class SftpSave:
         directories_in_path = self.sftp_connection.listdir_attr(path=path)
         return directories_in_path
 
-    def send_files(self, path):
+    def enter_directory(self, name):
         """
-        Copy files recursively. Creates the subdirectories if necessary.
-        :param path: path to save.
+        :param name: Name of a directory in the current directory.
+        :return: True if the directory exists and is now the current directory.
         """
         try:
-            for name in os.listdir(path):
-                local_path = os.path.join(path, name)
-                if os.path.isfile(local_path):
-                    self.send_file(local_path, name)
-                elif os.path.isdir(local_path):
-                    try:
-                        self.sftp_connection.mkdir(name)
-                        logging.info("New directory created" + local_path + name)
-
-                    # ignore "directory already exists"
-                    except paramiko.__all__ as e:
-                        raise ApplicationError(e)
-
-                    self.sftp_connection.chdir(name)
-                    self.send_files(local_path)
-                    self.sftp_connection.chdir("..")
+            self.sftp_connection.chdir(name)
+        except IOError:
+            return False
+        logging.info("Positioned in: " + self.sftp_connection.getcwd())
+        return True
 
-        except PermissionError:
-            logging.warning("Cannot copy: " + path + " PERMISSION DENIED")
+    def remove_file(self, path, sftp_connection=None):
+        """
+        Delete a file if it exists.
+        :param path: Absolute path of the file.
+        :param sftp_connection: channel to use, the main channel by default.
+        """
+        if sftp_connection is None:
+            sftp_connection = self.sftp_connection
+        try:
+            sftp_connection.remove(path)
+        except IOError:
+            pass
+
+    def make_directory(self, path):
+        """
+        Create a directory in the current directory.
+        :param path: Relative path of the directory, its parent must exist.
+        """
+        try:
+            self.sftp_connection.mkdir(path)
+            file_events.info("New directory created: " + path)
+        except IOError as e:
+            # A resumed backup already contains its directories
+            try:
+                if stat.S_ISDIR(self.sftp_connection.stat(path).st_mode):
+                    return
+            except IOError:
+                pass
+            raise ApplicationError(str(e))
+
+    def send_files_with_channels(self, bundles):
+        """
+        Send the listed files and the bundles by spreading them across several SFTP channels opened on the same
+        transport. Only one SSH handshake is done, each channel has its own file in flight.
+        :param bundles: List of Bundle to send.
+        """
+        jobs = bundles + self.files_to_send
+        channels = self.get_channels(len(jobs))
+        logging.info("Sending " + str(len(self.files_to_send)) + " files and " + str(len(bundles)) + " bundles with " +
+                     str(len(channels)) + " channel(s)")
+
+        start = time.monotonic()
+        with self.infos.measure_phase("transfer"):
+            run_pipeline(channels, jobs, self.send_job, self.get_job_path, self.settings.read_ahead)
+        self.infos.transfer_time += time.monotonic() - start
+
+        files_per_second, mb_per_second = self.infos.get_throughput()
+        logging.info("Transfer terminated: {:.1f} files/s, {:.2f} MB/s".format(files_per_second, mb_per_second))
+
+    def get_job_path(self, job):
+        """
+        :param job: Bundle or tuple (scan index entry, absolute path on server).
+        :return: Path of the local file read in advance by the pipeline, None for a bundle.
+        """
+        return None if isinstance(job, Bundle) else job[0].path
+
+    def send_job(self, sftp_connection, job, local_file=None):
+        """
+        :param sftp_connection: channel to use.
+        :param job: Bundle or tuple (scan index entry, absolute path on server).
+        :param local_file: ReadAheadFile of the file given by the pipeline, or None.
+        """
+        if isinstance(job, Bundle):
+            self.checkpoint.bundle_started(job)
+            checksum = self.send_bundle(job, sftp_connection)
+            self.checkpoint.bundle_done(job, checksum)
+        else:
+            entry, remote_path = job
+            resumed = self.checkpoint.is_partially_sent(entry)
+            self.checkpoint.file_started(entry)
+            if 0 < self.settings.delta_threshold <= entry.size:
+                checksum = self.send_file_with_delta(entry, remote_path, sftp_connection, resumed, local_file)
+            else:
+                offset = self.get_resume_offset(entry, remote_path, sftp_connection) if resumed else 0
+                checksum = self.send_file(entry.path, remote_path, sftp_connection, offset, local_file)
+            # A file that cannot be read is tried again if the backup is resumed
+            if entry.path not in self.unreadable_paths:
+                self.checkpoint.file_done(entry, checksum)
+
+    def get_resume_offset(self, entry, remote_path, sftp_connection):
+        """
+        :param entry: Scan index entry of a file partially sent by an interrupted backup.
+        :param remote_path: Absolute path of the file on server.
+        :param sftp_connection: channel to use.
+        :return: Number of bytes of the file already on server, 0 to send it again.
+        """
+        offset = self.get_remote_size(remote_path, sftp_connection)
+        return offset if offset <= entry.size else 0
+
+    def send_bundle(self, bundle, sftp_connection):
+        """
+        Send a bundle, the tar file is produced while it is sent.
+        :param bundle: Bundle to send.
+        :param sftp_connection: channel to use.
+        :return: SHA-256 of the bundle.
+        """
+        file_events.info("Sending " + bundle.name + " (" + str(len(bundle.entries)) + " files)")
+        with ArchiveStream(bundle.entries, self.infos, None, 0) as archive, \
+                sftp_connection.open(bundle.remote_path, 'wb') as remote_file:
+            hashing_file = HashingFile(archive)
+            remote_file.set_pipelined(True)
+            while True:
+                data = hashing_file.read(self.settings.buffer_size)
+                if not data:
+                    break
+                remote_file.write(data)
+        self.unreadable_paths.update(archive.unreadable_paths)
+        self.verify_file(sftp_connection, bundle.remote_path, bundle.name, hashing_file)
+        return hashing_file.get_checksum()
+
+    def get_remote_size(self, path, sftp_connection):
+        """
+        :param path: Absolute path of a file on server.
+        :param sftp_connection: channel to use.
+        :return: Size of the file on server, 0 if it does not exist.
+        """
+        try:
+            return sftp_connection.stat(path).st_size
+        except IOError:
+            return 0
 
-    def send_file(self, path, file_name):
+    def send_file(self, path, file_name, sftp_connection=None, offset=0, local_file=None):
         """
         Copy one file to server.
+        Writes are pipelined: they do not wait for the acknowledgement of the server before sending the next block.
         :param path: String path of the local file.
-        :param file_name: name of the file.
+        :param file_name: name of the file, or its absolute path on server.
+        :param sftp_connection: channel to use, the main channel by default.
+        :param offset: Number of bytes already on server, the remote file is completed from there.
+        :param local_file: ReadAheadFile of the file read by the pipeline, the file is opened here if None.
         """
+        if sftp_connection is None:
+            sftp_connection = self.sftp_connection
         try:
-            logging.info("Sending " + path)
-            self.sftp_connection.putfo(open(path, 'rb'), file_name)
-            self.infos.nb_file_copied += 1
+            start = time.monotonic()
+            with local_file if local_file is not None else open(path, 'rb') as file, \
+                    sftp_connection.open(file_name, 'r+b' if offset else 'wb') as remote_file:
+                # The checksum is computed while the file is read for the upload
+                hashing_file = HashingFile(file)
+                if offset:
+                    file_events.info("Resuming " + path + " at byte " + str(offset))
+                    hashing_file.seek(offset)
+                    remote_file.seek(offset)
+                else:
+                    file_events.info("Sending " + path)
+                remote_file.set_pipelined(True)
+                while True:
+                    data = hashing_file.read(self.settings.buffer_size)
+                    if not data:
+                        break
+                    remote_file.write(data)
+                self.infos.add_file_copied(file.tell() - offset, path, time.monotonic() - start)
+        except PermissionError:
+            logging.warning("Cannot copy: " + path + " PERMISSION DENIED")
+            self.unreadable_paths.add(path)
+            return None
+        # Verified once the remote file is closed, all the pipelined writes are acknowledged
+        self.verify_file(sftp_connection, file_name, path, hashing_file)
+        return hashing_file.get_checksum()
+
+    def send_file_with_delta(self, entry, remote_path, sftp_connection, resumed, local_file=None):
+        """
+        Copy one large file to server by sending only the blocks that changed since the previous backup.
+        The previous version is copied on the server with cp, then the blocks whose SHA-256 is not in its signature
+        are written at their offset. Without a previous version or cp, the whole file is sent. In both cases the
+        signature of the new version is written for the next backup.
+        :param entry: Scan index entry of the file.
+        :param remote_path: Absolute path of the file on server.
+        :param sftp_connection: channel to use.
+        :param resumed: True if an interrupted backup already sent a part of the file.
+        :param local_file: ReadAheadFile of the file read by the pipeline, the file is opened here if None.
+        :return: SHA-256 of the file.
+        """
+        path = entry.path
+        relative_path = posixpath.relpath(remote_path, self.backup_path)
+        signature = Signature()
+        nb_bytes_sent = 0
+        try:
+            start = time.monotonic()
+            with local_file if local_file is not None else open(path, 'rb') as file:
+                # The previous version is copied once the local file is opened, it is not kept if it cannot be read
+                previous_signature = self.get_previous_version(relative_path, remote_path, sftp_connection, resumed)
+                offset = 0
+                if previous_signature is not None:
+                    file_events.info("Sending " + path + " with delta")
+                elif resumed:
+                    offset = self.get_resume_offset(entry, remote_path, sftp_connection)
+                    file_events.info("Resuming " + path + " at byte " + str(offset))
+                else:
+                    file_events.info("Sending " + path)
+
+                with sftp_connection.open(remote_path, 'r+b' if previous_signature or offset else 'wb') as remote_file:
+                    hashing_file = HashingFile(file)
+                    remote_file.set_pipelined(True)
+                    while True:
+                        data = hashing_file.read(DELTA_BLOCK_SIZE)
+                        if not data:
+                            break
+                        position = signature.size
+                        digest = signature.add_block(data)
+                        # Blocks already sent by the interrupted backup or unchanged in the previous version
+                        if signature.size <= offset or previous_signature is not None \
+                                and previous_signature.is_block_unchanged(len(signature.digests) - 1, digest):
+                            continue
+                        remote_file.seek(position)
+                        remote_file.write(data)
+                        nb_bytes_sent += len(data)
+                    # The previous version or the interrupted transfer can be longer
+                    remote_file.truncate(signature.size)
+                self.infos.add_file_copied(nb_bytes_sent, path, time.monotonic() - start)
         except PermissionError:
             logging.warning("Cannot copy: " + path + " PERMISSION DENIED")
+            self.unreadable_paths.add(path)
+            return None
+
+        if previous_signature is not None:
+            self.infos.add_file_delta(signature.size - nb_bytes_sent)
+            file_events.info("Delta of " + path + ": " + str(nb_bytes_sent) + " of " + str(signature.size) +
+                             " bytes sent")
+        with sftp_connection.open(get_signature_path(self.backup_path, relative_path), 'wb') as remote_file:
+            remote_file.write(signature.to_bytes())
+        self.verify_file(sftp_connection, remote_path, path, hashing_file)
+        return hashing_file.get_checksum()
+
+    def get_previous_version(self, relative_path, remote_path, sftp_connection, resumed):
+        """
+        Put the previous version of a file at its place in the new backup, copied by the server.
+        :param relative_path: Path of the file in the backup.
+        :param remote_path: Absolute path of the file in the new backup.
+        :param sftp_connection: channel to use.
+        :param resumed: True if an interrupted backup already sent a part of the file.
+        :return: Signature of the previous version, or None if the file must be sent entirely.
+        """
+        location = get_previous_location(relative_path, self.previous_directories, self.previous_manifest)
+        if location is None or not self.remote_copy:
+            return None
+        previous_backup_path = posixpath.join(posixpath.dirname(self.backup_path), location)
+        if previous_backup_path == self.backup_path:
+            return None
+        try:
+            with sftp_connection.open(get_signature_path(previous_backup_path, relative_path), 'rb') as remote_file:
+                remote_file.prefetch()
+                previous_signature = Signature.from_bytes(remote_file.read())
+        except IOError:
+            return None
+        if previous_signature is None:
+            return None
+
+        # An interrupted delta already copied the previous version, its blocks are either old or new ones
+        if resumed and self.get_remote_size(remote_path, sftp_connection) >= previous_signature.size:
+            return previous_signature
+        previous_path = posixpath.join(previous_backup_path, relative_path)
+        if not self.copy_remote_file(previous_path, remote_path, previous_signature.size, sftp_connection):
+            return None
+        return previous_signature
+
+    def copy_remote_file(self, source, destination, size, sftp_connection):
+        """
+        Copy a file on the server with a cp command executed through the transport, the data does not go through the
+        network. The copy shares the blocks of the source on file systems that support it (btrfs, xfs).
+        :param source: Absolute path of the file to copy.
+        :param destination: Absolute path of the copy.
+        :param size: Size of the source.
+        :param sftp_connection: channel used to verify the copy.
+        :return: True if the copy exists.
+        """
+        if not self.shell_sees_backup(sftp_connection):
+            self.remote_copy = False
+            return False
+        command = "cp --reflink=auto -- {0} {1} 2>/dev/null || cp -- {0} {1}".format(shlex.quote(source),
+                                                                                    shlex.quote(destination))
+        exit_status, _ = self.run_command(command, self.settings.command_timeout)
+        if exit_status is None:
+            # cp can still be writing the file, it cannot be sent again
+            raise ApplicationError("Server did not copy " + source + " in " + str(self.settings.command_timeout) +
+                                   " seconds")
+
+        if exit_status == 0 and self.get_remote_size(destination, sftp_connection) == size:
+            return True
+        if self.remote_copy:
+            logging.info("Server cannot copy files with cp, large files will be sent entirely")
+        self.remote_copy = False
+        return False
+
+    def get_remote_checksum(self, method, sftp_connection, remote_path):
+        """
+        :param method: check-file (extension of the SFTP protocol) or sha256sum (command executed on the server).
+        :param sftp_connection: channel to use.
+        :param remote_path: Absolute path of the file on server.
+        :return: SHA-256 of the file computed by the server, None if the server cannot compute it.
+        """
+        if method == 'check-file':
+            try:
+                with sftp_connection.open(remote_path, 'rb') as remote_file:
+                    return remote_file.check('sha256').hex()
+            except (IOError, paramiko.SSHException):
+                return None
+
+        exit_status, output = self.run_command("sha256sum -- " + shlex.quote(remote_path),
+                                               self.settings.command_timeout)
+        return find_checksum(output.decode('utf-8', errors='replace'), 64) if exit_status == 0 else None
+
+    def get_verification(self, sftp_connection, remote_path):
+        """
+        Choose the method used to verify the files, by trying them on the first file sent. Done once per run.
+        :param sftp_connection: channel to use.
+        :param remote_path: Absolute path of a file sent.
+        :return: check-file, sha256sum or read.
+        """
+        with self.verification_lock:
+            if self.verification is None:
+                self.verification = 'read'
+                # sha256sum would compute the checksum of another file if the shell does not see the files of SFTP
+                methods = ['check-file', 'sha256sum'] if self.shell_sees_backup(sftp_connection) else ['check-file']
+                for method in methods:
+                    if self.get_remote_checksum(method, sftp_connection, remote_path) is not None:
+                        self.verification = method
+                        break
+                logging.info("Files verified with " + self.verification)
+            return self.verification
+
+    def verify_file(self, sftp_connection, remote_path, path, hashing_file):
+        """
+        Compare the checksum of a file on server with the one computed while it was sent, if verify is YES.
+        If the server cannot compute checksums, only a sample of the files is read back.
+        :param sftp_connection: channel to use.
+        :param remote_path: Absolute path of the file on server.
+        :param path: Path of the local file, or name of the bundle, for the logs.
+        :param hashing_file: HashingFile that read the file.
+        """
+        if self.settings.verify != "YES":
+            return
+        verification = self.get_verification(sftp_connection, remote_path)
+        if verification != 'read':
+            checksum = self.get_remote_checksum(verification, sftp_connection, remote_path)
+            if checksum is None:
+                logging.warning("Cannot verify: " + path + " the server did not give its checksum")
+                return
+        else:
+            if not is_sampled(self.settings.verify_sample):
+                return
+            sha256 = hashlib.sha256()
+            try:
+                with sftp_connection.open(remote_path, 'rb') as remote_file:
+                    remote_file.prefetch()
+                    while True:
+                        data = remote_file.read(self.settings.buffer_size)
+                        if not data:
+                            break
+                        sha256.update(data)
+            except IOError as e:
+                logging.warning("Cannot verify: " + path + " " + str(e))
+                return
+            checksum = sha256.hexdigest()
+
+        expected = hashing_file.get_checksum()
+        self.infos.add_file_verified(path, checksum == expected)
+        if checksum != expected:
+            logging.warning("Checksum mismatch: " + path + " is different on server (" + str(checksum) +
+                            " instead of " + expected + ")")
@@ -1,12 +1,23 @@
+import gzip
+import io
 import logging
+import os
+import shutil
 import smtplib
 import ssl
-from copy import deepcopy
-from email import encoders
-from email.mime.base import MIMEBase
+from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+# Maximum size of each log file attached to the mail, before compression. Only the end of bigger logs is attached.
+ATTACHMENT_MAX_SIZE = 20 * 1024 * 1024
+
+# Number of lines at the end of the logs written in the body of the mail.
+NB_TAIL_LINES = 20
+
+# Number of bytes read at the end of a log to find its last lines.
+TAIL_MAX_SIZE = 64 * 1024
+
 
 class MailSender:
     def __init__(self, settings, infos):
@@ -28,15 +39,17 @@ class MailSender:
         else:
             message["Subject"] = self.settings.title + " SUCCESS"
 
-            if get_nb_lines(self.infos.script_path + '/' + "warning.log") > 0:
-                body += "\nBUT there are some warnings, please look at warning.log !"
-
             directories_saved = '\n'.join(self.settings.paths_to_save)
             body = "Backup started at {} has succeeded. \n" \
-                   "These directories/files have been saved : \n{}\nFor a total of {} files.".format(
+                   "These directories/files have been saved : \n{}\nFor a total of {} files ({} bytes).".format(
                     self.infos.start_time,
                     directories_saved,
-                    self.infos.nb_file_copied)
+                    self.infos.nb_file_copied,
+                    self.infos.nb_bytes_copied)
+
+            if self.infos.transfer_time > 0:
+                files_per_second, mb_per_second = self.infos.get_throughput()
+                body += "\nTransfer speed: {:.1f} files/s, {:.2f} MB/s.".format(files_per_second, mb_per_second)
 
             # Add deleted directories to mail
             if len(self.infos.deleted_directories) > 0:
@@ -45,32 +58,49 @@ class MailSender:
             if self.infos.new_directory_name != "":
                 body += "\nNew directory {} have been created.".format(self.infos.new_directory_name)
 
+            if has_content(os.path.join(self.infos.script_path, "warning.log")):
+                body += "\nBUT there are some warnings, please look at warning.log !"
+
+        # Files whose checksum on server is not the one computed while they were sent
+        if self.infos.checksum_mismatches:
+            body += "\n{} of the {} verified files are different on server:\n{}".format(
+                len(self.infos.checksum_mismatches), self.infos.nb_file_verified,
+                '\n'.join(self.infos.checksum_mismatches[:NB_TAIL_LINES]))
+            if len(self.infos.checksum_mismatches) > NB_TAIL_LINES:
+                body += "\n... the others are in warning.log"
+
+        # Summary of the metrics, all of them are in report.json
+        if self.infos.phases:
+            body += "\nTime spent: " + ", ".join("{} {:.1f}s".format(name, seconds)
+                                                for name, seconds in self.infos.phases.items())
+        slowest_files = self.infos.get_slowest_files()
+        if slowest_files:
+            seconds, path, nb_bytes = slowest_files[0]
+            body += "\nSlowest file: {} ({} bytes in {:.1f}s).".format(path, nb_bytes, seconds)
+
+        # Last lines of the logs, to see what happened without opening the attachments
+        for filename in ["error.log", "application.log"]:
+            tail = get_tail(os.path.join(self.infos.script_path, filename), NB_TAIL_LINES)
+            if tail:
+                body += "\n\nLast lines of {}:\n{}".format(filename, tail)
+
         message.attach(MIMEText(body, "plain"))
 
         files = ["application.log", "error.log", "warning.log"]
         for filename in files:
             try:
                 # We assume that the file is in the directory where you run your Python script from
-                with open(self.infos.script_path + '/' + filename, "rb") as attachment:
-                    # The content type "application/octet-stream" means that a MIME attachment is a binary file
-                    part = MIMEBase("application", "octet-stream")
-                    part.set_payload(attachment.read())
-
-                # Encode to base64
-                encoders.encode_base64(part)
-
-                # Add header
-                part.add_header(
-                    "Content-Disposition",
-                    f"attachment; filename= {filename}",
-                )
-
-                # Add attachment to your message and convert it to string
+                part = MIMEApplication(get_compressed_log(os.path.join(self.infos.script_path, filename)), "gzip")
+                part.add_header("Content-Disposition", "attachment", filename=filename + ".gz")
                 message.attach(part)
 
             except Exception as e:
                 logging.warning("{} can't be attached".format(filename))
 
+        # The message is built once and sent to all the recipients in one transaction
+        message["To"] = ", ".join(self.settings.email_recipients)
+        text = message.as_bytes()
+
         server = None
         try:
             # Send email with TLS or not
@@ -86,28 +116,61 @@ class MailSender:
                 server = smtplib.SMTP(self.settings.smtp_server, self.settings.email_port)
                 server.login(self.settings.sender_login, self.settings.sender_password)
 
+            refused = server.sendmail(self.settings.sender_email, self.settings.email_recipients, text)
             for recipient in self.settings.email_recipients:
-                temp_message = deepcopy(message)
-                temp_message["To"] = recipient
-                text = temp_message.as_string()
-                server.sendmail(self.settings.sender_email, recipient, text)
-                logging.info("Email sent to {}".format(recipient))
+                if recipient in refused:
+                    logging.warning("Email refused for {}: {}".format(recipient, refused[recipient]))
+                else:
+                    logging.info("Email sent to {}".format(recipient))
 
         except Exception as e:
             # Print any error messages to stdout
             print(e)
         finally:
-            server.quit()
+            if server is not None:
+                server.quit()
+
+
+def get_compressed_log(path):
+    """
+    Compress a log file. Only the end of big files is kept, so the memory used does not depend on the size of the log.
+    :param path: of the file
+    :return: bytes of the gzip file.
+    """
+    compressed = io.BytesIO()
+    with open(path, 'rb') as log_file, gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_file:
+        log_file.seek(0, os.SEEK_END)
+        size = log_file.tell()
+        if size > ATTACHMENT_MAX_SIZE:
+            gzip_file.write("[{} first bytes removed]\n".format(size - ATTACHMENT_MAX_SIZE).encode('utf-8'))
+        log_file.seek(max(0, size - ATTACHMENT_MAX_SIZE))
+        shutil.copyfileobj(log_file, gzip_file, 1024 * 1024)
+    return compressed.getvalue()
+
+
+def get_tail(path, nb_lines):
+    """
+    Get the last lines of a file without reading all of it.
+    :param path: of the file
+    :param nb_lines: number of lines.
+    :return: String that contains the last lines, empty if the file does not exist.
+    """
+    try:
+        with open(path, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            file.seek(max(0, file.tell() - TAIL_MAX_SIZE))
+            lines = file.read().splitlines()[-nb_lines:]
+    except OSError:
+        return ""
+    return "\n".join(line.decode('utf-8', errors='replace') for line in lines)
 
 
-def get_nb_lines(path):
+def has_content(path):
     """
-    Get the number of lines in a file.
     :param path: of the file
-    :return: int number of file.
+    :return: True if the file exists and is not empty.
     """
-    i = 0
-    with open(path) as f:
-        for i, l in enumerate(f, 1):
-            pass
-    return i
+    try:
+        return os.path.getsize(path) > 0
+    except OSError:
+        return False
@@ -0,0 +1,107 @@
+import contextlib
+import gzip
+import logging
+import lzma
+import os
+import tarfile
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from main.utils.profile_logging import in_current_context
+
+# Extension of the archives for each compression.
+ARCHIVE_EXTENSIONS = {'gz': '.tar.gz', 'xz': '.tar.xz', 'zst': '.tar.zst'}
+
+
+def is_compression_available(compression):
+    """
+    :param compression: 'gz', 'xz' or 'zst'.
+    :return: True if the compression can be used. zst needs the zstandard module.
+    """
+    if compression == 'zst':
+        return zstandard is not None
+    return compression in ARCHIVE_EXTENSIONS
+
+
+class ArchiveStream:
+    """
+    Tar archive of scan index entries, compressed or not, produced on the fly.
+    A thread writes the archive in a pipe, the other end is a file object that can be uploaded directly.
+    Nothing is written on the local disk.
+    """
+
+    def __init__(self, entries, infos, compression, level):
+        """
+        Constructor.
+        :param entries: Scan index entries of the files and directories to archive.
+        :param infos: Object that contains the information about what happens.
+        :param compression: 'gz', 'xz', 'zst' or None for a tar without compression.
+        :param level: Compression level.
+        """
+        self.entries = entries
+        self.infos = infos
+        self.compression = compression
+        self.level = level
+        self.unreadable_paths = []  # Local paths of the files that could not be read
+        self.reader = None
+        self.thread = None
+        self.error = None
+        self.nb_bytes_read = 0
+
+    def __enter__(self):
+        read_fd, write_fd = os.pipe()
+        self.reader = os.fdopen(read_fd, 'rb')
+        self.thread = threading.Thread(target=in_current_context(self.write_archive), args=(os.fdopen(write_fd, 'wb'),),
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Closing the reader stops the thread if the upload failed
+        self.reader.close()
+        self.thread.join()
+        if exc_type is None and self.error is not None:
+            raise self.error
+
+    def read(self, size=-1):
+        data = self.reader.read(size)
+        self.nb_bytes_read += len(data)
+        return data
+
+    def write_archive(self, pipe):
+        """
+        Write the archive in the pipe. Runs in its own thread.
+        :param pipe: File object of the write end of the pipe.
+        """
+        try:
+            # Symbolic links are followed like in the scan, the archive contains the files they point to
+            with pipe, self.open_compressor(pipe) as compressor, \
+                    tarfile.open(fileobj=compressor, mode='w|', format=tarfile.PAX_FORMAT,
+                                 dereference=True) as archive:
+                for entry in self.entries:
+                    try:
+                        archive.add(entry.path, arcname=entry.relative_path, recursive=False)
+                        if entry.type == 'file':
+                            self.infos.add_file_copied(entry.size)
+                    except PermissionError:
+                        logging.warning("Cannot copy: " + entry.path + " PERMISSION DENIED")
+                        self.unreadable_paths.append(entry.path)
+        except Exception as e:
+            self.error = e
+
+    def open_compressor(self, pipe):
+        """
+        :param pipe: File object where compressed data is written.
+        :return: File object that compresses what is written in it.
+        """
+        if self.compression is None:
+            return contextlib.nullcontext(pipe)
+        if self.compression == 'gz':
+            return gzip.GzipFile(fileobj=pipe, mode='wb', compresslevel=self.level)
+        if self.compression == 'xz':
+            return lzma.LZMAFile(pipe, mode='wb', preset=self.level)
+        return zstandard.ZstdCompressor(level=self.level).stream_writer(pipe, closefd=False)
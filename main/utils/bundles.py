@@ -0,0 +1,67 @@
+import logging
+import posixpath
+
+# Index of the bundles, written in the backup directory. One line per file: bundle name, tabulation, file path.
+BUNDLE_INDEX_NAME = "bundles.index"
+
+# Maximum size of the files in one bundle.
+BUNDLE_MAX_SIZE = 64 * 1024 * 1024
+
+# Size of a tar header, each file in a bundle also uses at most one more block of padding.
+TAR_BLOCK_SIZE = 512
+
+
+class Bundle:
+    """
+    Tar file that contains small files. Files are stored with their path in the backup, so extracting all the bundles
+    in the backup directory (tar -xf bundle_0.tar) gives the complete tree.
+    """
+
+    def __init__(self, name, remote_path):
+        """
+        Constructor.
+        :param name: Name of the bundle, e.g. bundle_0.tar
+        :param remote_path: Absolute path of the bundle on server.
+        """
+        self.name = name
+        self.remote_path = remote_path
+        self.entries = []
+        self.size = 0
+
+
+def make_bundles(files_to_send, backup_path, threshold, first_number=0):
+    """
+    Put the files smaller than the threshold in bundles.
+    :param files_to_send: List of tuples (scan index entry, absolute path on server).
+    :param backup_path: Absolute path of the new backup directory on server.
+    :param threshold: Files smaller than this size in bytes are bundled.
+    :param first_number: Number of the first bundle, bundles of a resumed backup keep their names.
+    :return: Tuple (list of tuples (scan index entry, absolute path on server) of the files to send alone,
+    list of Bundle).
+    """
+    large_files = []
+    bundles = []
+    for entry, remote_path in files_to_send:
+        if entry.size >= threshold:
+            large_files.append((entry, remote_path))
+            continue
+
+        file_size = entry.size + 2 * TAR_BLOCK_SIZE
+        if not bundles or bundles[-1].size + file_size > BUNDLE_MAX_SIZE:
+            name = "bundle_" + str(first_number + len(bundles)) + ".tar"
+            bundles.append(Bundle(name, posixpath.join(backup_path, name)))
+        bundles[-1].entries.append(entry)
+        bundles[-1].size += file_size
+
+    logging.info(str(sum(len(bundle.entries) for bundle in bundles)) + " small files put in " + str(len(bundles)) +
+                 " bundles, " + str(len(large_files)) + " files sent alone")
+    return large_files, bundles
+
+
+def get_bundle_index(bundles):
+    """
+    :param bundles: List of Bundle.
+    :return: Content of the index as bytes.
+    """
+    lines = [bundle.name + '\t' + entry.relative_path for bundle in bundles for entry in bundle.entries]
+    return ('\n'.join(lines) + '\n').encode('utf-8')
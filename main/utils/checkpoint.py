@@ -0,0 +1,199 @@
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import threading
+
+from main.utils.bundles import Bundle, TAR_BLOCK_SIZE
+
+# Directory of the journals of unfinished backups, next to the log files.
+CHECKPOINT_DIRECTORY = "checkpoints"
+
+
+class Checkpoint:
+    """
+    Local journal of a backup sent to a server. Each file is recorded when it starts and when it is sent, one JSON
+    line at a time, so if the connection is lost the next run resumes the same backup directory instead of sending
+    everything again. The journal is deleted when the backup is complete.
+    """
+
+    def __init__(self, settings):
+        """
+        Constructor. There is one journal for each server and directory to save in.
+        :param settings: Object that contains the information about server, path to save, usernames...
+        """
+        destination = settings.save_mode + " " + settings.server_ip_address + " " + str(settings.port) + " " + \
+            settings.directory_to_save_in
+        self.path = os.path.join(CHECKPOINT_DIRECTORY,
+                                 hashlib.sha1(destination.encode('utf-8')).hexdigest() + ".journal")
+        self.directory_name = None
+        self.started = {}  # relative path -> (size, mtime) of the files that started to be sent
+        self.done = {}  # relative path -> (size, mtime) of the files sent
+        self.bundles_started = set()
+        self.bundles_done = {}  # bundle name -> list of [relative path, size, mtime]
+        self.checksums = {}  # relative path of the files and names of the bundles sent -> SHA-256
+        self.created_directories = set()  # relative paths of the directories created in the backup
+        self.journal = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Read the journal of the previous run.
+        :return: Name of the unfinished backup directory or None if the previous backup was complete.
+        """
+        try:
+            with open(self.path, encoding='utf-8') as journal:
+                lines = journal.readlines()
+        except FileNotFoundError:
+            return None
+
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line is incomplete if the application was killed while writing it
+                continue
+            if 'directory' in record:
+                self.directory_name = record['directory']
+            elif 'started' in record:
+                self.started[record['started']] = (record['size'], record['mtime'])
+            elif 'done' in record:
+                self.done[record['done']] = (record['size'], record['mtime'])
+                if 'sha256' in record:
+                    self.checksums[record['done']] = record['sha256']
+            elif 'directories_created' in record:
+                self.created_directories.update(record['directories_created'])
+            elif 'bundle_started' in record:
+                self.bundles_started.add(record['bundle_started'])
+            elif 'bundle_done' in record:
+                self.bundles_done[record['bundle_done']] = record['files']
+                if 'sha256' in record:
+                    self.checksums[record['bundle_done']] = record['sha256']
+
+        logging.info("Unfinished backup found: " + str(self.directory_name) + ", " + str(len(self.done)) +
+                     " files and " + str(len(self.bundles_done)) + " bundles already sent")
+        return self.directory_name
+
+    def start(self, directory_name):
+        """
+        Start the journal of a new backup, the journal of the previous one is replaced.
+        :param directory_name: Name of the new backup directory.
+        """
+        os.makedirs(CHECKPOINT_DIRECTORY, exist_ok=True)
+        self.directory_name = directory_name
+        self.started = {}
+        self.done = {}
+        self.bundles_started = set()
+        self.bundles_done = {}
+        self.checksums = {}
+        self.created_directories = set()
+        self.journal = open(self.path, 'w', encoding='utf-8')
+        self.write({'directory': directory_name})
+
+    def resume(self):
+        """
+        Continue the journal of the unfinished backup.
+        """
+        self.journal = open(self.path, 'a', encoding='utf-8')
+
+    def write(self, record):
+        """
+        Append a record to the journal. Called by several threads.
+        :param record: Dict written as one JSON line.
+        """
+        with self.lock:
+            self.journal.write(json.dumps(record) + '\n')
+            self.journal.flush()
+
+    def directories_created(self, relative_paths):
+        """
+        :param relative_paths: Paths of the directories created in the backup, they are not created again on resume.
+        """
+        self.created_directories.update(relative_paths)
+        self.write({'directories_created': relative_paths})
+
+    def file_started(self, entry):
+        self.write({'started': entry.relative_path, 'size': entry.size, 'mtime': entry.mtime})
+
+    def file_done(self, entry, checksum=None):
+        """
+        :param entry: Scan index entry of the file sent.
+        :param checksum: SHA-256 of the file sent, None if it was not sent.
+        """
+        record = {'done': entry.relative_path, 'size': entry.size, 'mtime': entry.mtime}
+        if checksum is not None:
+            record['sha256'] = checksum
+            self.checksums[entry.relative_path] = checksum
+        self.write(record)
+
+    def bundle_started(self, bundle):
+        self.write({'bundle_started': bundle.name})
+
+    def bundle_done(self, bundle, checksum=None):
+        record = {'bundle_done': bundle.name,
+                  'files': [[entry.relative_path, entry.size, entry.mtime] for entry in bundle.entries]}
+        if checksum is not None:
+            record['sha256'] = checksum
+            self.checksums[bundle.name] = checksum
+        self.write(record)
+
+    def is_partially_sent(self, entry):
+        """
+        :param entry: Scan index entry of a file.
+        :return: True if the previous run started to send this file and the file did not change since.
+        """
+        return entry.relative_path not in self.done and \
+            self.started.get(entry.relative_path) == (entry.size, entry.mtime)
+
+    def get_next_bundle_number(self):
+        """
+        :return: First number that was never used for a bundle of this backup.
+        """
+        names = self.bundles_started | set(self.bundles_done)
+        return max((int(name[len("bundle_"):-len(".tar")]) for name in names), default=-1) + 1
+
+    def filter_sent_files(self, files_to_send, backup_path):
+        """
+        Remove the files that were sent by the previous run and did not change since.
+        :param files_to_send: List of tuples (scan index entry, absolute path on server).
+        :param backup_path: Absolute path of the backup directory on server.
+        :return: Tuple (list of tuples (scan index entry, absolute path on server) of the files to send,
+        list of the Bundle already sent, list of the absolute paths of the bundles to delete on server).
+        Bundles to delete were not completely sent or contain files that changed.
+        """
+        files_by_path = {entry.relative_path: (entry, remote_path) for entry, remote_path in files_to_send}
+
+        bundles = []
+        bundles_to_delete = [posixpath.join(backup_path, name) for name in self.bundles_started
+                             if name not in self.bundles_done]
+        for name, files in self.bundles_done.items():
+            if not all(path in files_by_path and (files_by_path[path][0].size, files_by_path[path][0].mtime) ==
+                       (size, mtime) for path, size, mtime in files):
+                bundles_to_delete.append(posixpath.join(backup_path, name))
+                self.checksums.pop(name, None)
+                continue
+            bundle = Bundle(name, posixpath.join(backup_path, name))
+            for path, size, mtime in files:
+                bundle.entries.append(files_by_path.pop(path)[0])
+                bundle.size += size + 2 * TAR_BLOCK_SIZE
+            bundles.append(bundle)
+
+        remaining_files = [(entry, remote_path) for entry, remote_path in files_by_path.values()
+                           if self.done.get(entry.relative_path) != (entry.size, entry.mtime)]
+        if self.done or bundles:
+            logging.info("Resuming: " + str(len(files_to_send) - len(remaining_files)) + " files already sent, " +
+                         str(len(remaining_files)) + " files to send")
+        return remaining_files, bundles, bundles_to_delete
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def finish(self):
+        """
+        The backup is complete, the journal is deleted.
+        """
+        self.close()
+        os.remove(self.path)
@@ -0,0 +1,84 @@
+import hashlib
+import random
+import re
+import zlib
+
+# Checksums of the files of a backup, in the format of sha256sum: "sha256sum -c checksums.sha256" in the backup
+# directory verifies them.
+CHECKSUMS_NAME = "checksums.sha256"
+
+
+class HashingFile:
+    """
+    Compute the checksums of a file while it is read for the upload, so the file is read once.
+    """
+
+    def __init__(self, file):
+        """
+        Constructor.
+        :param file: Local file opened in binary mode, or ReadAheadFile.
+        """
+        self.file = file
+        self.sha256 = hashlib.sha256()
+        self.crc32 = 0  # Only some FTP servers can give a SHA-256, more of them give a CRC-32
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.sha256.update(data)
+        self.crc32 = zlib.crc32(data, self.crc32)
+        return data
+
+    def seek(self, offset):
+        """
+        Go to the offset by reading the beginning of the file, the checksums are always the ones of the whole file.
+        :param offset: New position, not before the current one.
+        """
+        while self.file.tell() < offset:
+            if not self.read(min(offset - self.file.tell(), 1024 * 1024)):
+                break
+        return self.file.tell()
+
+    def tell(self):
+        return self.file.tell()
+
+    def get_checksum(self):
+        """
+        :return: SHA-256 of the bytes read, in hexadecimal.
+        """
+        return self.sha256.hexdigest()
+
+    def get_crc(self):
+        """
+        :return: CRC-32 of the bytes read, in hexadecimal like XCRC.
+        """
+        return "{:08x}".format(self.crc32)
+
+
+def get_checksums_content(checksums):
+    """
+    :param checksums: Dict path in the backup -> SHA-256 in hexadecimal.
+    :return: Content of the checksums file as bytes.
+    """
+    lines = [checksum + '  ' + path for path, checksum in sorted(checksums.items())]
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def find_checksum(response, length):
+    """
+    Servers do not all format their answers the same way, e.g. "213 SHA-256 0-42 <hash> file" or "250 <hash>".
+    :param response: Answer of the server.
+    :param length: Number of hexadecimal digits of the checksum.
+    :return: The first word of the response that is a checksum, in lower case, or None.
+    """
+    for word in response.split():
+        if len(word) == length and re.fullmatch('[0-9a-fA-F]+', word):
+            return word.lower()
+    return None
+
+
+def is_sampled(percentage):
+    """
+    :param percentage: Percentage of the files read back from the server to verify them.
+    :return: True if this file is read back.
+    """
+    return random.random() * 100 < percentage
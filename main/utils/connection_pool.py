@@ -0,0 +1,72 @@
+import logging
+import threading
+import time
+
+
+class ConnectionPool:
+    """
+    Connections kept open between the backups of the daemon, so a backup to a server that was used recently does not
+    pay the connection and the authentication again. Connections are given back when a backup is done and closed if
+    they stay idle too long.
+    """
+
+    def __init__(self, max_idle_time):
+        """
+        Constructor.
+        :param max_idle_time: Seconds an idle connection is kept open.
+        """
+        self.max_idle_time = max_idle_time
+        self.idle = {}  # key -> list of tuples (connection, function that closes it, time it was given back)
+        self.lock = threading.Lock()
+
+    def take(self, key, is_alive):
+        """
+        Take an idle connection to a server, the connections closed by the server are dropped.
+        :param key: Tuple that identifies the server and the user, e.g. (save mode, address, port, username).
+        :param is_alive: Function that tells if a connection can still be used.
+        :return: The connection or None if there is no idle connection to this server.
+        """
+        while True:
+            with self.lock:
+                if not self.idle.get(key):
+                    return None
+                connection, close, _ = self.idle[key].pop()
+            if is_alive(connection):
+                return connection
+            close_quietly(connection, close)
+
+    def give_back(self, key, connection, close):
+        """
+        Keep a connection for the next backup to the same server.
+        :param key: Tuple that identifies the server and the user.
+        :param connection: Connection in the same state as a new one, e.g. in the home directory.
+        :param close: Function called with the connection to close it.
+        """
+        with self.lock:
+            self.idle.setdefault(key, []).append((connection, close, time.monotonic()))
+
+    def close_expired(self, max_idle_time=None):
+        """
+        Close the connections idle for more than max_idle_time.
+        :param max_idle_time: Seconds, 0 to close all the idle connections. Default is the one of the pool.
+        """
+        if max_idle_time is None:
+            max_idle_time = self.max_idle_time
+        deadline = time.monotonic() - max_idle_time
+        expired = []
+        with self.lock:
+            for key, connections in self.idle.items():
+                expired += [connection for connection in connections if connection[2] <= deadline]
+                connections[:] = [connection for connection in connections if connection[2] > deadline]
+        for connection, close, _ in expired:
+            close_quietly(connection, close)
+
+
+def close_quietly(connection, close):
+    """
+    Close a connection that may already be closed by the server.
+    """
+    try:
+        close(connection)
+    except Exception as e:
+        logging.debug("Idle connection closed with error: " + str(e))
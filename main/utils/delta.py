@@ -0,0 +1,92 @@
+import hashlib
+import posixpath
+import struct
+
+# Size of the blocks compared between two versions of a file.
+DELTA_BLOCK_SIZE = 256 * 1024
+
+# Directory of each backup that contains the signatures of its large files, one file per signature.
+SIGNATURES_DIRECTORY = ".signatures"
+
+# Header of a signature file: block size and size of the file, as unsigned 64 bits integers.
+HEADER = struct.Struct('>QQ')
+
+
+class Signature:
+    """
+    SHA-256 of each block of a file, stored in the backup next to the file. At the next backup, only the blocks of the
+    new version whose SHA-256 is different are sent, the other ones are copied on the server from the previous version.
+    """
+
+    def __init__(self, block_size=DELTA_BLOCK_SIZE, size=0, digests=None):
+        """
+        Constructor.
+        :param block_size: Size of the blocks, the last one can be smaller.
+        :param size: Size of the file.
+        :param digests: List of the SHA-256 of the blocks, as bytes.
+        """
+        self.block_size = block_size
+        self.size = size
+        self.digests = digests if digests is not None else []
+
+    def add_block(self, data):
+        """
+        :param data: Next block of the file.
+        :return: SHA-256 of the block.
+        """
+        digest = hashlib.sha256(data).digest()
+        self.digests.append(digest)
+        self.size += len(data)
+        return digest
+
+    def is_block_unchanged(self, index, digest):
+        """
+        :param index: Number of the block.
+        :param digest: SHA-256 of the block in the new version.
+        :return: True if the block is the same in this version.
+        """
+        return index < len(self.digests) and self.digests[index] == digest
+
+    def to_bytes(self):
+        return HEADER.pack(self.block_size, self.size) + b''.join(self.digests)
+
+    @staticmethod
+    def from_bytes(data):
+        """
+        :param data: Content of a signature file.
+        :return: The signature or None if the file is not a valid signature.
+        """
+        if len(data) < HEADER.size or (len(data) - HEADER.size) % 32:
+            return None
+        block_size, size = HEADER.unpack_from(data)
+        digests = [data[offset:offset + 32] for offset in range(HEADER.size, len(data), 32)]
+        if block_size != DELTA_BLOCK_SIZE or len(digests) != -(-size // block_size):
+            return None
+        return Signature(block_size, size, digests)
+
+
+def get_signature_path(backup_path, relative_path):
+    """
+    Signatures are in one directory, their names are the SHA-1 of the relative paths of the files.
+    :param backup_path: Absolute path of a backup directory on server.
+    :param relative_path: Path of the file in the backup.
+    :return: Absolute path of the signature of the file on server.
+    """
+    name = hashlib.sha1(relative_path.encode('utf-8')).hexdigest()
+    return posixpath.join(backup_path, SIGNATURES_DIRECTORY, name)
+
+
+def get_previous_location(relative_path, directories, previous_manifest):
+    """
+    Find the backup that contains the previous version of a file, sent alone and not in a bundle.
+    :param relative_path: Path of the file in the backup.
+    :param directories: Names of the backup directories, sorted from oldest to newest, without the new one.
+    :param previous_manifest: Manifest of the latest backup or None if it is not incremental.
+    :return: Name of the backup directory or None if there is no previous version.
+    """
+    if previous_manifest is not None:
+        previous = previous_manifest.files.get(relative_path)
+        if previous is None or 'bundle' in previous:
+            return None
+        return previous['location']
+    return directories[-1] if directories else None
@@ -0,0 +1,68 @@
+import errno
+import os
+import shutil
+
+# Maximum number of bytes copied by one system call.
+COPY_BLOCK_SIZE = 64 * 1024 * 1024
+
+# Errors meaning that the system call cannot be used for these files, another method must be tried.
+UNSUPPORTED_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+
+def copy_file_data(source, destination):
+    """
+    Copy the content of a file in the kernel, without reading it in Python.
+    Uses os.copy_file_range (can be a reflink or a server side copy), else os.sendfile, else a buffered copy.
+    :param source: path of the file to copy.
+    :param destination: path of the new file.
+    :return: Number of bytes copied.
+    """
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        source_fd = source_file.fileno()
+        destination_fd = destination_file.fileno()
+
+        for system_call in (copy_with_copy_file_range, copy_with_sendfile):
+            copied = system_call(source_fd, destination_fd)
+            if copied is not None:
+                return copied
+
+        shutil.copyfileobj(source_file, destination_file, 1024 * 1024)
+        return destination_file.tell()
+
+
+def copy_with_copy_file_range(source_fd, destination_fd):
+    """
+    :return: Number of bytes copied or None if copy_file_range cannot be used.
+    """
+    if not hasattr(os, 'copy_file_range'):
+        return None
+    offset = 0
+    try:
+        while True:
+            copied = os.copy_file_range(source_fd, destination_fd, COPY_BLOCK_SIZE, offset, offset)
+            if copied == 0:
+                return offset
+            offset += copied
+    except OSError as e:
+        if offset == 0 and e.errno in UNSUPPORTED_ERRORS:
+            return None
+        raise
+
+
+def copy_with_sendfile(source_fd, destination_fd):
+    """
+    :return: Number of bytes copied or None if sendfile cannot be used.
+    """
+    if not hasattr(os, 'sendfile'):
+        return None
+    offset = 0
+    try:
+        while True:
+            copied = os.sendfile(destination_fd, source_fd, offset, COPY_BLOCK_SIZE)
+            if copied == 0:
+                return offset
+            offset += copied
+    except OSError as e:
+        if offset == 0 and e.errno in UNSUPPORTED_ERRORS:
+            return None
+        raise
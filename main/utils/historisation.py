@@ -10,13 +10,15 @@ def get_new_name_by_date():
     return now.strftime("%Y%m%d_%H:%M:%S")
 
 
-def get_new_names_by_version(directories):
+def get_new_name_by_version(directories):
     """
-    Get a list of directory names with number. e.g. ['1', '2', '3', '4', '5'] if there are 5 backups.
-    :param directories list of old names.
-    :return: directories: list of string.
+    Get the name of the new backup: the highest version number + 1, e.g. '6' if backups are ['3', '4', '5'].
+    Older backups keep their number, so nothing has to be renamed. Archives are named like '5.tar.gz'.
+    :param directories: list of names of the other backups.
+    :return: name as string.
     """
-    new_directories_name = []
-    for i in range(0, len(directories)+1):
-        new_directories_name.append(str(i))
-    return new_directories_name
+    numbers = [directory.split('.')[0] for directory in directories]
+    versions = [int(number) for number in numbers if number.isdigit()]
+    if not versions:
+        return '0'
+    return str(max(versions) + 1)
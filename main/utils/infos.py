@@ -1,4 +1,19 @@
+import contextlib
+import heapq
+import json
+import logging
 import os
+import threading
+import time
+
+# Name of the JSON report written next to application.log at the end of each run.
+REPORT_NAME = "report.json"
+
+# Number of slowest files kept in the report.
+NB_SLOWEST_FILES = 10
+
+# Seconds between two progress lines in the logs.
+PROGRESS_INTERVAL = 10
 
 
 class Infos:
@@ -9,8 +24,160 @@ class Infos:
         self.start_time = None
         self.end_time = None
         self.nb_file_copied = 0
+        self.nb_bytes_copied = 0
+        self.nb_file_linked = 0  # unchanged files hard linked to the previous backup
+        self.nb_file_delta = 0  # large files sent with only the blocks that changed
+        self.nb_bytes_delta_skipped = 0  # bytes of these files copied on the server instead of sent
+        self.transfer_time = 0.0  # seconds spent sending files
+        self.nb_file_verified = 0  # files whose checksum was compared with the one on server
+        self.checksum_mismatches = []  # local paths of the files that are different on server
+        self.phases = {}  # phase name -> seconds spent in it
+        self.slowest_files = []  # heap of tuples (seconds, path, bytes)
+        self.workers = {}  # thread name -> {'files', 'bytes', 'seconds'} of the files it sent
+        self.profiler = None  # Profiler of the phases with the --profile option
+        self.last_progress = time.monotonic()
         self.new_directory_name = ""
         self.deleted_directories = []
         self.fail_reason = ""
         self.result = False  # indicates if success or fail
         self.script_path = os.getcwd()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure_phase(self, name):
+        """
+        Measure the time spent in the with block. Time is added if the phase is measured several times.
+        The phase is also profiled with the --profile option.
+        :param name: Name of the phase, e.g. scan or cleaning.
+        """
+        start = time.monotonic()
+        try:
+            with self.profiler.profile_phase(name) if self.profiler else contextlib.nullcontext():
+                yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - start
+
+    def add_file_copied(self, nb_bytes, path=None, duration=None):
+        """
+        Count a copied file. Can be called from several threads.
+        :param nb_bytes: size of the copied file.
+        :param path: path of the local file, only used by the report.
+        :param duration: seconds spent copying the file, None if it was not measured.
+        """
+        with self.lock:
+            self.nb_file_copied += 1
+            self.nb_bytes_copied += nb_bytes
+            self.log_progress()
+            if duration is None:
+                return
+
+            worker = self.workers.setdefault(threading.current_thread().name, {'files': 0, 'bytes': 0, 'seconds': 0.0})
+            worker['files'] += 1
+            worker['bytes'] += nb_bytes
+            worker['seconds'] += duration
+
+            if len(self.slowest_files) < NB_SLOWEST_FILES:
+                heapq.heappush(self.slowest_files, (duration, path, nb_bytes))
+            else:
+                heapq.heappushpop(self.slowest_files, (duration, path, nb_bytes))
+
+    def add_files_copied(self, nb_files, nb_bytes):
+        """
+        Count files copied by an external command, e.g. rsync. Can be called from several threads.
+        :param nb_files: number of copied files.
+        :param nb_bytes: size of the copied files.
+        """
+        with self.lock:
+            self.nb_file_copied += nb_files
+            self.nb_bytes_copied += nb_bytes
+
+    def log_progress(self):
+        """
+        Log the number of files copied so far, at most once per PROGRESS_INTERVAL. Must be called with the lock.
+        """
+        now = time.monotonic()
+        if now - self.last_progress >= PROGRESS_INTERVAL:
+            self.last_progress = now
+            logging.info("Progress: " + str(self.nb_file_copied) + " files (" + str(self.nb_bytes_copied) +
+                         " bytes) copied")
+
+    def add_file_verified(self, path, matches):
+        """
+        Count a file whose checksum was compared with the one of the file on server. Can be called from several threads.
+        :param path: path of the local file.
+        :param matches: False if the file is different on server.
+        """
+        with self.lock:
+            self.nb_file_verified += 1
+            if not matches:
+                self.checksum_mismatches.append(path)
+
+    def add_file_linked(self):
+        """
+        Count a file hard linked to the previous backup. Can be called from several threads.
+        """
+        with self.lock:
+            self.nb_file_linked += 1
+
+    def add_file_delta(self, nb_bytes_skipped):
+        """
+        Count a file sent with delta. Can be called from several threads.
+        :param nb_bytes_skipped: Bytes of the file that were not sent, the unchanged blocks.
+        """
+        with self.lock:
+            self.nb_file_delta += 1
+            self.nb_bytes_delta_skipped += nb_bytes_skipped
+
+    def get_throughput(self):
+        """
+        :return: Tuple (files per second, MB per second) of the transfer.
+        """
+        if self.transfer_time <= 0:
+            return 0.0, 0.0
+        return self.nb_file_copied / self.transfer_time, self.nb_bytes_copied / 1000000 / self.transfer_time
+
+    def get_slowest_files(self):
+        """
+        :return: List of tuples (seconds, path, bytes) of the slowest files, slowest first.
+        """
+        return sorted(self.slowest_files, reverse=True)
+
+    def get_report(self):
+        """
+        :return: Dict with all the metrics of the run, can be serialized in JSON.
+        """
+        files_per_second, mb_per_second = self.get_throughput()
+        phases = dict(self.phases)
+        phases['transfer'] = self.transfer_time
+        return {
+            'result': self.result,
+            'fail_reason': self.fail_reason,
+            'start_time': self.start_time.isoformat() if self.start_time else None,
+            'end_time': self.end_time.isoformat() if self.end_time else None,
+            'duration': (self.end_time - self.start_time).total_seconds()
+            if self.start_time and self.end_time else None,
+            'phases': phases,
+            'nb_file_copied': self.nb_file_copied,
+            'nb_file_linked': self.nb_file_linked,
+            'nb_file_delta': self.nb_file_delta,
+            'nb_bytes_delta_skipped': self.nb_bytes_delta_skipped,
+            'nb_bytes_copied': self.nb_bytes_copied,
+            'nb_file_verified': self.nb_file_verified,
+            'checksum_mismatches': self.checksum_mismatches,
+            'bytes_per_file': self.nb_bytes_copied / self.nb_file_copied if self.nb_file_copied else 0,
+            'files_per_second': files_per_second,
+            'mb_per_second': mb_per_second,
+            'slowest_files': [{'path': path, 'bytes': nb_bytes, 'seconds': seconds}
+                              for seconds, path, nb_bytes in self.get_slowest_files()],
+            'workers': self.workers,
+            'memory_peaks': self.profiler.peaks if self.profiler else {},
+            'new_directory_name': self.new_directory_name,
+            'deleted_directories': self.deleted_directories,
+        }
+
+    def write_report(self):
+        """
+        Write the report in the directory of the log files.
+        """
+        with open(os.path.join(self.script_path, REPORT_NAME), 'w') as report_file:
+            json.dump(self.get_report(), report_file, indent=2)
@@ -4,11 +4,13 @@ import select
 from logging import DEBUG, ERROR
 
 
-def call(popenargs, infos, stdout_log_level=DEBUG, stderr_log_level=ERROR, **kwargs):
+def call(popenargs, line_callback=None, prefix="", stdout_log_level=DEBUG, stderr_log_level=ERROR, **kwargs):
     """
     Variant of subprocess.call that accepts a logger instead of stdout/stderr,
     and logs stdout messages via logger.debug and stderr messages via
     logger.error.
+    :param line_callback: function called with each line of stdout as string, e.g. to parse statistics.
+    :param prefix: written before each logged line, to tell apart processes that run at the same time.
     """
     child = subprocess.Popen(popenargs, stdout=subprocess.PIPE,
                              stderr=subprocess.PIPE, **kwargs)
@@ -16,19 +18,27 @@ def call(popenargs, infos, stdout_log_level=DEBUG, stderr_log_level=ERROR, **kwa
     log_level = {child.stdout: stdout_log_level,
                  child.stderr: stderr_log_level}
 
+    def handle_line(io, line):
+        line = line.decode('utf-8', errors='replace').rstrip('\n')
+        if len(line) > 1:
+            logging.log(log_level[io], prefix + line)
+            if line_callback is not None and io is child.stdout:
+                line_callback(line)
+
     def check_io():
         ready_to_read = select.select([child.stdout, child.stderr], [], [], 1000)[0]
         for io in ready_to_read:
             line = io.readline()
-            if len(line) > 2:
-                logging.log(log_level[io], line[:-1])
-                if "Number of files:" in str(line[:-1]):
-                    infos.nb_file_copied = str(infos.nb_file_copied) + str(line[:-1])
+            if line:
+                handle_line(io, line)
 
     # keep checking stdout/stderr until the child exits
     while child.poll() is None:
         check_io()
 
-    check_io()  # check again to catch anything after the process exits
+    # read everything written before the process exited, e.g. the statistics at the end
+    for io in (child.stdout, child.stderr):
+        for line in io:
+            handle_line(io, line)
 
     return child.wait()
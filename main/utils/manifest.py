@@ -0,0 +1,103 @@
+import json
+import logging
+import posixpath
+
+# Name of the manifest file written in each backup directory.
+MANIFEST_NAME = "manifest.json"
+
+
+class Manifest:
+    """
+    List of the files of a backup with their size, modification time and hash.
+    For each file, location is the name of the backup directory that really contains it, and bundle the name of the
+    bundle that contains it if it was bundled. hash is None if the file was not hashed when it was sent (bundled or
+    sent with sendfile).
+    """
+
+    def __init__(self, directory_name, files=None):
+        """
+        Constructor.
+        :param directory_name: Name of the backup directory described by the manifest.
+        :param files: Dict relative path -> {'size', 'mtime', 'hash', 'location'}.
+        """
+        self.directory_name = directory_name
+        self.files = files if files is not None else {}
+
+    def add_file(self, relative_path, size, mtime, file_hash, location, bundle=None):
+        self.files[relative_path] = {'size': size, 'mtime': mtime, 'hash': file_hash, 'location': location}
+        if bundle is not None:
+            self.files[relative_path]['bundle'] = bundle
+
+    def add_bundles(self, bundles):
+        """
+        Record the bundle that contains each bundled file of this backup.
+        :param bundles: List of Bundle.
+        """
+        for bundle in bundles:
+            for entry in bundle.entries:
+                self.files[entry.relative_path]['bundle'] = bundle.name
+
+    def add_checksums(self, checksums, unreadable_paths):
+        """
+        Give the files sent in this backup the SHA-256 computed while they were sent, and remove the files that could
+        not be read.
+        :param checksums: Dict relative path -> SHA-256 of the files sent, see Checkpoint.checksums.
+        :param unreadable_paths: Set of the relative paths of the files that could not be read.
+        """
+        for relative_path in unreadable_paths:
+            self.files.pop(relative_path, None)
+        for relative_path, properties in self.files.items():
+            if properties['location'] == self.directory_name and relative_path in checksums:
+                properties['hash'] = checksums[relative_path]
+
+    def to_bytes(self):
+        return json.dumps({'directory': self.directory_name, 'files': self.files}).encode('utf-8')
+
+    @staticmethod
+    def from_bytes(data):
+        content = json.loads(data.decode('utf-8'))
+        return Manifest(content['directory'], content['files'])
+
+
+def get_directories_to_keep(directories, archiving_max):
+    """
+    Get the backup directories that will still exist after the next run.
+    Files that are only in other directories must be sent again, otherwise they would be lost at next cleaning.
+    :param directories: List of names of the backup directories, sorted from oldest to newest, without the new one.
+    :param archiving_max: Maximum number of backups.
+    :return: Set of directory names.
+    """
+    nb_deleted_next_time = max(0, len(directories) + 1 - int(archiving_max) + 1)
+    return set(directories[nb_deleted_next_time:])
+
+
+def filter_unchanged_files(files_to_send, backup_path, manifest, previous_manifest, directories_to_keep):
+    """
+    Remove from the files to send the ones that did not change since the previous backup and fill the manifest.
+    A file is unchanged if its size and its modification time are the same as in the previous manifest.
+    :param files_to_send: List of tuples (scan index entry, absolute path on server).
+    :param backup_path: Absolute path of the new backup directory on server.
+    :param manifest: Manifest of the new backup, filled by this function.
+    :param previous_manifest: Manifest of the latest backup or None.
+    :param directories_to_keep: Set of backup directories that can be referenced.
+    :return: List of tuples (scan index entry, absolute path on server) of the files that must be sent.
+    """
+    changed_files = []
+    nb_unchanged_bytes = 0
+    for entry, remote_path in files_to_send:
+        relative_path = posixpath.relpath(remote_path, backup_path)
+        previous = previous_manifest.files.get(relative_path) if previous_manifest else None
+        if previous is not None and previous['location'] in directories_to_keep \
+                and previous['size'] == entry.size and previous['mtime'] == entry.mtime:
+            manifest.add_file(relative_path, entry.size, entry.mtime, previous['hash'], previous['location'],
+                              previous.get('bundle'))
+            nb_unchanged_bytes += entry.size
+        else:
+            # The hash is the checksum computed while the file is sent, see add_checksums
+            manifest.add_file(relative_path, entry.size, entry.mtime, None, manifest.directory_name)
+            changed_files.append((entry, remote_path))
+
+    logging.info("Incremental backup: " + str(len(changed_files)) + " new or changed files to send, " +
+                 str(len(files_to_send) - len(changed_files)) + " unchanged files (" +
+                 str(nb_unchanged_bytes) + " bytes) kept in previous backups")
+    return changed_files
@@ -0,0 +1,196 @@
+import queue
+import threading
+
+from main.utils.profile_logging import in_current_context
+
+# Size of the blocks read from disk by the reader stage.
+READ_BLOCK_SIZE = 256 * 1024
+
+
+class ReadAheadFile:
+    """
+    File opened and read by the reader stage of the pipeline while the transport stage sends it. Only the blocks not
+    sent yet are kept in memory, at most depth blocks. Errors of the reader are raised in the transport stage, where
+    the file is used: when it is entered for an open error, by read for a read error.
+    """
+
+    def __init__(self, path, depth):
+        """
+        Constructor.
+        :param path: Path of the local file.
+        :param depth: Maximum number of blocks read in advance.
+        """
+        self.path = path
+        self.blocks = queue.Queue(maxsize=depth)  # bytes, None at the end of the file or an exception
+        self.block = memoryview(b'')
+        self.position = 0  # position in the current block
+        self.nb_bytes_read = 0  # bytes given to the transport
+        self.open_error = None
+        self.end = False
+        self.closed = False
+
+    def __enter__(self):
+        if self.open_error is not None:
+            raise self.open_error
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, size=-1):
+        """
+        :param size: Maximum number of bytes, -1 for the rest of the file.
+        :return: Next bytes of the file, empty at the end.
+        """
+        parts = []
+        while size != 0 and not self.end:
+            if self.position == len(self.block):
+                block = self.blocks.get()
+                if block is None:
+                    self.end = True
+                    break
+                if isinstance(block, Exception):
+                    self.end = True
+                    raise block
+                self.block = memoryview(block)
+                self.position = 0
+            end = len(self.block) if size < 0 else min(len(self.block), self.position + size)
+            parts.append(self.block[self.position:end])
+            if size > 0:
+                size -= end - self.position
+            self.position = end
+        data = b''.join(parts)
+        self.nb_bytes_read += len(data)
+        return data
+
+    def tell(self):
+        return self.nb_bytes_read
+
+    def seek(self, offset):
+        """
+        Skip the beginning of the file, e.g. the bytes already sent when a transfer is resumed. Blocks are read in
+        order, it is not possible to go back.
+        :param offset: New position, not before the current one.
+        """
+        while self.nb_bytes_read < offset:
+            if not self.read(min(offset - self.nb_bytes_read, READ_BLOCK_SIZE)):
+                break
+        return self.nb_bytes_read
+
+    def close(self):
+        """
+        Stop the reader if the file is not read to the end, e.g. the transfer failed.
+        """
+        self.closed = True
+        while True:
+            try:
+                self.blocks.get_nowait()
+            except queue.Empty:
+                return
+
+    def fill(self, file):
+        """
+        Read the file in blocks until its end or until the transport closes it. Runs in a reader thread.
+        :param file: The local file opened in binary mode, closed at the end.
+        """
+        try:
+            with file:
+                while not self.closed:
+                    block = file.read(READ_BLOCK_SIZE)
+                    self.put(block or None)
+                    if not block:
+                        return
+        except OSError as e:
+            self.put(e)
+
+    def put(self, block):
+        """
+        Wait for a free place for the block, unless the transport closed the file.
+        """
+        while not self.closed:
+            try:
+                self.blocks.put(block, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+
+def run_pipeline(connections, jobs, work, get_path, depth):
+    """
+    Do jobs with two stages connected by bounded queues: reader threads read the local files in advance, one transport
+    thread per connection sends them. Disk reads overlap with network writes and the memory used is bounded by the
+    number of files in flight times depth blocks.
+    A new saving mode only has to give the transport, the work done for one job with one connection.
+    If a job raises an exception, the remaining jobs are abandoned and the first exception is raised again.
+    :param connections: List of connection objects, one transport thread is started per connection.
+    :param jobs: Iterable of jobs to do, in order.
+    :param work: Function called with (connection, job, ReadAheadFile or None) for each job.
+    :param get_path: Function called with a job, returns the path of the local file to read in advance or None if the
+    transport reads it itself, e.g. for a bundle.
+    :param depth: Maximum number of blocks read in advance for each file, 0 to not use the reader stage.
+    """
+    jobs_queue = queue.Queue()
+    for job in jobs:
+        jobs_queue.put(job)
+
+    # One reader more than transports: the next file is being read while all the transports are busy
+    nb_readers = len(connections) + 1 if depth > 0 else 1
+    ready = queue.Queue(maxsize=nb_readers)  # tuples (job, ReadAheadFile or None), None when all jobs are read
+    errors = []
+
+    def reader():
+        while not errors:
+            try:
+                job = jobs_queue.get_nowait()
+            except queue.Empty:
+                return
+            path = get_path(job) if depth > 0 else None
+            if path is None:
+                ready.put((job, None))
+                continue
+            local_file = ReadAheadFile(path, depth)
+            try:
+                file = open(path, 'rb')
+            except OSError as e:
+                local_file.open_error = e
+                ready.put((job, local_file))
+                continue
+            # Given to the transport first, it sends the blocks while the next ones are read
+            ready.put((job, local_file))
+            local_file.fill(file)
+
+    def transport(connection):
+        while True:
+            item = ready.get()
+            if item is None:
+                return
+            job, local_file = item
+            if errors:
+                # Abandon the jobs read in advance
+                if local_file is not None:
+                    local_file.close()
+                continue
+            try:
+                work(connection, job, local_file)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if local_file is not None:
+                    local_file.close()
+
+    readers = [threading.Thread(target=in_current_context(reader), name="reader-" + str(i), daemon=True)
+               for i in range(nb_readers)]
+    transports = [threading.Thread(target=in_current_context(transport), args=(connection,),
+                                   name="connection-" + str(i), daemon=True)
+                  for i, connection in enumerate(connections)]
+    for thread in readers + transports:
+        thread.start()
+    for thread in readers:
+        thread.join()
+    for _ in transports:
+        ready.put(None)
+    for thread in transports:
+        thread.join()
+
+    if errors:
+        raise errors[0]
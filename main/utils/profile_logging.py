@@ -0,0 +1,63 @@
+import ast
+import configparser
+import contextvars
+import logging
+import os
+
+from main.utils.queue_logging import file_events
+
+# Name of the profile of the backup that runs in the current thread, None outside of the daemon.
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+
+class ProfileFilter(logging.Filter):
+    """
+    Keep only the records logged by the backup of one profile, so each profile of the daemon has its own log files.
+    With None, keep only the records logged outside of any profile, e.g. by the scheduler.
+    """
+
+    def __init__(self, profile_name):
+        super().__init__()
+        self.profile_name = profile_name
+        self.file_events = "ALL"  # ALL or SUMMARY, like set_file_events_verbosity but for this profile only
+
+    def filter(self, record):
+        if current_profile.get() != self.profile_name:
+            return False
+        return self.file_events == "ALL" or record.name != file_events.name or record.levelno >= logging.WARNING
+
+
+def in_current_context(function):
+    """
+    Threads do not inherit the context of the thread that creates them: the work given to a new thread must be
+    wrapped to log in the same profile.
+    :param function: Function run by another thread.
+    :return: Function that runs the given one in a copy of the current context, can be called by several threads.
+    """
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(function, *args)
+
+
+def get_file_handlers(logging_path, directory):
+    """
+    Create the file handlers of the logging configuration file (application.log, warning.log, error.log) in another
+    directory, with the same levels and format.
+    :param logging_path: Path of the logging configuration file, e.g. main/settings/logging.ini.
+    :param directory: Directory of the log files.
+    :return: List of the handlers.
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(logging_path)
+
+    handlers = []
+    for name in config.get('handlers', 'keys').split(','):
+        section = config['handler_' + name.strip()]
+        if section.get('class') != 'FileHandler':
+            continue
+        args = ast.literal_eval(section.get('args'))
+        handler = logging.FileHandler(os.path.join(directory, args[0]), *args[1:])
+        handler.setLevel(section.get('level', 'NOTSET'))
+        formatter = config['formatter_' + section.get('formatter')]
+        handler.setFormatter(logging.Formatter(formatter.get('format'), formatter.get('datefmt')))
+        handlers.append(handler)
+    return handlers
@@ -0,0 +1,77 @@
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import tracemalloc
+
+# Number of functions and of source lines written for each phase.
+NB_TOP_LINES = 30
+
+
+def reset_peak():
+    """
+    Start measuring the peak of traced memory again. tracemalloc.reset_peak only exists from python 3.9: before, the
+    peak of a phase is the highest memory traced since the start of the run.
+    """
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+
+
+class Profiler:
+    """
+    Profile each phase of a run with cProfile and tracemalloc. Only used with the --profile option.
+    cProfile only sees the thread that runs the phase: with several connections, the work of the other threads appears
+    as time spent waiting for them.
+    """
+
+    def __init__(self):
+        self.profiles = {}  # phase name -> cProfile.Profile
+        self.peaks = {}  # phase name -> peak of traced memory in bytes
+        self.snapshots = {}  # phase name -> tracemalloc snapshot at the end of the phase
+        self.running = []  # [phase name, peak of memory so far] of the phases in progress, innermost last
+        tracemalloc.start()
+
+    @contextlib.contextmanager
+    def profile_phase(self, name):
+        """
+        Profile the with block. A phase can contain other phases, e.g. cleaning is in save.
+        :param name: Name of the phase.
+        """
+        # Only one cProfile can be enabled at a time, the enclosing phase is paused
+        if self.running:
+            self.profiles[self.running[-1][0]].disable()
+            self.running[-1][1] = max(self.running[-1][1], tracemalloc.get_traced_memory()[1])
+        reset_peak()
+        self.running.append([name, 0])
+        profile = self.profiles.setdefault(name, cProfile.Profile())
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            peak = max(self.running.pop()[1], tracemalloc.get_traced_memory()[1])
+            self.peaks[name] = max(self.peaks.get(name, 0), peak)
+            self.snapshots[name] = tracemalloc.take_snapshot()
+
+            if self.running:
+                self.running[-1][1] = max(self.running[-1][1], peak)
+                reset_peak()
+                self.profiles[self.running[-1][0]].enable()
+
+    def write(self, directory):
+        """
+        Write, for each phase, profile_<phase>.prof (readable with pstats or snakeviz) and profile_<phase>.txt with
+        the peak of memory, the most expensive functions and the lines that hold the most memory.
+        :param directory: Directory of the log files.
+        """
+        tracemalloc.stop()
+        for name, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(directory, "profile_" + name + ".prof"))
+            with open(os.path.join(directory, "profile_" + name + ".txt"), 'w') as profile_file:
+                profile_file.write("Peak of memory: {} bytes\n\n".format(self.peaks[name]))
+                pstats.Stats(profile, stream=profile_file).sort_stats('cumulative').print_stats(NB_TOP_LINES)
+                profile_file.write("Memory allocated at the end of the phase, by line:\n")
+                for statistic in self.snapshots[name].statistics('lineno')[:NB_TOP_LINES]:
+                    profile_file.write(str(statistic) + "\n")
+            logging.info("Profile of phase " + name + " written, peak of memory: " + str(self.peaks[name]) + " bytes")
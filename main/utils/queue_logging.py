@@ -0,0 +1,48 @@
+import logging
+import logging.handlers
+import queue
+
+# Logger of the events of each file (sending, resuming, directory created...). Its level gives their verbosity.
+file_events = logging.getLogger("files")
+
+
+def set_file_events_verbosity(verbosity):
+    """
+    :param verbosity: ALL to log each file, SUMMARY to only log the progress and the totals.
+    Warnings and errors about files are always logged.
+    """
+    file_events.setLevel(logging.INFO if verbosity == "ALL" else logging.WARNING)
+
+
+class QueueLogging:
+    """
+    Runs the handlers of the root logger (console, application.log, warning.log, error.log) in a background thread.
+    Threads that log only put the records in a queue, they do not wait for the writes.
+    """
+
+    def __init__(self):
+        self.listener = None
+        self.handlers = []
+
+    def start(self):
+        root = logging.getLogger()
+        self.handlers = root.handlers[:]
+        records = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(records, *self.handlers, respect_handler_level=True)
+        for handler in self.handlers:
+            root.removeHandler(handler)
+        root.addHandler(logging.handlers.QueueHandler(records))
+        self.listener.start()
+
+    def stop(self):
+        """
+        Write the records still in the queue and put the handlers back on the root logger.
+        Must be called before the log files are read, e.g. to attach them to the mail.
+        """
+        root = logging.getLogger()
+        self.listener.stop()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        for handler in self.handlers:
+            handler.flush()
+            root.addHandler(handler)
@@ -0,0 +1,129 @@
+import fnmatch
+import logging
+import os
+import stat
+from collections import namedtuple
+from pathlib import Path
+
+# One scanned file or directory. Tuples are used to keep the index small with millions of entries.
+# path: local path, relative_path: path in the backup, type: 'file' or 'dir', size, mtime and mode: from stat.
+Entry = namedtuple('Entry', ['path', 'relative_path', 'type', 'size', 'mtime', 'mode'])
+
+
+class ScanIndex:
+    """
+    Files and directories to save, scanned once and shared by every saving mode.
+    Entries are in scan order: a directory always comes before its content.
+    """
+
+    def __init__(self, exclusions=()):
+        """
+        Constructor.
+        :param exclusions: Patterns of the files and directories not to save, see is_excluded().
+        """
+        self.exclusions = list(exclusions)
+        self.roots = []  # Verified paths to save
+        self.entries = []
+        self.nb_files = 0
+        self.total_size = 0
+
+    def scan(self, paths_to_save):
+        """
+        Scan each path to save with os.scandir. Paths that do not exist are ignored.
+        :param paths_to_save: List of strings that contains paths or files.
+        """
+        for path_or_file in paths_to_save:
+            name = Path(path_or_file).name
+            if self.is_excluded(name, name):
+                logging.info("Excluded: " + path_or_file)
+                continue
+            try:
+                path_stat = os.stat(path_or_file)
+            except FileNotFoundError:
+                logging.error("File or directory NOT FOUND: " + path_or_file)
+                continue
+            except PermissionError:
+                logging.warning("Cannot copy: " + path_or_file + " PERMISSION DENIED")
+                continue
+
+            if stat.S_ISREG(path_stat.st_mode):
+                logging.info("File: " + path_or_file + " exists")
+                self.roots.append(path_or_file)
+                self.add(path_or_file, name, 'file', path_stat)
+            elif stat.S_ISDIR(path_stat.st_mode):
+                logging.info("Directory: " + path_or_file + " exists")
+                self.roots.append(path_or_file)
+                self.add(path_or_file, name, 'dir', path_stat)
+                logging.info("Analysing: " + path_or_file)
+                self.scan_directory(path_or_file, name, path_stat)
+
+    def scan_directory(self, path, relative_path, path_stat):
+        """
+        Scan a directory recursively. Symbolic links are followed, except if they point to one of their parents.
+        :param path: local path of the directory.
+        :param relative_path: path of the directory in the backup.
+        :param path_stat: stat of the directory.
+        """
+        # Stack of (path, relative path, (device, inode) of the directory and its parents)
+        directories = [(path, relative_path, ((path_stat.st_dev, path_stat.st_ino),))]
+        while directories:
+            path, relative_path, parents = directories.pop()
+            subdirectories = []
+            try:
+                with os.scandir(path) as iterator:
+                    for dir_entry in iterator:
+                        entry_relative_path = relative_path + '/' + dir_entry.name
+                        if self.is_excluded(dir_entry.name, entry_relative_path):
+                            continue
+                        try:
+                            entry_stat = dir_entry.stat()
+                        except OSError:
+                            logging.warning("Cannot copy: " + dir_entry.path + " PERMISSION DENIED")
+                            continue
+
+                        if stat.S_ISREG(entry_stat.st_mode):
+                            self.add(dir_entry.path, entry_relative_path, 'file', entry_stat)
+                        elif stat.S_ISDIR(entry_stat.st_mode):
+                            if (entry_stat.st_dev, entry_stat.st_ino) in parents:
+                                logging.warning("Ignored symbolic link loop: " + dir_entry.path)
+                                continue
+                            self.add(dir_entry.path, entry_relative_path, 'dir', entry_stat)
+                            subdirectories.append((dir_entry.path, entry_relative_path,
+                                                   parents + ((entry_stat.st_dev, entry_stat.st_ino),)))
+            except OSError:
+                logging.warning("Cannot copy: " + path + " PERMISSION DENIED")
+
+            # Reversed to scan subdirectories in the order they were found
+            directories.extend(reversed(subdirectories))
+
+    def is_excluded(self, name, relative_path):
+        """
+        A pattern without "/" is matched against the name of the file or directory, e.g. *.tmp or node_modules.
+        A pattern with "/" is matched against the path in the backup, e.g. Documents/*/cache.
+        :param name: Name of the file or directory.
+        :param relative_path: Path in the backup.
+        :return: True if the file or directory must not be saved. The content of an excluded directory is not saved.
+        """
+        for pattern in self.exclusions:
+            if fnmatch.fnmatchcase(relative_path if '/' in pattern else name, pattern):
+                return True
+        return False
+
+    def add(self, path, relative_path, entry_type, entry_stat):
+        self.entries.append(Entry(path, relative_path, entry_type, entry_stat.st_size, entry_stat.st_mtime,
+                                  entry_stat.st_mode))
+        if entry_type == 'file':
+            self.nb_files += 1
+            self.total_size += entry_stat.st_size
+
+    def files(self):
+        """
+        :return: Iterator on the entries of the files.
+        """
+        return (entry for entry in self.entries if entry.type == 'file')
+
+    def directories(self):
+        """
+        :return: Iterator on the entries of the directories.
+        """
+        return (entry for entry in self.entries if entry.type == 'dir')
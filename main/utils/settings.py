@@ -3,6 +3,7 @@ from os import path
 
 import configparser as configparser
 
+from main.utils.archive_stream import is_compression_available
 from main.utils.custom_exceptions import ApplicationError
 
 
@@ -17,15 +18,35 @@ class Settings:
         # [ main ]
         self.save_mode = None
         self.paths_to_save = None
+        self.exclusions = []
         self.archiving_mode = None
         self.archiving_max = None
         self.directory_to_save_in = None
+        self.incremental = "NO"
+        self.snapshot = "NO"
+        self.nb_threads = 4
+        self.read_ahead = 8
+        self.archive = "NO"
+        self.compression_level = 6
+        self.bundle_threshold = 0
+        self.log_queue = "NO"
+        self.file_events = "ALL"
 
         # [remote]
         self.username = None
         self.password = None
         self.port = None
         self.server_ip_address = None
+        self.nb_connections = 1
+        self.server_side_delete = "NO"
+        self.rsync_files_from = "NO"
+        self.verify = "NO"
+        self.verify_sample = 5
+        self.delta_threshold = 0
+        self.buffer_size = 262144
+        self.window_size = 4194304
+        self.zero_copy = "NO"
+        self.command_timeout = 3600
 
         # [email]
         self.email_recipients = []
@@ -51,16 +72,51 @@ class Settings:
             config.read(self.file_name)
 
             self.paths_to_save = config.get('main', 'paths_to_save').splitlines()
+            self.exclusions = [pattern for pattern in config.get('main', 'exclusions', fallback='').splitlines()
+                               if pattern.strip()]
             self.save_mode = config.get('main', 'save_mode')
             self.archiving_mode = config.get('main', 'archiving_mode')
             self.archiving_max = config.get('main', 'archiving_max')
             self.directory_to_save_in = config.get('main', 'directory_to_save_in')
+            self.incremental = config.get('main', 'incremental', fallback='NO')
+            self.snapshot = config.get('main', 'snapshot', fallback='NO')
+            self.nb_threads = int(config.get('main', 'nb_threads', fallback='4'))
+            if self.nb_threads < 1:
+                raise ApplicationError("Number of threads must be at least 1, please verify your settings.ini")
+            self.read_ahead = int(config.get('main', 'read_ahead', fallback='8'))
+            if self.read_ahead < 0:
+                raise ApplicationError("Read ahead must be at least 0, please verify your settings.ini")
 
             # Verify archiving mode
             self.archiving_mode = config.get('main', 'archiving_mode')
             if self.archiving_mode not in {"date", "version"}:
                 raise ApplicationError("Archiving mode mode is not valid, please verify your settings.ini")
 
+            if self.incremental not in {"YES", "NO"}:
+                raise ApplicationError("Incremental option is not valid, please verify your settings.ini")
+
+            # Verify archive mode
+            self.archive = config.get('main', 'archive', fallback='NO')
+            self.compression_level = int(config.get('main', 'compression_level', fallback='6'))
+            if self.archive != "NO" and not is_compression_available(self.archive):
+                raise ApplicationError("Archive option is not valid or its module is not installed, "
+                                       "please verify your settings.ini")
+            if self.archive != "NO" and self.incremental == "YES":
+                raise ApplicationError("Archive and incremental options cannot be used together, "
+                                       "please verify your settings.ini")
+
+            self.bundle_threshold = int(config.get('main', 'bundle_threshold', fallback='0'))
+
+            self.log_queue = config.get('main', 'log_queue', fallback='NO')
+            if self.log_queue not in {"YES", "NO"}:
+                raise ApplicationError("Log queue option is not valid, please verify your settings.ini")
+            self.file_events = config.get('main', 'file_events', fallback='ALL')
+            if self.file_events not in {"ALL", "SUMMARY"}:
+                raise ApplicationError("File events option is not valid, please verify your settings.ini")
+
+            if self.snapshot not in {"YES", "NO"}:
+                raise ApplicationError("Snapshot option is not valid, please verify your settings.ini")
+
             remote_modes = ["FTP", "FTPS", "SFTP", "RSYNC"]
             # Verify if save mode is a remote method
             if self.save_mode in remote_modes:
@@ -69,9 +125,38 @@ class Settings:
                 self.username = config.get('remote', 'username')
                 self.password = config.get('remote', 'password')
                 self.port = int(config.get('remote', 'port'))
+                self.nb_connections = int(config.get('remote', 'nb_connections', fallback='1'))
+                if self.nb_connections < 1:
+                    raise ApplicationError("Number of connections must be at least 1, please verify your settings.ini")
+                self.server_side_delete = config.get('remote', 'server_side_delete', fallback='NO')
+                if self.server_side_delete not in {"YES", "NO"}:
+                    raise ApplicationError("server_side_delete option is not valid, please verify your settings.ini")
+                self.rsync_files_from = config.get('remote', 'rsync_files_from', fallback='NO')
+                if self.rsync_files_from not in {"YES", "NO"}:
+                    raise ApplicationError("rsync_files_from option is not valid, please verify your settings.ini")
+                self.verify = config.get('remote', 'verify', fallback='NO')
+                if self.verify not in {"YES", "NO"}:
+                    raise ApplicationError("verify option is not valid, please verify your settings.ini")
+                self.verify_sample = float(config.get('remote', 'verify_sample', fallback='5'))
+                if not 0 <= self.verify_sample <= 100:
+                    raise ApplicationError("verify_sample must be between 0 and 100, please verify your settings.ini")
+                self.delta_threshold = int(config.get('remote', 'delta_threshold', fallback='0'))
+                if self.delta_threshold < 0:
+                    raise ApplicationError("delta_threshold must be at least 0, please verify your settings.ini")
+                self.buffer_size = int(config.get('remote', 'buffer_size', fallback='262144'))
+                self.window_size = int(config.get('remote', 'window_size', fallback='4194304'))
+                if self.buffer_size < 1 or self.window_size < 32768:
+                    raise ApplicationError("buffer_size must be at least 1 and window_size at least 32768, "
+                                           "please verify your settings.ini")
+                self.command_timeout = int(config.get('remote', 'command_timeout', fallback='3600'))
+                if self.command_timeout < 1:
+                    raise ApplicationError("command_timeout must be at least 1, please verify your settings.ini")
+                self.zero_copy = config.get('remote', 'zero_copy', fallback='NO')
+                if self.zero_copy not in {"YES", "NO"}:
+                    raise ApplicationError("zero_copy option is not valid, please verify your settings.ini")
 
             # Else, verify if it is local
-            elif self.save_mode == "LOCAL":
+            elif self.save_mode in ["LOCAL", "DEDUP"]:
                 logging.info("{} mode chosen".format(self.save_mode))
 
             # Raise an exception if precedent tests failed
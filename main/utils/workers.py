@@ -0,0 +1,45 @@
+import queue
+import threading
+
+from main.utils.profile_logging import in_current_context
+
+
+def run_in_workers(connections, jobs, work):
+    """
+    Distribute jobs across connections. Each connection is used by one and only one thread.
+    If a job raises an exception, the remaining jobs are abandoned and the first exception is raised again.
+    :param connections: List of connection objects, one thread is started per connection.
+    :param jobs: Iterable of jobs to do.
+    :param work: Function called with (connection, job) for each job.
+    """
+    jobs_queue = queue.Queue()
+    for job in jobs:
+        jobs_queue.put(job)
+
+    errors = []
+
+    def worker(connection):
+        while not errors:
+            try:
+                job = jobs_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                work(connection, job)
+            except Exception as e:
+                errors.append(e)
+
+    # Do not create threads if there is only one connection
+    if len(connections) == 1:
+        worker(connections[0])
+    else:
+        threads = [threading.Thread(target=in_current_context(worker), args=(connection,), name="connection-" + str(i),
+                                    daemon=True)
+                   for i, connection in enumerate(connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]